@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Benchmark formatting the values of the cells displayed on the grid.
+
+Values of four mixed columns (two texts, an integer and a timestamp)
+and of the selection column are formatted through
+:meth:`datagrid_gtk3.ui.grid.DataGridModel.get_formatted_value`, and
+the best rate of a few runs is printed for each.
+
+Usage::
+
+    python benchmarks/format_cells.py [--rows N] [CHECKOUT]
+
+``CHECKOUT`` is the root of the datagrid_gtk3 checkout to benchmark,
+defaulting to the one containing this script. To compare against an
+older revision, check it out somewhere else first, e.g.::
+
+    git worktree add /tmp/before <revision>
+    python benchmarks/format_cells.py /tmp/before
+
+"""
+
+import argparse
+import atexit
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+_ROOT = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                     os.path.pardir)
+
+_CONFIG = [
+    {'column': 'first_name', 'type': 'str'},
+    {'column': 'last_name', 'type': 'str'},
+    {'column': 'age', 'type': 'int'},
+    {'column': 'start', 'type': 'int', 'encoding': 'timestamp'},
+]
+
+
+def create_db(path):
+    """Create the people database.
+
+    :param str path: the path of the database file
+    """
+    conn = sqlite3.connect(path)
+    conn.execute('CREATE TABLE people (__id INTEGER PRIMARY KEY, '
+                 'first_name TEXT, last_name TEXT, age INTEGER, '
+                 'start INTEGER)')
+    conn.execute('INSERT INTO people VALUES (1, ?, ?, ?, ?)',
+                 (u'Dee ' * 5, u'Steve', 34, 1400000000))
+    conn.commit()
+    conn.close()
+
+
+def get_best_rate(func, cells, runs):
+    """Get the best rate func formatted the cells at.
+
+    :param callable func: the function formatting a single cell
+    :param list cells: the values and column indexes of the cells
+    :param int runs: how many times the rate should be measured
+    :return: the best rate, in cells per second
+    :rtype: float
+    """
+    best = None
+    for _ in xrange(runs):
+        start = time.time()
+        for value, column in cells:
+            func(value, column)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return len(cells) / best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('checkout', nargs='?', default=_ROOT)
+    parser.add_argument('--rows', type=int, default=200000)
+    parser.add_argument('--runs', type=int, default=3)
+    args = parser.parse_args()
+
+    sys.path.insert(0, os.path.realpath(args.checkout))
+    from datagrid_gtk3.db.sqlite import SQLiteDataSource
+    from datagrid_gtk3.ui.grid import DataGridModel
+
+    tmpdir = tempfile.mkdtemp()
+    atexit.register(shutil.rmtree, tmpdir)
+    db_path = os.path.join(tmpdir, 'people.sqlite')
+    create_db(db_path)
+
+    data_source = SQLiteDataSource(db_path, 'people', config=_CONFIG)
+    model = DataGridModel(data_source, None, None)
+    model.refresh()
+
+    columns_idx = dict(
+        (column['name'], i) for i, column in enumerate(model.columns))
+    row = [u'Dee ' * 5, u'Steve', 34, 1400000000]
+    cells = [(value, columns_idx[column['column']])
+             for value, column in zip(row, _CONFIG)] * args.rows
+    print('%d mixed cells/s' % (
+        get_best_rate(model.get_formatted_value, cells, args.runs), ))
+
+    selected_idx = columns_idx[data_source.SELECTED_COLUMN]
+    cells = [(True, selected_idx), (False, selected_idx)] * args.rows
+    print('%d selection cells/s' % (
+        get_best_rate(model.get_formatted_value, cells, args.runs), ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Benchmark loading a filtered tree from a SQLite data source.
+
+A synthetic tree (integer ids, indexed parent column, 28 levels deep
+with the default size) is filtered on an unindexed column matching
+about 0.1% of its nodes. The matches are loaded with all their
+ancestors, and the time and number of queries of each load, including
+the total count, are printed.
+
+Usage::
+
+    python benchmarks/load_filtered_tree.py [--nodes N] [CHECKOUT]
+
+``CHECKOUT`` is the root of the datagrid_gtk3 checkout to benchmark,
+defaulting to the one containing this script. To compare against an
+older revision, check it out somewhere else first, e.g.::
+
+    git worktree add /tmp/before <revision>
+    python benchmarks/load_filtered_tree.py /tmp/before
+
+"""
+
+import argparse
+import atexit
+import os
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+_ROOT = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                     os.path.pardir)
+
+
+def create_db(path, nodes):
+    """Create the tree database.
+
+    :param str path: the path of the database file
+    :param int nodes: the number of nodes on the tree
+    """
+    rnd = random.Random(42)
+
+    def iter_nodes():
+        for i in xrange(1, nodes + 1):
+            parent = int(i / 1.58) or None
+            tag = 1 if rnd.random() < 0.001 else 0
+            yield (i, parent, 'node-%d' % (i, ), tag, 0)
+
+    conn = sqlite3.connect(path)
+    conn.execute('CREATE TABLE nodes (__id INTEGER PRIMARY KEY, '
+                 '__parent INTEGER, name TEXT, tag INTEGER, '
+                 'children_len INTEGER)')
+    conn.executemany('INSERT INTO nodes VALUES (?, ?, ?, ?, ?)', iter_nodes())
+    conn.execute('CREATE INDEX nodes_parent ON nodes (__parent)')
+    conn.commit()
+    conn.close()
+
+
+def count_nodes(rows):
+    """Count the loaded nodes, including the children.
+
+    :param rows: the loaded rows
+    :type rows: :class:`datagrid_gtk3.db.Node`
+    :return: the number of nodes
+    :rtype: int
+    """
+    return sum(1 + count_nodes(row) for row in rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('checkout', nargs='?', default=_ROOT)
+    parser.add_argument('--nodes', type=int, default=1000000)
+    parser.add_argument('--runs', type=int, default=3)
+    args = parser.parse_args()
+
+    sys.path.insert(0, os.path.realpath(args.checkout))
+    from datagrid_gtk3.db.sqlite import SQLiteDataSource
+
+    class TreeDataSource(SQLiteDataSource):
+        PARENT_ID_COLUMN = '__parent'
+        CHILDREN_LEN_COLUMN = 'children_len'
+
+    tmpdir = tempfile.mkdtemp()
+    atexit.register(shutil.rmtree, tmpdir)
+    db_path = os.path.join(tmpdir, 'tree.sqlite')
+    create_db(db_path, args.nodes)
+
+    data_source = TreeDataSource(db_path, 'nodes',
+                                 ensure_selected_column=False)
+    params = {
+        'where': {'tag': {'param': 1, 'operator': '='}},
+        'order_by': '__id',
+    }
+    queries = [0]
+    select = data_source.select
+
+    def counting_select(*args, **kwargs):
+        queries[0] += 1
+        return select(*args, **kwargs)
+    data_source.select = counting_select
+
+    for _ in xrange(args.runs):
+        queries[0] = 0
+        start = time.time()
+        rows = data_source.load(params)
+        elapsed = time.time() - start
+        print('%.3fs, %d nodes, %d queries' % (
+            elapsed, count_nodes(rows), queries[0]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Benchmark the memory used by the rows loaded from a SQLite data source.
+
+A table of four columns (integer id, text, integer and real) is loaded
+on a single page, and the time it took and the growth of the process'
+resident memory per loaded row are printed. The resident memory is
+read from ``/proc``, so this only runs on Linux.
+
+Usage::
+
+    python benchmarks/load_rows.py [--rows N] [CHECKOUT]
+
+``CHECKOUT`` is the root of the datagrid_gtk3 checkout to benchmark,
+defaulting to the one containing this script. To compare against an
+older revision, check it out somewhere else first, e.g.::
+
+    git worktree add /tmp/before <revision>
+    python benchmarks/load_rows.py /tmp/before
+
+"""
+
+import argparse
+import atexit
+import gc
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+_ROOT = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                     os.path.pardir)
+
+
+def create_db(path, rows):
+    """Create the rows database.
+
+    :param str path: the path of the database file
+    :param int rows: the number of rows on the table
+    """
+    conn = sqlite3.connect(path)
+    conn.execute('CREATE TABLE rows (__id INTEGER PRIMARY KEY, '
+                 'name TEXT, n INTEGER, d REAL)')
+    conn.executemany(
+        'INSERT INTO rows VALUES (?, ?, ?, ?)',
+        ((i, 'name %d' % (i % 1000, ), i % 97, i * 0.5)
+         for i in xrange(rows)))
+    conn.commit()
+    conn.close()
+
+
+def get_rss():
+    """Get the resident memory of this process.
+
+    :return: the resident memory, in bytes
+    :rtype: int
+    """
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) * 1024
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('checkout', nargs='?', default=_ROOT)
+    parser.add_argument('--rows', type=int, default=1000000)
+    args = parser.parse_args()
+
+    sys.path.insert(0, os.path.realpath(args.checkout))
+    from datagrid_gtk3.db.sqlite import SQLiteDataSource
+
+    tmpdir = tempfile.mkdtemp()
+    atexit.register(shutil.rmtree, tmpdir)
+    db_path = os.path.join(tmpdir, 'rows.sqlite')
+    create_db(db_path, args.rows)
+
+    data_source = SQLiteDataSource(db_path, 'rows',
+                                   ensure_selected_column=False)
+    data_source.MAX_RECS = args.rows
+
+    gc.collect()
+    rss = get_rss()
+    start = time.time()
+    rows = data_source.load({})
+    elapsed = time.time() - start
+    gc.collect()
+    rss = get_rss() - rss
+
+    print('%d rows loaded in %.2fs, %.0f bytes/row RSS' % (
+        len(rows), elapsed, rss / float(len(rows))))
+
+
+if __name__ == '__main__':
+    main()
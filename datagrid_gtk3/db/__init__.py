@@ -5,9 +5,16 @@ backends (eg. SQLite)
 
 """
 
+import array
+
 from gi.repository import GObject
 
 
+class QueryCancelled(Exception):
+
+    """Raised when a query gets cancelled before finishing."""
+
+
 class Node(list):
 
     """A list that can hold data.
@@ -15,11 +22,17 @@ class Node(list):
     Just like a simple list, but one can set/get its data
     from :obj:`.data`.
 
+    The data is usually a tuple, as loaded from the data source, which
+    is more compact than a list. Use :meth:`.set_value` to change it.
+
     :param object data: the data that will be stored in this node
     :param int children_len: the number of the children that will
         be loaded lazely at some point
     """
 
+    # Nodes are created for each loaded row, so avoid a __dict__ for each
+    __slots__ = ('data', 'children_len', 'path')
+
     def __init__(self, data=None, children_len=0):
         super(Node, self).__init__()
 
@@ -41,6 +54,127 @@ class Node(list):
                       all(c.is_children_loaded(recursive=True) for c in self))
         return loaded
 
+    def set_value(self, index, value):
+        """Change one of the values on this node's data.
+
+        The data is copied to a list the first time it gets changed,
+        so the tuple it was loaded as (which may be shared, e.g. by
+        a cache) is never modified.
+
+        :param int index: the index of the value on the data
+        :param object value: the new value
+        """
+        if not isinstance(self.data, list):
+            self.data = list(self.data)
+        self.data[index] = value
+
+
+class ColumnarPage(object):
+
+    """A page of rows stored column-wise.
+
+    Integer and float columns are stored on typed arrays when all their
+    values fit on them, which takes a fraction of the memory needed to
+    hold each value as an object. The other columns are stored as
+    tuples, copied to a list the first time one of their values gets
+    changed.
+
+    :param rows: the data of the rows, as loaded on
+        :attr:`Node.data` by the data source
+    :type rows: iterable
+    """
+
+    def __init__(self, rows):
+        self._columns = [self._pack(values) for values in zip(*rows)]
+        self._len = len(self._columns[0]) if self._columns else 0
+
+    def __len__(self):
+        return self._len
+
+    ###
+    # Public
+    ###
+
+    def get_value(self, index, column):
+        """Get a value of one of the rows.
+
+        :param int index: the index of the row
+        :param int column: the index of the column
+        :return: the value
+        """
+        return self._columns[column][index]
+
+    def get_row(self, index):
+        """Get the values of one of the rows.
+
+        :param int index: the index of the row
+        :return: the values, like a :attr:`Node.data` loaded by
+            the data source
+        :rtype: tuple
+        """
+        return tuple(values[index] for values in self._columns)
+
+    def set_value(self, index, column, value):
+        """Change a value of one of the rows.
+
+        :param int index: the index of the row
+        :param int column: the index of the column
+        :param object value: the new value
+        """
+        values = self._columns[column]
+        if isinstance(values, tuple):
+            values = self._columns[column] = list(values)
+        try:
+            values[index] = value
+        except (TypeError, OverflowError):
+            # The value doesn't fit on the column's array anymore
+            values = self._columns[column] = list(values)
+            values[index] = value
+
+    def get_column(self, column):
+        """Get all the values of a column (e.g. to aggregate them).
+
+        :param int column: the index of the column
+        :return: the values, on an array when the column is numeric
+        :rtype: sequence
+        """
+        if not self._len:
+            return ()
+        return self._columns[column]
+
+    def find(self, column, value):
+        """Find the first row having the value on the column.
+
+        :param int column: the index of the column
+        :param object value: the value to look for
+        :return: the index of the row or `None` if not found
+        :rtype: int
+        """
+        try:
+            return self.get_column(column).index(value)
+        except ValueError:
+            return None
+
+    ###
+    # Private
+    ###
+
+    def _pack(self, values):
+        """Pack the values of a column as compactly as possible.
+
+        :param tuple values: the values of the column
+        :return: an array when all the values are integers or all of them
+            are floats, otherwise the values themselves
+        :rtype: sequence
+        """
+        try:
+            return array.array('l', values)
+        except (TypeError, OverflowError):
+            pass
+        if all(type(value) is float for value in values):
+            return array.array('d', values)
+        return values
+
 
 class DataSource(GObject.GObject):
     """Base class for data sources."""
@@ -50,6 +184,7 @@ class DataSource(GObject.GObject):
     PARENT_ID_COLUMN = None
     CHILDREN_LEN_COLUMN = None
     FLAT_COLUMN = None
+    MAX_RECS = 100
 
     def __init__(self):
         super(DataSource, self).__init__()
@@ -65,21 +200,57 @@ class DataSource(GObject.GObject):
     def get_visible_columns(self):
         return []
 
-    def load(self, params=None):
+    def load(self, params=None, cancel_event=None):
         return Node()
 
+    def load_counted(self, params=None, cancel_event=None):
+        """Load the records along with their total number.
+
+        Unlike :meth:`.load`, this should not change :attr:`.total_recs`,
+        so it can be called from another thread. Data sources only
+        overriding :meth:`.load` fallback to using it here.
+
+        :return: the rows and the total number of records
+        :rtype: tuple
+        """
+        rows = self.load(params, cancel_event=cancel_event)
+        return rows, self.total_recs
+
     def update_selected_columns(self, columns):
         pass
 
     def get_all_record_ids(self, params=None):
         return []
 
+    def count(self, params=None, time_budget=None, cancel_event=None):
+        return self.total_recs, True
+
+    def get_row_position(self, record_id, params=None):
+        """Get the position of the record when loaded with the params.
+
+        :return: the position of the record, or `None` if it is unknown
+        :rtype: int
+        """
+        return None
+
+    def get_ancestor_ids(self, record_id):
+        """Get the ids of the ancestors of the record on the tree.
+
+        :return: the ancestors ids, starting from the root, or `None`
+            if they are unknown
+        :rtype: list
+        """
+        return None
+
     def get_single_record(self, record_id, table=None):
         return tuple()
 
     def update(self, params, ids=None):
         pass
 
+    def update_by_filter(self, params, filter_params=None):
+        pass
+
 
 class EmptyDataSource(DataSource):
     """Data source that can be used when an empty data grid is required."""
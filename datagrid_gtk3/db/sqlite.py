@@ -1,13 +1,23 @@
 """SQLite database backend."""
 
+import copy
+import hashlib
 import logging
 import operator
+import os
 import sqlite3
 import struct
+import sys
+import threading
+import time
 import weakref
-from contextlib import closing
+from collections import OrderedDict
+from contextlib import closing, contextmanager
 
-from gi.repository import GObject
+from gi.repository import (
+    GLib,
+    GObject,
+)
 from sqlalchemy import (
     Column,
     INTEGER,
@@ -16,24 +26,31 @@ from sqlalchemy import (
     create_engine,
     inspect,
 )
+from sqlalchemy.dialects import sqlite as sqlite_dialect
 from sqlalchemy.exc import DatabaseError
 from sqlalchemy.sql import (
     cast,
     alias,
     and_,
+    bindparam,
     collate,
     column,
     desc,
     func,
+    literal_column,
+    null,
     or_,
     select,
     table as table_,
+    text,
+    visitors,
 )
 
-from datagrid_gtk3.db import DataSource, Node
+from datagrid_gtk3.db import DataSource, Node, QueryCancelled
+from datagrid_gtk3.utils.cacheutils import LRUCache
 
 logger = logging.getLogger(__name__)
-_compile = lambda q: q.compile(compile_kwargs={"literal_binds": True}).string
+_DIALECT = sqlite_dialect.dialect(paramstyle='qmark')
 
 _OPERATOR_MAPPER = {
     'is': operator.eq,
@@ -46,6 +63,342 @@ _OPERATOR_MAPPER = {
 }
 
 
+def _get_bind_values(sql):
+    """Get the values of the bind parameters used on the statement.
+
+    :param sql: the statement to get the values from
+    :type sql: :class:`sqlalchemy.sql.expression.ClauseElement`
+    :return: a dict mapping the bind parameters keys to their values
+    :rtype: dict
+    """
+    values = {}
+    visitors.traverse(
+        sql, {}, {'bindparam': lambda bp: values.__setitem__(
+            bp.key, bp.effective_value)})
+    return values
+
+
+def _freeze(obj):
+    """Get a hashable version of obj.
+
+    Dicts, lists and sets will be converted recursively to tuples
+    (sorted, in case of dicts and sets) so they can be used as keys
+    of other dicts.
+
+    :param object obj: the object to freeze
+    :return: the frozen object
+    """
+    if isinstance(obj, dict):
+        return tuple(sorted((k, _freeze(v)) for k, v in obj.iteritems()))
+    if isinstance(obj, (set, frozenset)):
+        return tuple(sorted(_freeze(v) for v in obj))
+    if isinstance(obj, (list, tuple)):
+        return tuple(_freeze(v) for v in obj)
+    return obj
+
+
+def _has_text_affinity(declared_type):
+    """Check if a column with the declared type has ``TEXT`` affinity.
+
+    This follows the rules used by SQLite to determine the affinity
+    of a column (https://www.sqlite.org/datatype3.html).
+
+    :param str declared_type: the column's declared type
+    :rtype: bool
+    """
+    declared_type = (declared_type or '').upper()
+    if 'INT' in declared_type:
+        return False
+    return any(name in declared_type for name in ['CHAR', 'CLOB', 'TEXT'])
+
+
+def _get_search_text(search):
+    """Get the search terms as unicode.
+
+    On Python 2, the text typed on a :class:`Gtk.Entry` is an UTF-8
+    encoded str. It needs to be decoded so non-ascii terms can be used
+    on unicode literals and so its length is the number of characters.
+
+    :param search: the search terms
+    :type search: str or unicode
+    :rtype: unicode
+    """
+    if isinstance(search, bytes):
+        return search.decode('utf-8', 'replace')
+    return search
+
+
+def _get_fts5_query(search):
+    """Get a FTS5 query matching records containing all the terms.
+
+    Each term is quoted, so characters with a special meaning in the
+    FTS5 query syntax will be matched literally, and is made a prefix
+    query, so records will be matched while the term is being typed.
+
+    :param unicode search: the search terms, separated by spaces
+    :return: the FTS5 query
+    :rtype: unicode
+    """
+    return u' '.join(
+        u'"%s"*' % (term.replace(u'"', u'""'), ) for term in search.split())
+
+
+def _copy_rows(rows):
+    """Copy the rows loaded by :meth:`SQLiteDataSource.load`.
+
+    The rows are copied recursively, so the copy can be modified (e.g.
+    by a model) without affecting them. Their data is only copied when
+    it was changed into a list by :meth:`datagrid_gtk3.db.Node.set_value`.
+
+    :param rows: the rows to copy
+    :type rows: :class:`datagrid_gtk3.db.Node`
+    :return: the copied rows
+    :rtype: :class:`datagrid_gtk3.db.Node`
+    """
+    data = rows.data
+    copied = Node(data=tuple(data) if isinstance(data, list) else data,
+                  children_len=rows.children_len)
+    copied.extend(_copy_rows(row) for row in rows)
+    return copied
+
+
+def _get_result_size(result):
+    """Estimate the memory used by a cached result.
+
+    :param object result: the rows (and total) or the total of records
+        cached by :class:`SQLiteDataSource`
+    :return: the approximate size in bytes
+    :rtype: int
+    """
+    if isinstance(result, tuple):
+        return sum(_get_result_size(item) for item in result)
+    if not isinstance(result, Node):
+        return sys.getsizeof(result)
+
+    size = sys.getsizeof(result)
+    if result.data is not None:
+        size += sys.getsizeof(result.data) + sum(
+            sys.getsizeof(value) for value in result.data)
+    return size + sum(_get_result_size(row) for row in result)
+
+
+class _PooledConnection(sqlite3.Connection):
+
+    """A sqlite connection that remembers its per-connection setup.
+
+    Temporary views and tables only exist on the connection that
+    created them, so we keep track of the ones already created here
+    to avoid creating them again each time it is reused.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(_PooledConnection, self).__init__(*args, **kwargs)
+        self.temp_views = set()
+        # Materialized ids sets, in least recently used order
+        self.id_sets = OrderedDict()
+        self.id_sets_created = 0
+        # Materialized search results, by table name
+        self.search_sets = {}
+        # The last PRAGMA data_version seen on this connection
+        self.data_version = None
+
+
+class SQLiteConnectionPool(object):
+
+    """A pool of long-lived connections to a SQLite database file.
+
+    Opening a connection means paying for the connection setup and
+    for warming up SQLite's page cache again. The pool keeps the
+    connections alive between calls so they can be reused by every
+    :class:`SQLiteDataSource` that points to the same database file.
+
+    Use :meth:`get_pool` instead of instantiating this directly so
+    the pool will be shared.
+
+    :param str db_file: path to SQLite database file
+    :param dict pragmas: ``PRAGMA`` values to set on each new
+        connection, overriding the ones in :attr:`.DEFAULT_PRAGMAS`
+    """
+
+    # cache_size is in KiB when negative (i.e. 64MB here)
+    DEFAULT_PRAGMAS = {
+        'cache_size': -65536,
+        'mmap_size': 268435456,
+        'temp_store': 'MEMORY',
+    }
+    MAX_IDLE_CONNECTIONS = 4
+    CACHED_STATEMENTS = 256
+
+    _pools = weakref.WeakValueDictionary()
+    _pools_lock = threading.Lock()
+
+    def __init__(self, db_file, pragmas=None):
+        self.db_file = db_file
+        self.pragmas = dict(self.DEFAULT_PRAGMAS)
+        self.pragmas.update(pragmas or {})
+        self.stats = {
+            'connections_created': 0,
+            'connections_reused': 0,
+            'connections_closed': 0,
+        }
+
+        self._lock = threading.Lock()
+        self._idle = []
+        self._columns_versions = {}
+        self._updates = 0
+        self._data_changes = 0
+
+    ###
+    # Public
+    ###
+
+    @classmethod
+    def get_pool(cls, db_file, pragmas=None):
+        """Get the pool shared by everyone using the given database file.
+
+        :param str db_file: path to SQLite database file
+        :param dict pragmas: ``PRAGMA`` values to set on new connections.
+            Note that they will not affect already opened connections
+        :return: the connection pool
+        :rtype: :class:`SQLiteConnectionPool`
+        """
+        # '' and ':memory:' are private databases. Don't try to resolve them
+        key = db_file
+        if db_file and db_file != ':memory:':
+            key = os.path.realpath(db_file)
+
+        with cls._pools_lock:
+            pool = cls._pools.get(key)
+            if pool is None:
+                pool = cls(db_file, pragmas=pragmas)
+                cls._pools[key] = pool
+            elif pragmas:
+                pool.pragmas.update(pragmas)
+
+        return pool
+
+    @contextmanager
+    def connection(self):
+        """Borrow a connection from the pool.
+
+        The connection will be returned to the pool when leaving
+        the context. Any uncommitted changes will be rolled back
+        if an exception happens inside it.
+        """
+        conn = self._acquire()
+        try:
+            yield conn
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            self._release(conn)
+
+    def invalidate_columns(self, columns):
+        """Mark the given columns as modified.
+
+        Anything derived from those columns (e.g. materialized
+        ids sets) will know that it needs to be generated again
+        by comparing :meth:`.get_columns_version` results.
+
+        :param columns: the names of the modified columns
+        :type columns: iterable
+        """
+        with self._lock:
+            self._updates += 1
+            for col in columns:
+                self._columns_versions[col] = (
+                    self._columns_versions.get(col, 0) + 1)
+
+    def get_columns_version(self, columns=None):
+        """Get the version of the given columns.
+
+        :param columns: the names of the columns, or `None` to
+            consider all of them
+        :type columns: iterable
+        :return: an object that will compare different after any of
+            the columns gets modified by :meth:`.invalidate_columns`
+        :rtype: tuple
+        """
+        with self._lock:
+            if columns is None:
+                return (None, self._updates)
+            return tuple(sorted(
+                (col, self._columns_versions.get(col, 0))
+                for col in columns))
+
+    def check_data_version(self, conn):
+        """Check if the database was modified by another connection.
+
+        This compares the ``PRAGMA data_version`` of the connection
+        with the one seen the last time it was checked, which changes
+        when any other connection (including ones from other processes)
+        commits a change to the database file.
+
+        :param conn: an open connection from this pool
+        :return: an object that will compare different after a
+            change was detected on any connection of this pool
+        :rtype: int
+        """
+        with closing(conn.cursor()) as cursor:
+            cursor.execute('PRAGMA data_version')
+            data_version = cursor.fetchone()[0]
+
+        with self._lock:
+            # The changes done before a connection was opened can't be
+            # detected by it, so consider it as a change to be safe
+            if data_version != conn.data_version:
+                conn.data_version = data_version
+                self._data_changes += 1
+            return self._data_changes
+
+    def close(self):
+        """Close all the idle connections on this pool."""
+        with self._lock:
+            idle, self._idle = self._idle, []
+
+        for conn in idle:
+            conn.close()
+            self.stats['connections_closed'] += 1
+
+    ###
+    # Private
+    ###
+
+    def _acquire(self):
+        """Get an idle connection or open a new one."""
+        with self._lock:
+            if self._idle:
+                self.stats['connections_reused'] += 1
+                return self._idle.pop()
+
+        conn = sqlite3.connect(
+            self.db_file, factory=_PooledConnection,
+            check_same_thread=False,
+            cached_statements=self.CACHED_STATEMENTS)
+        conn.create_function('rank', 1, rank)
+
+        with closing(conn.cursor()) as cursor:
+            for pragma, value in sorted(self.pragmas.iteritems()):
+                cursor.execute('PRAGMA %s = %s' % (pragma, value))
+
+        self.stats['connections_created'] += 1
+        return conn
+
+    def _release(self, conn):
+        """Give the connection back to the pool."""
+        # Callers are free to change the row factory while using it
+        conn.row_factory = None
+
+        with self._lock:
+            if len(self._idle) < self.MAX_IDLE_CONNECTIONS:
+                self._idle.append(conn)
+                return
+
+        conn.close()
+        self.stats['connections_closed'] += 1
+
+
 class SQLiteDataSource(DataSource):
 
     """SQLite data source especially for use with a `Gtk.TreeModel`.
@@ -75,15 +428,61 @@ class SQLiteDataSource(DataSource):
     :param str query: Full custom query to be used instead of the table name.
     :param bool persist_columns_visibility: Weather we should persist
         the columns visibility in the database.
+    :param dict pragmas: ``PRAGMA`` values to use on the connections
+        to the database. See :attr:`SQLiteConnectionPool.DEFAULT_PRAGMAS`
+    :param bool search_index: Whether to build the full-text search
+        table on the background if it doesn't exist.
+        See :meth:`.build_search_index`
+    :param bool substring_index: Whether to build the substring search
+        table on the background if it doesn't exist.
+        See :meth:`.build_substring_index`
     """
 
     __gsignals__ = {
         'rows-changed': (GObject.SignalFlags.RUN_LAST, None, (object, object)),
+        'search-index-progress': (GObject.SignalFlags.RUN_LAST, None,
+                                  (float, )),
+        'search-index-built': (GObject.SignalFlags.RUN_LAST, None, ()),
     }
 
     _DBS = weakref.WeakSet()
+    # Only one search table is built at a time
+    _SEARCH_INDEX_LOCK = threading.Lock()
 
     MAX_RECS = 100
+    # Use keyset pagination (i.e. seek past the last loaded row instead of
+    # using OFFSET) when the sort allows it. See :meth:`.load`
+    SEEK_PAGINATION = True
+    MAX_SEEK_STATES = 8
+    STATEMENT_CACHE_SIZE = 64
+    # Number of SQLite virtual machine instructions between each check
+    # of the time budget when counting records
+    COUNT_PROGRESS_INTERVAL = 10000
+    # Number of SQLite virtual machine instructions between each check
+    # for the cancellation of a query
+    CANCEL_CHECK_INTERVAL = 1000
+    # Materialize the ordered ids of the records matching the params
+    # in a temporary table when they can't use keyset pagination.
+    # See :meth:`.load`
+    MATERIALIZE_IDS = False
+    MAX_MATERIALIZED_IDS = 4
+    # Materialize the rowids of the records matching a search, so the
+    # next search can be done over them when it is a refinement of the
+    # previous one. See :meth:`._get_search_set`
+    REFINE_SEARCHES = False
+    MAX_SEARCH_SET_RECS = 1000000
+    # Protect against cycles when walking up a tree
+    MAX_TREE_DEPTH = 1000
+    # Create an index for PARENT_ID_COLUMN if it doesn't have one
+    CREATE_PARENT_INDEX = False
+    # Number of records indexed by each transaction when building
+    # the full-text search table
+    SEARCH_INDEX_BATCH_SIZE = 10000
+    # Memory budget (in bytes) to cache the first RESULT_CACHE_PAGES
+    # pages and the number of records for the last used params.
+    # See :meth:`.load`
+    RESULT_CACHE_SIZE = 0
+    RESULT_CACHE_PAGES = 2
     SQLITE_PY_TYPES = {
         'INT': long,
         'INTEGER': long,
@@ -104,13 +503,24 @@ class SQLiteDataSource(DataSource):
     def __init__(self, db_file, table=None, update_table=None, config=None,
                  ensure_selected_column=True,
                  display_all=False, query=None,
-                 persist_columns_visibility=True):
+                 persist_columns_visibility=True, pragmas=None,
+                 search_index=False, substring_index=False):
         """Process database column info."""
         super(SQLiteDataSource, self).__init__()
 
         assert table or query  # either table or query must be given
         self.db_file = db_file
-        self.table = table_(table if table else "__CustomQueryTempView")
+        self._pool = SQLiteConnectionPool.get_pool(db_file, pragmas=pragmas)
+        if table is None:
+            # The temporary view lives on a connection that is shared with
+            # other data sources, so it needs a name unique to the query
+            if isinstance(query, unicode):
+                query_digest = hashlib.sha1(query.encode('utf-8'))
+            else:
+                query_digest = hashlib.sha1(query)
+            table = '__CustomQueryTempView_%s' % (
+                query_digest.hexdigest()[:12], )
+        self.table = table_(table)
         self.query = query
         if query:
             logger.debug("Custom SQL: %s", query)
@@ -123,6 +533,18 @@ class SQLiteDataSource(DataSource):
         else:
             self.update_table = table
         self.config = config
+        self._id_is_rowid = False
+        self._parent_indexed = None
+        self._text_columns = []
+        self._like_columns = []
+        self._search_fts5 = False
+        self._seek_states = OrderedDict()
+        self._seek_lock = threading.Lock()
+        self._statements = LRUCache(self.STATEMENT_CACHE_SIZE)
+        self._results = LRUCache(
+            self.RESULT_CACHE_SIZE, get_size=_get_result_size)
+        self._results_version = None
+        self._results_lock = threading.Lock()
         self.columns = self.get_columns()
         self.columns_idx = {
             col['name']: i for i, col in enumerate(self.columns)}
@@ -134,17 +556,28 @@ class SQLiteDataSource(DataSource):
         for col in ['tablename', 'columns']:
             self.visible_columns_table.append_column(column(col))
 
-        with closing(sqlite3.connect(self.db_file)) as conn:
+        with self._connect() as conn:
             with closing(conn.cursor()) as cursor:
-                # FIXME: Maybe we should use a parameter to generate
-                # search_table if it doesn't exist?
                 search_table = self.table.name + '_search'
                 cursor.execute('PRAGMA table_info(%s)' % (search_table, ))
                 if cursor.fetchone():
                     self.search_table = search_table
+                    cursor.execute(
+                        'SELECT sql FROM sqlite_master WHERE name = ?',
+                        (search_table, ))
+                    row = cursor.fetchone()
+                    self._search_fts5 = bool(
+                        row and row[0] and 'FTS5' in row[0].upper())
                 else:
                     self.search_table = None
 
+                substring_table = self.table.name + '_substr'
+                cursor.execute('PRAGMA table_info(%s)' % (substring_table, ))
+                if cursor.fetchone():
+                    self.substring_table = substring_table
+                else:
+                    self.substring_table = None
+
                 # Migrate old `_selected_columns` to `__visible_columns`
                 cursor.execute('PRAGMA table_info(_selected_columns)')
                 columns = {column_info[1] for column_info in cursor.fetchall()}
@@ -156,14 +589,46 @@ class SQLiteDataSource(DataSource):
 
         self.__class__._DBS.add(self)
 
+        if search_index:
+            self.build_search_index()
+        if substring_index:
+            self.build_substring_index()
+
     ###
     # Public
     ###
 
-    def load(self, params=None):
+    def load(self, params=None, cancel_event=None):
         """Execute SQL ``SELECT`` and populate ``rows`` attribute.
 
-        Loads a maximum of ``MAX_RECS`` records at a time.
+        Loads a maximum of ``MAX_RECS`` records at a time. Pages after
+        the first one can be loaded from other threads, since each
+        thread borrows its own connection from the pool.
+
+        When the records are sorted by the rowid (or not sorted at all),
+        pages are loaded using keyset pagination: when loading the page
+        just after the last one loaded for the same params, we seek
+        past the last record id it returned instead of making SQLite
+        walk and discard all the records before the page (which is what
+        happens with ``OFFSET``). That way the cost of loading a page
+        does not depend on how deep it is.
+
+        When that is not possible and :attr:`.MATERIALIZE_IDS` is set,
+        the ordered ids of all the records matching the params are
+        materialized once in a temporary table, indexed by their
+        position. Any page is then loaded by joining a range of
+        positions on it, without filtering and sorting the records
+        again. Up to :attr:`.MAX_MATERIALIZED_IDS` of them are kept
+        for each connection and they are generated again when
+        :meth:`.update` modifies the columns they depend on.
+
+        When :attr:`.RESULT_CACHE_SIZE` is set, the first
+        :attr:`.RESULT_CACHE_PAGES` pages and the number of records
+        are cached for the params they were loaded with (e.g. so
+        going back to a previous filter or sort does not query the
+        database again). The cache is cleared when the database
+        gets modified, be it by :meth:`.update`, by another data
+        source or by another process.
 
         ``params`` dict example::
 
@@ -182,72 +647,255 @@ class SQLiteDataSource(DataSource):
                 }
             }
 
+        When searching using a FTS5 search table (see
+        :meth:`.build_search_index`) and not sorting by any column, the
+        records are sorted by their ``bm25()`` rank, best matches first.
+
+        ``page_count`` can be used to load that many pages at once,
+        starting at ``page``.
+
+        ``columns`` can be used to load only the values of the columns
+        with the given names (e.g. the ones being displayed), plus
+        the ones with special meanings (like :attr:`.ID_COLUMN`). The
+        rows will still have a value for each column, but the ones
+        not loaded will be `None`. Use :meth:`.get_single_record` to
+        get all the values of a record.
+
+        ``truncate`` can be used to load at most that many characters
+        of the text values (the ones in text columns that are displayed
+        as strings or html), so huge values only being displayed on a
+        grid will not have to be read whole. A value having exactly
+        that many characters may have been truncated, so this should
+        be one more than the length that will actually be displayed.
+
+        When ``defer_count`` is present and true in the params, the
+        total number of records will not be counted when loading the
+        first page (unless it can be deduced from the page itself) and
+        ``total_recs`` will be set to `None`. Use :meth:`.count` to
+        count them later (e.g. on another thread).
+
         :param dict params: dict of various parameters from which to construct
             additional SQL clauses eg. ``WHERE``, ``ORDER BY``, etc.
+        :param cancel_event: an event that, when set (e.g. by another
+            thread), will interrupt the queries being executed
+        :type cancel_event: :class:`threading.Event`
+        :raise QueryCancelled: if `cancel_event` got set before
+            the records were loaded
+        """
+        params = params or {}
+        rows, total_recs = self.load_counted(params, cancel_event=cancel_event)
+        if params.get('page', 0) == 0:
+            self.total_recs = total_recs
+        return rows
+
+    def load_counted(self, params=None, cancel_event=None):
+        """Load the records just like :meth:`.load`, along with their count.
+
+        The total number of records is returned instead of being set on
+        :attr:`.total_recs`, which is not changed. That makes this safe
+        to call from another thread, even to load the first page, while
+        the records previously loaded are still being displayed.
+
+        See :meth:`.load` for the parameters documentation.
+
+        :return: the rows and the total number of records, which is
+            `None` when it was not counted (e.g. because of
+            ``defer_count``) or when not loading the first page
+        :rtype: tuple
+        :raise QueryCancelled: if `cancel_event` got set before
+            the records were loaded
         """
         rows = Node()
+        total_recs = None
         # FIXME: Maybe we should use kwargs instead of params?
         params = params or {}
+        result_key = self._get_result_key(params)
 
         # WHERE
-        where = params.get('where', None)
-        if where is not None:
-            where = self._get_where_clause(where)
+        where, where_shape, flat = self._get_filter(params)
 
         # ORDER BY
-        order_by = params.get('order_by', None)
-        # Do a numeric ordering first, as suggested here
-        # (http://stackoverflow.com/a/4204641), and then a case-insensitive one
-        order_by = (order_by and
-                    [self.table.columns[order_by] + 0,
-                     collate(self.table.columns[order_by], 'NOCASE')])
-        if order_by is not None and params.get('desc', False):
-            order_by = [desc(col) for col in order_by]
+        seek_key = self._get_seek_key(params)
+        order_by = self._get_order_by(params)
 
         # OFFSET
         page = params.get('page', 0)
+        page_count = params.get('page_count', 1)
         offset = page * self.MAX_RECS
+        limit = page_count * self.MAX_RECS
         # A little optimization to avoid doing more queries when we
         # already loaded everything
-        if page > 0 and offset >= self.total_recs:
-            return rows
-
-        # Flat
-        flat = params.get('flat', False)
-        if flat:
-            flat_where = operator.ne(
-                self.table.columns[self.FLAT_COLUMN], None)
-            where = and_(where, flat_where) if where is not None else flat_where  # noqa
-
-        with closing(sqlite3.connect(self.db_file)) as conn:
-            conn.row_factory = lambda cursor, row: list(row)
-            # ^^ make result lists mutable so we can change values in
-            # the GTK TreeModel that uses this datasource.
-            conn.create_function('rank', 1, rank)
-            # TODO: ^^ only if search term in params
-            with closing(conn.cursor()) as cursor:
-                self._ensure_temp_view(cursor)
-
-            if page == 0:
+        if (page > 0 and self.total_recs is not None and
+                offset >= self.total_recs):
+            return rows, None
+        defer_count = params.get('defer_count', False)
+        materialize = (seek_key is None and self.MATERIALIZE_IDS and
+                       not self.query and
+                       not (self.PARENT_ID_COLUMN and not flat))
+
+        seek_where = None
+        with self._seek_lock:
+            seek_state = (self._seek_states.get(seek_key)
+                          if seek_key is not None else None)
+        if seek_state is not None and seek_state[0] == page - 1:
+            id_column = self.table.columns[self.ID_COLUMN]
+            seek_id = bindparam('seek_id', seek_state[1])
+            if params.get('desc', False):
+                seek_where = id_column < seek_id
+            else:
+                seek_where = id_column > seek_id
+            offset = None
+
+        table = self.table
+        ranked = self._is_ranked(params)
+        if ranked:
+            # Join the search table to be able to sort by its rank
+            table = self._get_search_join()
+
+        with self._connect() as conn, self._cancellable(conn, cancel_event):
+            cached_total = None
+            if result_key is not None:
+                results_version = self._check_results(conn)
+                cached = self._get_cached_rows(params, result_key, seek_key)
+                if cached is not None:
+                    return cached
+                if page == 0:
+                    cached_total = self._results.get(
+                        self._get_count_key(params))
+
+            search_set = self._get_search_set(conn, params, create=page == 0)
+            if search_set is not None:
+                where, where_shape, flat = self._get_filter(
+                    params, search_set=search_set[0])
+
+            page_where = where
+            if ranked:
+                page_where = self._get_filter(params, fts_join=True)[0]
+            if seek_where is not None:
+                page_where = (and_(page_where, seek_where)
+                              if page_where is not None else seek_where)
+
+            if page == 0 and not defer_count and not materialize:
                 # set the total record count the only the first time the
                 # record set is requested
-                res = self.select(
-                    conn, self.table, [func.count(1)], where=where)
-                self.total_recs = int(list(res)[0][0])
+                if search_set is not None and not flat:
+                    total_recs = search_set[1]
+                elif cached_total is not None:
+                    total_recs = cached_total
+                else:
+                    total_recs = self._count(conn, where, where_shape, flat)
 
+            columns, columns_key = self._get_load_columns(params)
+            cache_key = (where_shape, params.get('order_by', None),
+                         params.get('desc', False), flat, columns_key)
             if self.PARENT_ID_COLUMN and not flat:
                 rows.extend(
                     self._load_tree_rows(
-                        conn, where, order_by, params.get('parent_id', None)))
+                        conn, where, order_by, params.get('parent_id', None),
+                        columns=columns, cache_key=cache_key))
+            elif materialize:
+                id_set, id_set_len = self._get_id_set(
+                    conn, params, page_where, where_shape, order_by,
+                    table=table)
+                if page == 0:
+                    # We get the count for free when materializing
+                    total_recs = id_set_len
+                query = self._select_id_set_page(
+                    conn, id_set, page, page_count,
+                    columns=columns, columns_key=columns_key)
+                for row in query:
+                    rows.append(Node(data=row))
             else:
                 query = self.select(
-                    conn, self.table, self.table.columns, where=where,
-                    limit=self.MAX_RECS, offset=offset, order_by=order_by)
+                    conn, table, columns, where=page_where,
+                    limit=limit, offset=offset, order_by=order_by,
+                    cache_key=('page', cache_key, offset is None))
                 for row in query:
                     rows.append(Node(data=row))
 
+                if seek_key is not None:
+                    self._set_seek_state(seek_key, page, page_count, rows)
+
+        if page == 0 and defer_count and not materialize:
+            # If the first page is not complete, it has all the records.
+            # Note that when loading a tree, the rows are just the roots
+            is_tree = self.PARENT_ID_COLUMN and not flat
+            if search_set is not None and not flat:
+                total_recs = search_set[1]
+            elif not is_tree and len(rows) < limit:
+                total_recs = len(rows)
+
         rows.children_len = len(rows)
-        return rows
+        if result_key is not None:
+            self._cache_result(
+                results_version, result_key, (_copy_rows(rows), total_recs))
+            if total_recs is not None:
+                self._cache_result(
+                    results_version, self._get_count_key(params), total_recs)
+        return rows, total_recs
+
+    def count(self, params=None, time_budget=None, cancel_event=None):
+        """Count the records matching the params.
+
+        This is the count that :meth:`.load` does when loading the
+        first page, and can be used to do it separately when
+        ``defer_count`` is passed to it. It is safe to call this
+        from another thread.
+
+        If `time_budget` is given and the count takes longer than it,
+        the query will be interrupted and, when there's no filter, the
+        number of records will be estimated from the statistics
+        gathered by ``ANALYZE`` (if any).
+
+        :param dict params: the same params passed to :meth:`.load`.
+            Only the ones related to filtering will be used
+        :param float time_budget: the maximum time in seconds to spend
+            counting the records or `None` to take as long as needed
+        :param cancel_event: an event that, when set (e.g. by another
+            thread), will interrupt the count
+        :type cancel_event: :class:`threading.Event`
+        :return: the number of records (or `None` if it could not
+            be counted) and if that number is exact or an estimation
+        :rtype: tuple
+        :raise QueryCancelled: if `cancel_event` got set before
+            the records were counted
+        """
+        params = params or {}
+        where, where_shape, flat = self._get_filter(params)
+        count_key = self._get_count_key(params)
+        is_cancelled = cancel_event.is_set if cancel_event else lambda: False
+        with self._connect() as conn, self._cancellable(conn, cancel_event):
+            if count_key is not None:
+                results_version = self._check_results(conn)
+                total_recs = self._results.get(count_key)
+                if total_recs is not None:
+                    return total_recs, True
+
+            if time_budget is not None:
+                deadline = time.time() + time_budget
+                conn.set_progress_handler(
+                    lambda: time.time() > deadline or is_cancelled(),
+                    self.COUNT_PROGRESS_INTERVAL)
+
+            try:
+                total_recs = self._count(conn, where, where_shape, flat)
+            except sqlite3.OperationalError as e:
+                if (time_budget is None or 'interrupted' not in str(e) or
+                        is_cancelled()):
+                    raise
+            else:
+                if count_key is not None:
+                    self._cache_result(results_version, count_key, total_recs)
+                return total_recs, True
+            finally:
+                if time_budget is not None:
+                    conn.set_progress_handler(None, 0)
+
+            logger.debug('Counting records took more than %ss', time_budget)
+            estimate = None
+            if where is None:
+                estimate = self._estimate_count(conn)
+            return estimate, False
 
     def update(self, params, ids=None):
         """Update the recordset with a SQL ``UPDATE`` statement.
@@ -258,42 +906,86 @@ class SQLiteDataSource(DataSource):
         If `ids` is None, will update the entire table.
 
         :param dict params: keys corresponding to DB columns + values to update
-        :param list ids: database primary keys to use for updating
+        :param ids: database primary keys to use for updating
+        :type ids: iterable
         """
-        # FIXME: Use sqlalchemy to construct the queries here
-        with closing(sqlite3.connect(self.db_file)) as conn:
+        if ids is not None:
+            # The ids are used more than once, so make sure a generator
+            # (or a set, which can't be indexed) works here too
+            ids = list(ids)
+        update_sql_str, update_values = self._get_update_set(params)
+        self._pool.invalidate_columns(params.keys())
+        with self._connect() as conn:
             with closing(conn.cursor()) as cursor:
-                update_sql_list = []
-                for key, value in params.iteritems():
-                    if isinstance(value, bool):
-                        value = int(value)
-                    elif isinstance(value, basestring):
-                        value = "'%s'" % value
-                    update_sql_list.append('%s=%s' % (key, value))
-                update_sql_str = ', '.join(update_sql_list)
-                if ids is not None:
-                    for id_ in ids:
-                        sql = 'UPDATE %s SET %s WHERE %s = ?' % (
-                            self.update_table, update_sql_str, self.ID_COLUMN)
-                        cursor.execute(sql, (str(id_),))
-                else:
+                if ids is None:
                     sql = 'UPDATE %s SET %s' % (
                         self.update_table, update_sql_str)
-                    cursor.execute(sql)
+                    cursor.execute(sql, update_values)
+                elif len(ids) == 1:
+                    sql = 'UPDATE %s SET %s WHERE %s = ?' % (
+                        self.update_table, update_sql_str, self.ID_COLUMN)
+                    cursor.execute(sql, update_values + [ids[0]])
+                else:
+                    # Join the ids in a single statement instead of
+                    # doing one update for each of them
+                    cursor.execute(
+                        'CREATE TEMP TABLE IF NOT EXISTS '
+                        '__update_ids (id PRIMARY KEY)')
+                    cursor.execute('DELETE FROM temp.__update_ids')
+                    cursor.executemany(
+                        'INSERT OR IGNORE INTO temp.__update_ids VALUES (?)',
+                        ((id_, ) for id_ in ids))
+                    sql = ('UPDATE %s SET %s WHERE %s IN '
+                           '(SELECT id FROM temp.__update_ids)') % (
+                               self.update_table, update_sql_str,
+                               self.ID_COLUMN)
+                    cursor.execute(sql, update_values)
+                    cursor.execute('DELETE FROM temp.__update_ids')
                 conn.commit()
 
-        # Emit rows-changed for any other databases connected to the same
-        # database and table. This is to allow any view using them
-        # to update themselves with the changes done here.
-        # The current object will not emit the event as it is the one who
-        # made the update and thus, is assumed to know about the changes
-        for db in self.__class__._DBS:
-            if db is self:
-                continue
-            if (db.db_file, db.table.name) != (self.db_file, self.table.name):
-                continue
+        self._emit_rows_changed(params, lambda: ids)
+
+    def update_by_filter(self, params, filter_params=None):
+        """Update all the records matching the given filter.
+
+        The update is done by a single SQL ``UPDATE`` statement, using
+        the ``WHERE`` clause constructed from `filter_params`. That
+        means that the records ids are never loaded here, making this
+        a lot faster than calling :meth:`.update` with the result
+        of :meth:`.get_all_record_ids`. For the same reason, the other
+        data sources will be told that all the records changed.
+
+        :param dict params: keys corresponding to DB columns + values to update
+        :param dict filter_params: params from which to construct
+            SQL ``WHERE`` clause, just like the ones passed to
+            :meth:`.get_all_record_ids`. If `None` or if it doesn't
+            have a ``where`` key, the entire table will be updated.
+        """
+        where = filter_params and filter_params.get('where', None)
+        if not where:
+            self.update(params)
+            return
 
-            db.emit('rows-changed', params, ids)
+        update_sql_str, update_values = self._get_update_set(params)
+        where_shape = self._get_where_shape(where)
+        ids_sql, ids_values = self._get_select_sql(
+            self.table, [self.table.columns[self.ID_COLUMN]],
+            where=self._get_where_clause(where),
+            cache_key=('record_ids', where_shape))
+
+        self._pool.invalidate_columns(params.keys())
+        with self._connect() as conn:
+            with closing(conn.cursor()) as cursor:
+                sql = 'UPDATE %s SET %s WHERE %s IN (%s)' % (
+                    self.update_table, update_sql_str, self.ID_COLUMN,
+                    ids_sql)
+                logger.debug('SQL:\n%s', sql)
+                cursor.execute(sql, update_values + ids_values)
+                conn.commit()
+
+        # The filter may depend on the updated columns, so the records
+        # matching it now may not be the ones that got updated
+        self._emit_rows_changed(params, lambda: None)
 
     def get_all_record_ids(self, params=None):
         """Get all the record primary keys for given params.
@@ -302,15 +994,16 @@ class SQLiteDataSource(DataSource):
         :return: primary key ids
         :rtype: list
         """
-        with closing(sqlite3.connect(self.db_file)) as conn:
-            conn.create_function('rank', 1, rank)
-            # TODO: ^^ create this function only if search term in params
+        with self._connect() as conn:
             where = params and params.get('where', None)
+            where_shape = None
             if where is not None:
+                where_shape = self._get_where_shape(where)
                 where = self._get_where_clause(where)
             res = self.select(
                 conn, self.table,
-                [self.table.columns[self.ID_COLUMN]], where=where)
+                [self.table.columns[self.ID_COLUMN]], where=where,
+                cache_key=('record_ids', where_shape))
 
             return [row[0] for row in res]
 
@@ -321,15 +1014,188 @@ class SQLiteDataSource(DataSource):
         :return: row of data
         :rtype: tuple
         """
-        with closing(sqlite3.connect(self.db_file)) as conn:
+        with self._connect() as conn:
             conn.row_factory = sqlite3.Row  # Access columns by name
+            where = (self.table.columns[self.ID_COLUMN] ==
+                     bindparam('record_id', record_id))
             res = list(self.select(
-                conn, self.table, self.table.columns,
-                where=self.table.columns[self.ID_COLUMN] == record_id))
+                conn, self.table, self.table.columns, where=where,
+                cache_key=('single_record', )))
 
             # TODO log error if more than one
             return res[0]
 
+    def get_row_position(self, record_id, params=None):
+        """Get the position of the record when loaded with the params.
+
+        That is the index the record would have on the rows if all the
+        pages were loaded by :meth:`.load` using the same params. This
+        is done by counting the records that would come before it,
+        without loading any of them.
+
+        :param record_id: the id of the record
+        :param dict params: the params used to load the records
+        :return: the position of the record or `None` if it doesn't
+            match the params or if it is unknown, i.e. when loading a
+            tree or when the records are not sorted, or if it can't be
+            known without loading them (i.e. when sorting by the search
+            rank without :attr:`.MATERIALIZE_IDS`)
+        :rtype: int
+        """
+        params = params or {}
+        if self.PARENT_ID_COLUMN and not params.get('flat', False):
+            # Records on a tree don't have positions
+            return None
+        sort_key = self._get_sort_key(params)
+        if not sort_key or self.id_column_idx is None:
+            return None
+
+        where, where_shape, flat = self._get_filter(params)
+        is_desc = params.get('desc', False)
+        order_by = params.get('order_by', None)
+        id_where = (self.table.columns[self.ID_COLUMN] ==
+                    bindparam('record_id', record_id))
+        materialize = (self._get_seek_key(params) is None and
+                       self.MATERIALIZE_IDS and not self.query)
+        ranked = self._is_ranked(params)
+        if ranked and not materialize:
+            # The search rank can't be compared
+            return None
+
+        with self._connect() as conn:
+            if materialize:
+                table = self.table
+                if ranked:
+                    table = self._get_search_join()
+                    where = self._get_filter(params, fts_join=True)[0]
+                id_set, _ = self._get_id_set(
+                    conn, params, where, where_shape,
+                    self._get_order_by(params), table=table)
+                sql = ('SELECT pos - 1 FROM temp.%s WHERE rid = '
+                       '(SELECT _rowid_ FROM %s WHERE %s = ?)') % (
+                           id_set, self.table.name, self.ID_COLUMN)
+                with closing(conn.cursor()) as cursor:
+                    cursor.execute(sql, (record_id, ))
+                    row = cursor.fetchone()
+                return row and row[0]
+
+            res = list(self.select(
+                conn, self.table, sort_key,
+                where=and_(where, id_where) if where is not None else id_where,
+                cache_key=('row_sort_key', where_shape, order_by, flat)))
+            if not res:
+                return None
+
+            values = res[0]
+            before = self._get_before_clause(sort_key, values, is_desc)
+            if before is None:
+                return 0
+
+            res = self.select(
+                conn, self.table, [func.count(literal_column('1'))],
+                where=and_(where, before) if where is not None else before,
+                cache_key=('row_position', where_shape, order_by, is_desc,
+                           flat, tuple(value is None for value in values)))
+            return int(list(res)[0][0])
+
+    def get_ancestor_ids(self, record_id):
+        """Get the ids of the ancestors of the record on the tree.
+
+        All of them are resolved by a single recursive query.
+
+        :param record_id: the id of the record
+        :return: the ancestors ids, starting from the root and ending
+            on the record's parent, or `None` if the record doesn't exist
+        :rtype: list
+        """
+        if not self.PARENT_ID_COLUMN:
+            return []
+
+        sql = """
+            WITH RECURSIVE __ancestors (id, depth) AS (
+                SELECT {parent}, 1 FROM {table} WHERE {id} = ?
+                UNION ALL
+                SELECT t.{parent}, a.depth + 1
+                FROM {table} AS t JOIN __ancestors AS a ON t.{id} = a.id
+                WHERE a.depth < ?
+            )
+            SELECT id FROM __ancestors ORDER BY depth DESC
+        """.format(parent=self.PARENT_ID_COLUMN, table=self.table.name,
+                   id=self.ID_COLUMN)
+
+        with self._connect() as conn:
+            with closing(conn.cursor()) as cursor:
+                cursor.execute(sql, (record_id, self.MAX_TREE_DEPTH))
+                rows = cursor.fetchall()
+
+        if not rows:
+            return None
+        return [row[0] for row in rows if row[0] is not None]
+
+    def build_search_index(self):
+        """Build the full-text search table on a background thread.
+
+        A FTS5 table named ``<table>_search`` is created for the
+        visible text columns, using the records rowid as its own. It
+        is filled in batches of :attr:`.SEARCH_INDEX_BATCH_SIZE`
+        records, each one on its own transaction so the database is
+        not kept locked while indexing, and ``search-index-progress``
+        is emitted after each of them with the fraction of records
+        already indexed. Triggers keep it in sync with the changes
+        done to the records.
+
+        The table is built under a temporary name and only renamed
+        when it is complete, so searches keep working as before in the
+        meantime and an interrupted build will not leave an incomplete
+        table behind. After that, ``search-index-built`` is emitted by
+        all the data sources for the table, which will start using it.
+        The signals are emitted on the main loop.
+
+        :return: the thread building the table or `None` if it already
+            exists or can't be built (e.g. for custom queries)
+        :rtype: :class:`threading.Thread`
+        """
+        if self.search_table is not None:
+            return None
+        return self._start_search_index_build(
+            self.table.name + '_search', self._get_search_columns())
+
+    def build_substring_index(self):
+        """Build the substring search table on a background thread.
+
+        This is a FTS5 table named ``<table>_substr`` for all the text
+        columns, using the ``trigram`` tokenizer, that is built and
+        kept in sync just like the one built by
+        :meth:`.build_search_index` (and emits the same signals). When
+        there's no full-text search table, searches for 3 or more
+        characters will use it to find the records containing them,
+        instead of scanning the records with ``LIKE``.
+
+        It needs SQLite 3.34.0 or later.
+
+        :return: the thread building the table or `None` if it already
+            exists or can't be built (e.g. for custom queries)
+        :rtype: :class:`threading.Thread`
+        """
+        if self.substring_table is not None:
+            return None
+        return self._start_search_index_build(
+            self.table.name + '_substr', self._text_columns,
+            tokenize='trigram')
+
+    @property
+    def connection_stats(self):
+        """Statistics about the connections used by this data source.
+
+        Note that the connections are shared with other data sources
+        using the same database file, and so are the statistics.
+
+        :returns: a dict with the number of connections created,
+            reused and closed
+        :rtype: dict
+        """
+        return dict(self._pool.stats)
+
     def get_visible_columns(self):
         """Get visible columns info from DB.
 
@@ -340,15 +1206,16 @@ class SQLiteDataSource(DataSource):
             return None
 
         where = (self.visible_columns_table.columns['tablename'] ==
-                 self.table.name)
+                 bindparam('tablename', self.table.name))
         columns = [self.visible_columns_table.columns['columns']]
 
-        with closing(sqlite3.connect(self.db_file)) as conn:
+        with self._connect() as conn:
             conn.row_factory = sqlite3.Row  # Access columns by name
             try:
                 result = list(
                     self.select(conn, self.visible_columns_table,
-                                columns, where=where))
+                                columns, where=where,
+                                cache_key=('visible_columns', )))
             except sqlite3.OperationalError as err:
                 # FIXME: When will this happen?
                 logger.warn(str(err))
@@ -370,7 +1237,7 @@ class SQLiteDataSource(DataSource):
         if not self._persist_columns_visibility:
             return
 
-        with closing(sqlite3.connect(self.db_file)) as conn:
+        with self._connect() as conn:
             with closing(conn.cursor()) as cursor:
                 table = self.visible_columns_table.name
                 cursor.execute(
@@ -383,46 +1250,223 @@ class SQLiteDataSource(DataSource):
                 conn.commit()
 
     def select(self, conn, table, columns=None, where=None,
-               order_by=None, limit=None, offset=None):
+               order_by=None, limit=None, offset=None, cache_key=None):
         """Select records from given db and table given columns and criteria.
 
-        :param str db_file: path to SQLite database file
-        :param str table: name of table in SQLite db
+        The statement is compiled with bound parameters. When a
+        ``cache_key`` is given, the compiled SQL is cached using it so
+        the next statements with the same key will not need to be
+        compiled again. Since the SQL is the same, sqlite will also be
+        able to reuse its already prepared statement.
+
+        :param conn: the connection to the database
+        :param table: the table (or join) to select from
         :param list columns: list of columns to SELECT from
-        :param dict where: dict of parameters to build ``WHERE`` clause
+        :param where: the ``WHERE`` clause
+        :param order_by: the list of ``ORDER BY`` clauses
+        :param int limit: the ``LIMIT`` value
+        :param int offset: the ``OFFSET`` value
+        :param tuple cache_key: a key identifying the shape of the
+            statement, i.e. statements with the same key must produce
+            the same SQL, differing only by the values of their bound
+            parameters. All of them must be named.
+        """
+        sql_str, bind_values = self._get_select_sql(
+            table, columns=columns, where=where, order_by=order_by,
+            limit=limit, offset=offset, cache_key=cache_key)
+
+        logger.debug('SQL:\n%s\nParams: %r', sql_str, bind_values)
+        with closing(conn.cursor()) as cursor:
+            for row in cursor.execute(sql_str, bind_values):
+                yield row
+
+    @property
+    def statement_cache_stats(self):
+        """Statistics about the compiled statements cache.
+
+        :returns: a dict with the number of ``hits`` and ``misses``
+            and the cache ``size`` and ``max_size``
+        :rtype: dict
+        """
+        return self._statements.info()
+
+    @property
+    def result_cache_stats(self):
+        """Statistics about the loaded results cache.
+
+        :returns: a dict with the number of ``hits`` and ``misses``
+            and the cache ``size`` and ``max_size``, in bytes
+        :rtype: dict
+        """
+        return self._results.info()
+
+    def do_rows_changed(self, params, ids):
+        """Forget the cached results when another data source updates rows.
+
+        :param dict params: the updated columns mapped to their new values
+        :param list ids: the ids of the updated records, or `None`
+        """
+        self._clear_results()
+
+    ###
+    # Private
+    ###
+
+    def _get_select_sql(self, table, columns=None, where=None,
+                        order_by=None, limit=None, offset=None,
+                        cache_key=None):
+        """Get the SQL for the select statement.
+
+        See :meth:`.select` for the parameters documentation.
+
+        :return: the SQL string and the list of values for its
+            bound parameters
+        :rtype: tuple
         """
         columns = columns or table.columns
         sql = select(
             columns=columns, whereclause=where,
             from_obj=[table], order_by=order_by)
-        sql_str = _compile(sql)
 
-        # XXX: How to make sqlalchemy use limit/offset right? It is not
-        # replacing the values on _compile
+        if cache_key is not None:
+            # Joins don't have a name. The cache_key should be enough
+            # to distinguish between them
+            cache_key = (getattr(table, 'name', None), limit is not None,
+                         offset is not None) + tuple(cache_key)
+        compiled = cache_key and self._statements.get(cache_key)
+
+        if compiled is None:
+            compiled_sql = sql.compile(dialect=_DIALECT)
+            sql_str = compiled_sql.string
+            names = compiled_sql.positiontup
+            values = compiled_sql.params
+            # XXX: How to make sqlalchemy use limit/offset right? It is not
+            # rendering them for sqlite when compiling with literal binds
+            if limit is not None:
+                sql_str += '\nLIMIT ?'
+            if offset is not None:
+                sql_str += '\nOFFSET ?'
+            # Anonymous bind parameters get a new name each time the
+            # statement is generated, so we can't cache those
+            if cache_key is not None and set(names) <= set(
+                    _get_bind_values(sql)):
+                self._statements[cache_key] = (sql_str, names)
+        else:
+            sql_str, names = compiled
+            values = _get_bind_values(sql)
+
+        bind_values = [values[name] for name in names]
         if limit is not None:
-            sql_str += '\nLIMIT %s' % (limit, )
+            bind_values.append(limit)
         if offset is not None:
-            sql_str += '\nOFFSET %s' % (offset, )
+            bind_values.append(offset)
+
+        return sql_str, bind_values
 
-        logger.debug('SQL:\n%s', sql_str)
+    def _count(self, conn, where, where_shape, flat):
+        """Count the records matching the where clause.
+
+        :param conn: an open connection to the database
+        :param where: the where clause to filter the records
+        :param tuple where_shape: the where params shape, used to
+            cache the compiled statement
+        :param bool flat: if the records are being loaded as flat
+        :return: the number of records
+        :rtype: int
+        """
+        res = self.select(
+            conn, self.table, [func.count(literal_column('1'))],
+            where=where, cache_key=('count', where_shape, flat))
+        return int(list(res)[0][0])
+
+    def _estimate_count(self, conn):
+        """Estimate the number of records on the table.
+
+        The estimation comes from the ``sqlite_stat1`` table, populated
+        by ``ANALYZE``, which stores the number of rows of each table.
+
+        :param conn: an open connection to the database
+        :return: the estimated number of records or `None` if there
+            are no statistics for the table
+        :rtype: int
+        """
         with closing(conn.cursor()) as cursor:
-            for row in cursor.execute(sql_str):
-                yield row
+            try:
+                cursor.execute(
+                    'SELECT stat FROM sqlite_stat1 WHERE tbl = ?',
+                    (self.table.name, ))
+            except sqlite3.OperationalError:
+                # sqlite_stat1 will not exist if ANALYZE was never run
+                return None
+            row = cursor.fetchone()
 
-    ###
-    # Private
-    ###
+        if row is None or not row[0]:
+            return None
+        return int(row[0].split()[0])
+
+    def _get_update_set(self, params):
+        """Get the ``SET`` part of an ``UPDATE`` statement.
+
+        :param dict params: keys corresponding to DB columns + values to update
+        :return: the SQL string and the list of values for its
+            bound parameters
+        :rtype: tuple
+        """
+        update_sql_list = []
+        update_values = []
+        for key, value in params.iteritems():
+            if isinstance(value, bool):
+                value = int(value)
+            update_sql_list.append('%s = ?' % (key, ))
+            update_values.append(value)
+
+        return ', '.join(update_sql_list), update_values
+
+    def _emit_rows_changed(self, params, get_ids):
+        """Emit rows-changed on the other data sources for this table.
+
+        This is to allow any view using them to update themselves with
+        the changes done here. The current object will not emit the
+        event as it is the one who made the update and thus, is
+        assumed to know about the changes. The signal is emitted on
+        the main loop.
+
+        :param dict params: the updated columns mapped to their new values
+        :param callable get_ids: a callable returning the ids of the
+            updated records, or `None` if all of them were updated.
+            It will only be called if there's a data source to notify
+        """
+        ids_loaded = False
+        ids = None
+        for db in self.__class__._DBS:
+            if db is self:
+                continue
+            if (db.db_file, db.table.name) != (self.db_file, self.table.name):
+                continue
+
+            if not ids_loaded:
+                ids = get_ids()
+                ids_loaded = True
+            # The update may have been done on a worker thread, but
+            # the views handling the signal must be updated on the
+            # main loop. The cached results must be forgotten now
+            db._clear_results()
+            GLib.idle_add(db.emit, 'rows-changed', params, ids)
 
-    def _get_where_clause(self, where_params):
+    def _get_where_clause(self, where_params, fts_join=False):
         """Construct a SQL ``WHERE`` clause.
 
         A typical ``where_params`` dict might look like this::
 
             {'search': {'operator': '=', 'param': 'Google'}}
 
-        .. NOTE:: ``search`` is a special key used for full-text searches
+        .. NOTE:: ``search`` is a special key used for full-text searches.
+            Without a search table, only text columns are searched
 
         :param dict where_params: parameters to build ``WHERE`` clause
+        :param bool fts_join: if the FTS5 search table is joined with
+            the table (see :meth:`._get_search_join`), in which case
+            it will be matched directly
         :return: SQL ``WHERE`` clause, and parameters to use in clause
         :rtype: tuple
         """
@@ -430,49 +1474,1056 @@ class SQLiteDataSource(DataSource):
         for key, value in where_params.iteritems():
             if key == 'search':
                 # full-text search
-                if value['param'] and self.search_table is not None:
-                    # XXX: This is to make MATCH be compiled direct here.
-                    # We should build this query using sqlalchemy instead
-                    match = column(self.search_table).match(value['param'])
-
-                    sql = '(%s IN (%s)' % (
+                param = _get_search_text(value['param'])
+                search_mode = self._get_search_mode(param)
+                if search_mode == 'fts5':
+                    search = bindparam('search', _get_fts5_query(param))
+                    if fts_join:
+                        sql = text('%s MATCH :search' % (self.search_table, ))
+                    else:
+                        sql = text(
+                            '%s._rowid_ IN (SELECT rowid FROM %s '
+                            'WHERE %s MATCH :search)' % (
+                                self.table.name, self.search_table,
+                                self.search_table))
+                    sql_clauses.append(sql.bindparams(search))
+                elif search_mode == 'fts':
+                    sql = text('(%s IN (%s)' % (
                         self.ID_COLUMN,
                         'SELECT %(id)s FROM '
                         '(SELECT rank(matchinfo(%(table)s)) AS r, %(id)s'
-                        ' FROM  %(table)s WHERE %(match)s)'
+                        ' FROM  %(table)s WHERE %(table)s MATCH :search)'
                         ' WHERE r > 0 ORDER BY r DESC)' % {
                             "id": self.ID_COLUMN,
                             "table": self.search_table,
-                            "match": _compile(match),
                         }
-                    )
+                    )).bindparams(bindparam('search', param))
                     sql_clauses.append(sql)
-                elif value['param']:
-                    clauses = [col.like('%{}%'.format(value['param']))
-                               for col in self.table.columns]
+                elif search_mode == 'trigram':
+                    # A phrase on the trigram table matches the records
+                    # containing it, just like "LIKE '%search%'"
+                    search = bindparam(
+                        'search', u'"%s"' % (param.replace(u'"', u'""'), ))
+                    sql = text(
+                        '%s._rowid_ IN (SELECT rowid FROM %s '
+                        'WHERE %s MATCH :search)' % (
+                            self.table.name, self.substring_table,
+                            self.substring_table))
+                    sql_clauses.append(sql.bindparams(search))
+                elif search_mode == 'like':
+                    # The same bind parameter is used for all the columns
+                    search = bindparam('search', u'%{}%'.format(param))
+                    columns = [self.table.columns[name]
+                               for name in self._like_columns]
+                    clauses = [col.like(search)
+                               for col in columns or self.table.columns]
                     sql_clauses.append(or_(*clauses))
             elif value['operator'] == 'range':
+                start, end = value['param']
                 sql_clauses.append(
-                    self.table.columns[key].between(*value['param']))
+                    self.table.columns[key].between(
+                        bindparam('where_%s_start' % (key, ), start),
+                        bindparam('where_%s_end' % (key, ), end)))
             else:
+                param = value['param']
+                # Comparing with None will generate an "IS NULL"
+                if param is not None:
+                    param = bindparam('where_%s' % (key, ), param)
                 clause = _OPERATOR_MAPPER[value['operator']](
-                    self.table.columns[key], value['param'])
+                    self.table.columns[key], param)
                 sql_clauses.append(clause)
 
         return and_(*sql_clauses)
 
-    def _ensure_temp_view(self, cursor):
+    def _get_search_columns(self):
+        """Get the columns to index on the full-text search table.
+
+        :return: the names of the visible text columns
+        :rtype: list
+        """
+        visible = self.get_visible_columns()
+        return [col['name'] for col in self.columns
+                if col['name'] in self._text_columns and
+                (col['name'] in visible if visible is not None
+                 else col['visible'])]
+
+    def _start_search_index_build(self, search_table, columns,
+                                  tokenize=None):
+        """Start building a search table on a background thread.
+
+        :param str search_table: the name of the search table
+        :param list columns: the names of the columns to index
+        :param str tokenize: the FTS5 tokenizer to use, or `None`
+            to use the default one
+        :return: the thread building the table or `None` if it
+            can't be built
+        :rtype: :class:`threading.Thread`
+        """
+        if self.query or not columns:
+            return None
+
+        task = threading.Thread(
+            target=self._build_search_index,
+            args=(search_table, columns, tokenize))
+        task.daemon = True
+        task.start()
+        return task
+
+    def _get_search_triggers(self, name, search_table, columns):
+        """Get the triggers keeping the search table in sync.
+
+        :param str name: the name of the search table once built,
+            used to name the triggers
+        :param str search_table: the name of the search table
+        :param list columns: the names of the indexed columns
+        :return: a list of tuples containing the name of each trigger
+            and the SQL to create it
+        :rtype: list
+        """
+        columns_str = ', '.join(columns)
+        delete = 'DELETE FROM %s WHERE rowid = old._rowid_;' % (
+            search_table, )
+        insert = 'INSERT INTO %s (rowid, %s) VALUES (new._rowid_, %s);' % (
+            search_table, columns_str,
+            ', '.join('new.%s' % (col, ) for col in columns))
+        prefix = '__' + name
+        return [
+            (prefix + '_insert',
+             'CREATE TRIGGER %s_insert AFTER INSERT ON %s BEGIN %s END' % (
+                 prefix, self.table.name, insert)),
+            (prefix + '_delete',
+             'CREATE TRIGGER %s_delete AFTER DELETE ON %s BEGIN %s END' % (
+                 prefix, self.table.name, delete)),
+            # Updating other columns (e.g. __selected) doesn't reindex
+            (prefix + '_update',
+             'CREATE TRIGGER %s_update AFTER UPDATE OF %s ON %s '
+             'BEGIN %s %s END' % (
+                 prefix, columns_str, self.table.name, delete, insert)),
+        ]
+
+    def _build_search_index(self, search_table, columns, tokenize=None):
+        """Build a search table.
+
+        This runs on the thread started by
+        :meth:`._start_search_index_build`.
+
+        :param str search_table: the name of the search table
+        :param list columns: the names of the columns to index
+        :param str tokenize: the FTS5 tokenizer to use, or `None`
+            to use the default one
+        """
+        building_table = '__%s_building' % (search_table, )
+
+        with self._SEARCH_INDEX_LOCK, self._connect() as conn:
+            with closing(conn.cursor()) as cursor:
+                cursor.execute('PRAGMA table_info(%s)' % (search_table, ))
+                if cursor.fetchone():
+                    # Already built by another data source
+                    return
+
+                try:
+                    self._fill_search_table(
+                        conn, cursor, search_table, building_table,
+                        columns, tokenize)
+
+                    # Rename the table and replace its triggers atomically
+                    isolation_level = conn.isolation_level
+                    conn.isolation_level = None
+                    try:
+                        cursor.execute('BEGIN IMMEDIATE')
+                        for name, _ in self._get_search_triggers(
+                                search_table, building_table, columns):
+                            cursor.execute('DROP TRIGGER %s' % (name, ))
+                        cursor.execute('ALTER TABLE %s RENAME TO %s' % (
+                            building_table, search_table))
+                        for _, sql in self._get_search_triggers(
+                                search_table, search_table, columns):
+                            cursor.execute(sql)
+                        cursor.execute('COMMIT')
+                    except sqlite3.Error:
+                        try:
+                            cursor.execute('ROLLBACK')
+                        except sqlite3.Error:
+                            pass
+                        raise
+                    finally:
+                        conn.isolation_level = isolation_level
+                except sqlite3.Error:
+                    logger.exception(
+                        'Could not build the search table %s', search_table)
+                    return
+
+        # The data sources may be building queries on the main loop
+        # or on the worker, so only change them on the main loop
+        GLib.idle_add(self._on_search_index_built, search_table)
+
+    def _fill_search_table(self, conn, cursor, name, search_table, columns,
+                           tokenize=None):
+        """Create the search table and index all the records on it.
+
+        :param conn: an open connection to the database
+        :param cursor: a cursor for the connection
+        :param str name: the name of the search table once built
+        :param str search_table: the name of the search table
+        :param list columns: the names of the columns to index
+        :param str tokenize: the FTS5 tokenizer to use, or `None`
+            to use the default one
+        """
+        table = self.table.name
+        triggers = self._get_search_triggers(name, search_table, columns)
+        # Remove what was left by an interrupted build
+        for name, _ in triggers:
+            cursor.execute('DROP TRIGGER IF EXISTS %s' % (name, ))
+        cursor.execute('DROP TABLE IF EXISTS %s' % (search_table, ))
+
+        options = list(columns)
+        if tokenize is not None:
+            options.append("tokenize='%s'" % (tokenize, ))
+        cursor.execute('CREATE VIRTUAL TABLE %s USING fts5(%s)' % (
+            search_table, ', '.join(options)))
+        # The triggers index the records modified while building the
+        # table, so those must be skipped when indexing each batch
+        for _, sql in triggers:
+            cursor.execute(sql)
+        cursor.execute(
+            'SELECT min(_rowid_), max(_rowid_) FROM %s' % (table, ))
+        first, last = cursor.fetchone()
+        conn.commit()
+        if first is None:
+            return
+
+        sql = ('INSERT INTO {search} (rowid, {columns}) '
+               'SELECT _rowid_, {columns} FROM {table} '
+               'WHERE _rowid_ >= ? AND _rowid_ < ? AND _rowid_ NOT IN '
+               '(SELECT rowid FROM {search} WHERE rowid >= ? AND rowid < ?)'
+               ).format(search=search_table, table=table,
+                        columns=', '.join(columns))
+        total = last - first + 1
+        for start in xrange(first, last + 1, self.SEARCH_INDEX_BATCH_SIZE):
+            end = min(start + self.SEARCH_INDEX_BATCH_SIZE, last + 1)
+            cursor.execute(sql, (start, end, start, end))
+            conn.commit()
+            GLib.idle_add(self.emit, 'search-index-progress',
+                          float(end - first) / total)
+
+    def _on_search_index_built(self, search_table):
+        """Start using the search table on all the data sources.
+
+        This is called on the main loop after the search table
+        gets built.
+
+        :param str search_table: the name of the search table
+        """
+        substring = search_table == self.table.name + '_substr'
+        for db in list(self.__class__._DBS):
+            if (db.db_file, db.table.name) != (self.db_file, self.table.name):
+                continue
+            if substring:
+                db.substring_table = search_table
+            else:
+                db._search_fts5 = True
+                db.search_table = search_table
+            db.emit('search-index-built')
+        return False
+
+    def _get_search_mode(self, search):
+        """Get how the records will be matched by the search.
+
+        :param unicode search: the search terms
+        :return: ``'fts5'`` or ``'fts'`` when using the full-text
+            search table (FTS5 or a legacy FTS3/FTS4 one), ``'trigram'``
+            when using the substring search table, ``'like'`` when
+            falling back to ``LIKE`` or `None` if there's nothing
+            to search
+        :rtype: str
+        """
+        search = _get_search_text(search)
+        if not search:
+            return None
+        if self.search_table is None:
+            # Trigrams can't match less than 3 characters
+            if self.substring_table is not None and len(search) >= 3:
+                return 'trigram'
+            return 'like'
+        if self._search_fts5:
+            return 'fts5' if search.split() else None
+        return 'fts'
+
+    def _is_ranked(self, params):
+        """Check if the records will be sorted by their search rank.
+
+        That happens when searching using a FTS5 table and the records
+        are not sorted by any column.
+
+        :param dict params: the params used to load the records
+        :rtype: bool
+        """
+        if params.get('order_by', None):
+            return False
+        if self.PARENT_ID_COLUMN and not params.get('flat', False):
+            return False
+        search = (params.get('where', None) or {}).get('search', None)
+        return (search is not None and
+                self._get_search_mode(search['param']) == 'fts5')
+
+    def _get_search_join(self):
+        """Get the table joined with its FTS5 search table.
+
+        Matching the search table on this join (instead of filtering
+        the ids by a subquery) allows sorting the records by their
+        ``bm25()`` rank.
+        """
+        search_table = table_(self.search_table, column('rowid'))
+        rowid = literal_column('%s._rowid_' % (self.table.name, ))
+        return self.table.join(search_table, search_table.c.rowid == rowid)
+
+    def _get_where_shape(self, where_params):
+        """Get the shape of the ``WHERE`` clause for the given params.
+
+        Clauses with the same shape will only differ by the values of
+        their bound parameters. That is, they will produce the same SQL.
+
+        :param dict where_params: parameters to build ``WHERE`` clause
+        :return: the shape of the clause
+        :rtype: tuple
+        """
+        shape = []
+        for key, value in where_params.iteritems():
+            param = value['param']
+            if key == 'search':
+                param_shape = self._get_search_mode(param)
+            else:
+                param_shape = param is None
+            shape.append((key, value.get('operator'), param_shape))
+
+        return tuple(sorted(shape))
+
+    @contextmanager
+    def _connect(self):
+        """Borrow a connection to the database from the pool.
+
+        The connection is ready to be used by this data source, i.e.
+        any temporary view it requires will already exist on it.
+        """
+        with self._pool.connection() as conn:
+            self._ensure_temp_view(conn)
+            yield conn
+
+    @contextmanager
+    def _cancellable(self, conn, cancel_event):
+        """Interrupt the queries on the connection when the event is set.
+
+        This uses a progress handler, checking the event each
+        :attr:`.CANCEL_CHECK_INTERVAL` virtual machine instructions.
+
+        :param conn: an open connection to the database
+        :param cancel_event: the event to check, or `None` if the
+            queries can't be cancelled
+        :type cancel_event: :class:`threading.Event`
+        :raise QueryCancelled: if the event got set
+        """
+        if cancel_event is None:
+            yield
+            return
+        if cancel_event.is_set():
+            raise QueryCancelled()
+
+        conn.set_progress_handler(
+            cancel_event.is_set, self.CANCEL_CHECK_INTERVAL)
+        try:
+            yield
+        except sqlite3.OperationalError as e:
+            if 'interrupted' in str(e) and cancel_event.is_set():
+                raise QueryCancelled()
+            raise
+        finally:
+            conn.set_progress_handler(None, 0)
+
+    def _ensure_temp_view(self, conn):
         """If a custom query is defined, temporary view using that query
         is used in place of a table name.
         This makes sure that temporary view exists if required.
 
-        :param cursor: Cursor for the session where the view might be needed.
+        :param conn: Connection for the session where the view might
+            be needed.
         """
-        if self.query:
+        if self.query and self.table.name not in conn.temp_views:
             # create a temporary view for collecting column info
-            cursor.execute('CREATE TEMP VIEW IF NOT EXISTS %s AS %s' % (
-                self.table.name, self.query
-            ))
+            with closing(conn.cursor()) as cursor:
+                cursor.execute('CREATE TEMP VIEW IF NOT EXISTS %s AS %s' % (
+                    self.table.name, self.query
+                ))
+            conn.temp_views.add(self.table.name)
+
+    def _get_filter(self, params, fts_join=False, search_set=None):
+        """Get the where clause to filter the records.
+
+        :param dict params: the params used to load the records
+        :param bool fts_join: if the FTS5 search table is joined with
+            the table. See :meth:`._get_where_clause`
+        :param str search_set: the name of the temporary table with the
+            records matching the where params, to filter by it instead.
+            See :meth:`._get_search_set`
+        :return: the where clause (or `None` if there's no filter),
+            the where params shape and if the records are being
+            loaded as flat
+        :rtype: tuple
+        """
+        where = params.get('where', None)
+        where_shape = None
+        if search_set is not None:
+            where = text('%s._rowid_ IN (SELECT rid FROM temp.%s)' % (
+                self.table.name, search_set))
+            where_shape = ('search_set', )
+        elif where is not None:
+            where_shape = self._get_where_shape(where)
+            where = self._get_where_clause(where, fts_join=fts_join)
+
+        flat = params.get('flat', False)
+        if flat:
+            flat_where = operator.ne(
+                self.table.columns[self.FLAT_COLUMN], None)
+            where = and_(where, flat_where) if where is not None else flat_where  # noqa
+
+        return where, where_shape, flat
+
+    def _get_search_set(self, conn, params, create=True):
+        """Get the materialized rowids of the records matching a search.
+
+        When :attr:`.REFINE_SEARCHES` is set, the rowids of the records
+        matching the ``where`` params of a search are inserted in a
+        temporary table (one for each table and connection), which is
+        then used to filter the records. When the next search is a
+        refinement of it (see :meth:`._is_refinement`), e.g. when the
+        user keeps typing the search terms, only the records on it need
+        to be checked, instead of all the records on the table.
+
+        Note that this makes the first page of each search wait for
+        all the records to be matched (but they will not need to be
+        counted after that). The results are discarded when there are
+        more than :attr:`.MAX_SEARCH_SET_RECS` of them or when
+        :meth:`.update` modifies the columns they depend on.
+
+        :param conn: an open connection to the database
+        :param dict params: the params used to load the records
+        :param bool create: if the table should be created when it
+            doesn't exist for the params
+        :return: the temporary table name and the number of records
+            on it, or `None` if it can't be used for the params
+        :rtype: tuple
+        """
+        where_params = params.get('where', None) or {}
+        search = where_params.get('search', None)
+        if (not self.REFINE_SEARCHES or self.query or search is None or
+                self._get_search_mode(search['param']) is None or
+                self._is_ranked(params)):
+            return None
+
+        name = '__DataGridSearch_%s' % (self.table.name, )
+        refine = False
+        current = conn.search_sets.get(self.table.name, None)
+        if (current is not None and
+                current[1] == self._get_search_set_version(current[0])):
+            if current[0] == where_params:
+                return name, current[2]
+            refine = self._is_refinement(current[0], where_params)
+        if not create:
+            return None
+
+        # Get it before matching the records, in case they change meanwhile
+        version = self._get_search_set_version(where_params)
+        where = self._get_where_clause(where_params)
+        if refine:
+            where = and_(
+                text('%s._rowid_ IN (SELECT rid FROM temp.%s)' % (
+                    self.table.name, name)),
+                where)
+        sql_str, bind_values = self._get_select_sql(
+            self.table, [literal_column('%s._rowid_' % (self.table.name, ))],
+            where=where, limit=self.MAX_SEARCH_SET_RECS + 1,
+            cache_key=('search_set', self._get_where_shape(where_params),
+                       refine))
+
+        with closing(conn.cursor()) as cursor:
+            cursor.execute('DROP TABLE IF EXISTS temp.%s_new' % (name, ))
+            cursor.execute(
+                'CREATE TEMP TABLE %s_new (rid INTEGER PRIMARY KEY)' % (
+                    name, ))
+            sql = 'INSERT INTO temp.%s_new (rid) %s' % (name, sql_str)
+            logger.debug('SQL:\n%s\nParams: %r', sql, bind_values)
+            try:
+                cursor.execute(sql, bind_values)
+            except sqlite3.OperationalError:
+                # The query got interrupted (e.g. it was cancelled).
+                # Make sure dropping the table will not be interrupted too
+                conn.set_progress_handler(None, 0)
+                cursor.execute('DROP TABLE temp.%s_new' % (name, ))
+                raise
+            total_recs = cursor.rowcount
+
+            conn.search_sets.pop(self.table.name, None)
+            cursor.execute('DROP TABLE IF EXISTS temp.%s' % (name, ))
+            if total_recs > self.MAX_SEARCH_SET_RECS:
+                cursor.execute('DROP TABLE temp.%s_new' % (name, ))
+                conn.commit()
+                return None
+            cursor.execute(
+                'ALTER TABLE temp.%s_new RENAME TO %s' % (name, name))
+        # Do not hold the read lock on the database
+        conn.commit()
+
+        conn.search_sets[self.table.name] = (
+            copy.deepcopy(where_params), version, total_recs)
+        return name, total_recs
+
+    def _get_search_set_version(self, where_params):
+        """Get the version of the data a search set depends on.
+
+        :param dict where_params: the ``where`` params of the search
+        :return: a value that changes when the records matching
+            the params may have changed
+        """
+        dependencies = None
+        if self._like_columns:
+            dependencies = set(where_params.keys()) - {'search'}
+            dependencies.update(self._like_columns)
+        # Building a search table changes how the records are matched
+        return (self._pool.get_columns_version(dependencies),
+                self.search_table, self.substring_table)
+
+    def _is_refinement(self, old_where, new_where):
+        """Check if the new where params refine the old ones.
+
+        That is, if the records matching the new params are guaranteed
+        to be a subset of the ones matching the old params. This
+        happens when all the old params are present on the new ones,
+        each of them being the same or narrower, like a search term
+        containing the old one or a range inside the old one. The
+        new params can also have other keys.
+
+        :param dict old_where: the old ``where`` params
+        :param dict new_where: the new ``where`` params
+        :rtype: bool
+        """
+        for key, old_value in old_where.iteritems():
+            new_value = new_where.get(key, None)
+            if new_value is None:
+                return False
+            if new_value == old_value:
+                continue
+
+            old_param = old_value['param']
+            new_param = new_value['param']
+            if key == 'search':
+                old_param = _get_search_text(old_param)
+                new_param = _get_search_text(new_param)
+                search_mode = self._get_search_mode(old_param)
+                if search_mode != self._get_search_mode(new_param):
+                    return False
+                if search_mode in ['like', 'trigram']:
+                    # Anything containing the new term contains the old one
+                    if old_param not in new_param:
+                        return False
+                elif search_mode == 'fts5':
+                    # The terms are prefixes. Extending the last one or
+                    # adding more terms will only match less records
+                    if not new_param.startswith(old_param):
+                        return False
+                else:
+                    return False
+                continue
+
+            operator_ = old_value.get('operator', None)
+            if (operator_ != new_value.get('operator', None) or
+                    old_param is None or new_param is None):
+                return False
+            if operator_ == 'range':
+                if not (old_param[0] <= new_param[0] and
+                        new_param[1] <= old_param[1]):
+                    return False
+            elif operator_ in ['>', '>=']:
+                if new_param < old_param:
+                    return False
+            elif operator_ in ['<', '<=']:
+                if new_param > old_param:
+                    return False
+            else:
+                return False
+
+        return True
+
+    def _get_sort_key(self, params):
+        """Get the expressions used to sort the records.
+
+        When sorting by a column, the records id is used to break ties,
+        so the records position will be well defined. When not sorting
+        by anything, the records are sorted by their search rank if
+        they are searched using a FTS5 table (see :meth:`._is_ranked`)
+        or by their id only if that comes for free (i.e. when the id
+        is the rowid).
+
+        :param dict params: the params used to load the records
+        :return: the list of expressions, in ascending order
+        :rtype: list
+        """
+        order_by = params.get('order_by', None)
+        id_column = None
+        if self.id_column_idx is not None:
+            id_column = self.table.columns[self.ID_COLUMN]
+
+        if self._is_ranked(params):
+            # bm25() is lower for better matches
+            sort_key = [literal_column('bm25(%s)' % (self.search_table, ))]
+            if id_column is not None:
+                sort_key.append(id_column)
+            return sort_key
+        if self._get_seek_key(params) is not None:
+            return [id_column]
+        if not order_by:
+            return [id_column] if self._id_is_rowid else []
+
+        # Do a numeric ordering first, as suggested here
+        # (http://stackoverflow.com/a/4204641), and then a
+        # case-insensitive one
+        sort_key = [self.table.columns[order_by] + literal_column('0'),
+                    collate(self.table.columns[order_by], 'NOCASE')]
+        if id_column is not None and order_by != self.ID_COLUMN:
+            sort_key.append(id_column)
+        return sort_key
+
+    def _ensure_parent_index(self, conn):
+        """Check that the parent column is indexed.
+
+        Without an index, loading each level of the tree needs a full
+        scan on the table. If :attr:`.CREATE_PARENT_INDEX` is set, the
+        index will be created when it is missing. Otherwise, a warning
+        will be logged.
+
+        :param conn: an open connection to the database
+        :return: if the parent column is indexed
+        :rtype: bool
+        """
+        if self._parent_indexed is not None:
+            return self._parent_indexed
+        # Views can't be indexed
+        if self.query:
+            self._parent_indexed = False
+            return False
+
+        with closing(conn.cursor()) as cursor:
+            cursor.execute('PRAGMA index_list(%s)' % (self.table.name, ))
+            indexes = [row[1] for row in cursor.fetchall()]
+            for index in indexes:
+                cursor.execute('PRAGMA index_info(%s)' % (index, ))
+                first_column = cursor.fetchone()
+                if first_column and first_column[2] == self.PARENT_ID_COLUMN:
+                    self._parent_indexed = True
+                    return True
+
+            if self.CREATE_PARENT_INDEX:
+                cursor.execute(
+                    'CREATE INDEX IF NOT EXISTS __%s_%s_index ON %s (%s)' % (
+                        self.table.name, self.PARENT_ID_COLUMN,
+                        self.table.name, self.PARENT_ID_COLUMN))
+                conn.commit()
+                self._parent_indexed = True
+                return True
+
+        logger.warning(
+            'The column %s on table %s is not indexed. Loading the tree '
+            'will be slow', self.PARENT_ID_COLUMN, self.table.name)
+        self._parent_indexed = False
+        return False
+
+    def _get_before_clause(self, sort_key, values, is_desc):
+        """Get a clause matching the records sorted before the values.
+
+        The comparison is done lexicographically on the sort key,
+        taking into account that ``NULL`` values come first when
+        sorting in ascending order (and last when descending).
+
+        :param list sort_key: the expressions used to sort the records
+        :param tuple values: the values of the sort key for the record
+        :param bool is_desc: if the records are sorted in descending order
+        :return: the clause or `None` if no record would come before it
+        """
+        clauses = []
+        same = []
+        for i, (expr, value) in enumerate(zip(sort_key, values)):
+            if value is None:
+                before = expr.isnot(None) if is_desc else None
+                equal = expr.is_(None)
+            else:
+                param = bindparam('position_key_%d' % (i, ), value)
+                before = (expr > param if is_desc
+                          else or_(expr.is_(None), expr < param))
+                equal = expr == param
+
+            if before is not None:
+                clauses.append(and_(*(same + [before])))
+            same.append(equal)
+
+        return or_(*clauses) if clauses else None
+
+    def _get_order_by(self, params):
+        """Get the ``ORDER BY`` clauses to sort the records.
+
+        :param dict params: the params used to load the records
+        :return: the list of ``ORDER BY`` clauses or `None` if the
+            records should not be sorted
+        :rtype: list
+        """
+        order_by = self._get_sort_key(params) or None
+        if order_by is not None and params.get('desc', False):
+            order_by = [desc(col) for col in order_by]
+        return order_by
+
+    def _get_seek_key(self, params):
+        """Get the key to store/retrieve the keyset pagination state.
+
+        Keyset pagination can only be used when the records are
+        sorted by the rowid, since that is guaranteed to be unique
+        and indexed.
+
+        :param dict params: the params used to load the records
+        :return: a key representing the params (excluding the page) or
+            `None` if keyset pagination cannot be used for them
+        :rtype: tuple
+        """
+        if not self.SEEK_PAGINATION or not self._id_is_rowid:
+            return None
+        # Tree levels are not paginated
+        if self.PARENT_ID_COLUMN and not params.get('flat', False):
+            return None
+        if params.get('order_by', None) not in [None, self.ID_COLUMN]:
+            return None
+        if self._is_ranked(params):
+            return None
+
+        return self._get_params_key(params)
+
+    def _get_load_columns(self, params):
+        """Get the columns to select when loading the records.
+
+        :param dict params: the params used to load the records.
+            See the ``columns`` and ``truncate`` params of :meth:`.load`
+        :return: the columns to select, with ``NULL`` in place of the
+            ones that should not be loaded (so the values of each
+            column are still at their index), and a key representing
+            how they are loaded (`None` if all of them are loaded whole)
+        :rtype: tuple
+        """
+        names = params.get('columns', None)
+        truncate = params.get('truncate', None)
+        if names is None and truncate is None:
+            return self.table.columns.values(), None
+
+        if names is not None:
+            names = set(names)
+            names.update([self.ID_COLUMN, self.PARENT_ID_COLUMN,
+                          self.CHILDREN_LEN_COLUMN, self.FLAT_COLUMN,
+                          self.SELECTED_COLUMN])
+        if truncate is not None:
+            truncated = {
+                col['name'] for col in self.columns
+                if col['name'] in self._text_columns and
+                col['transform'] in [None, 'string', 'html']}
+        else:
+            truncated = set()
+
+        # Use named bind parameters, since the anonymous ones would get a
+        # new name each time and the statement would never be cached
+        truncate_len = bindparam('truncate_len', truncate)
+        columns = []
+        loaded = []
+        for col in self.table.columns:
+            if names is not None and col.name not in names:
+                columns.append(null().label(col.name))
+            elif col.name in truncated:
+                columns.append(func.substr(
+                    col, literal_column('1'), truncate_len).label(col.name))
+                loaded.append(col.name)
+            else:
+                columns.append(col)
+                loaded.append(col.name)
+
+        return columns, (tuple(loaded), truncate)
+
+    def _get_params_key(self, params):
+        """Get a key representing the records matched by the params.
+
+        :param dict params: the params used to load the records
+        :return: a hashable version of the params, excluding the
+            ones that don't change which records are matched or their
+            order (e.g. the page)
+        :rtype: tuple
+        """
+        return _freeze(dict(
+            (k, v) for k, v in params.iteritems()
+            if k not in ['page', 'page_count', 'parent_id', 'defer_count']))
+
+    def _set_seek_state(self, seek_key, page, page_count, rows):
+        """Remember the last record loaded for keyset pagination.
+
+        :param tuple seek_key: the key returned by :meth:`._get_seek_key`
+        :param int page: the first page that was loaded
+        :param int page_count: the number of pages that were loaded
+        :param rows: the loaded rows
+        :type rows: :class:`datagrid_gtk3.db.Node`
+        """
+        if not len(rows):
+            return
+
+        with self._seek_lock:
+            self._seek_states.pop(seek_key, None)
+            self._seek_states[seek_key] = (
+                page + page_count - 1, rows[-1].data[self.id_column_idx])
+            while len(self._seek_states) > self.MAX_SEEK_STATES:
+                self._seek_states.popitem(last=False)
+
+    def _get_result_key(self, params):
+        """Get the key to cache the rows loaded for the params.
+
+        :param dict params: the params used to load the records
+        :return: a key representing the params or `None` if the
+            rows should not be cached
+        :rtype: tuple
+        """
+        if not self._results.max_size:
+            return None
+        # Only the first pages of the root level are cached
+        if params.get('parent_id', None) is not None:
+            return None
+        page = params.get('page', 0)
+        if page >= self.RESULT_CACHE_PAGES:
+            return None
+
+        return ('rows', self._get_params_key(params), page,
+                params.get('page_count', 1))
+
+    def _get_count_key(self, params):
+        """Get the key to cache the number of records for the params.
+
+        Contrary to :meth:`._get_result_key`, this only considers the
+        params that filter the records, since their order doesn't
+        change how many of them there are.
+
+        :param dict params: the params used to load the records
+        :return: a key representing the filter params or `None` if
+            the number of records should not be cached
+        :rtype: tuple
+        """
+        if not self._results.max_size:
+            return None
+        return ('count', _freeze(params.get('where', None)),
+                params.get('flat', False))
+
+    def _check_results(self, conn):
+        """Clear the cached results if the database got modified.
+
+        :param conn: an open connection to the database
+        :return: the version of the data the results will be loaded
+            from, to be passed to :meth:`._cache_result`
+        :rtype: tuple
+        """
+        version = (self._pool.get_columns_version(),
+                   self._pool.check_data_version(conn),
+                   self.search_table, self.substring_table)
+        with self._results_lock:
+            if version != self._results_version:
+                self._results.clear()
+                self._results_version = version
+        return version
+
+    def _get_cached_rows(self, params, result_key, seek_key):
+        """Get the rows cached for the params, if any.
+
+        When loading the first page, the total number of records is
+        also got from the cache. The rows are not considered cached if
+        the number of records should be counted but it is not known.
+
+        :param dict params: the params used to load the records
+        :param tuple result_key: the key returned by
+            :meth:`._get_result_key`
+        :param tuple seek_key: the key returned by :meth:`._get_seek_key`
+        :return: a copy of the cached rows and the total number of
+            records, like returned by :meth:`.load_counted`, or `None`
+        :rtype: tuple
+        """
+        cached = self._results.get(result_key)
+        if cached is None:
+            return None
+
+        rows, total_recs = cached
+        page = params.get('page', 0)
+        if page == 0:
+            if total_recs is None:
+                total_recs = self._results.get(self._get_count_key(params))
+            if total_recs is None and not params.get('defer_count', False):
+                return None
+
+        if seek_key is not None:
+            self._set_seek_state(
+                seek_key, page, params.get('page_count', 1), rows)
+        return _copy_rows(rows), total_recs
+
+    def _cache_result(self, version, key, result):
+        """Cache a result loaded from the given version of the data.
+
+        The result is discarded if the database got modified while it
+        was being loaded.
+
+        :param tuple version: the version returned by
+            :meth:`._check_results` before loading the result
+        :param tuple key: the key returned by :meth:`._get_result_key`
+            or :meth:`._get_count_key`
+        :param object result: the result to cache
+        """
+        with self._results_lock:
+            if (version != self._results_version or
+                    version[0] != self._pool.get_columns_version()):
+                return
+            self._results[key] = result
+
+    def _clear_results(self):
+        """Clear the cached results."""
+        with self._results_lock:
+            self._results.clear()
+            # Make sure results being loaded right now are not cached
+            self._results_version = None
+
+    def _get_id_set(self, conn, params, where, where_shape, order_by,
+                    table=None):
+        """Get the materialized ids for the params.
+
+        The rowids of the records matching the where clause are
+        inserted, in order, in a temporary table like::
+
+            CREATE TEMP TABLE __DataGridIds_N (
+                pos INTEGER PRIMARY KEY,
+                rid INTEGER
+            )
+
+        where ``pos`` starts at 1. It will be reused while it is
+        cached on the connection and the columns it depends on
+        were not modified.
+
+        :param conn: an open connection to the database
+        :param dict params: the params used to load the records
+        :param where: the where clause to filter the records
+        :param tuple where_shape: the where params shape, used to
+            cache the compiled statement
+        :param list order_by: the list of ``ORDER BY`` clauses
+        :param table: the table (or join) to select the records
+            from. Defaults to :attr:`.table`
+        :return: the temporary table name and the number of records
+        :rtype: tuple
+        """
+        key = (self.table.name, self._get_params_key(params))
+        dependencies = set((params.get('where', None) or {}).keys())
+        if 'search' in dependencies:
+            # The search matches any column
+            dependencies = None
+        else:
+            dependencies.update(
+                col for col in [params.get('order_by', None),
+                                params.get('flat', False) and
+                                self.FLAT_COLUMN]
+                if col)
+        version = self._pool.get_columns_version(dependencies)
+
+        id_set = conn.id_sets.pop(key, None)
+        if id_set is not None:
+            name, total_recs, id_set_version = id_set
+            if id_set_version == version:
+                conn.id_sets[key] = id_set
+                return name, total_recs
+            self._drop_id_set(conn, name)
+
+        conn.id_sets_created += 1
+        name = '__DataGridIds_%d' % (conn.id_sets_created, )
+        # Break ties by the rowid so the order will be stable
+        rowid = literal_column('%s._rowid_' % (self.table.name, ))
+        order_by = list(order_by or []) + [
+            desc(rowid) if params.get('desc', False) else rowid]
+        if table is None:
+            table = self.table
+        sql_str, bind_values = self._get_select_sql(
+            table, [rowid], where=where, order_by=order_by,
+            cache_key=('id_set', where_shape, params.get('order_by', None),
+                       params.get('desc', False), params.get('flat', False)))
+
+        with closing(conn.cursor()) as cursor:
+            cursor.execute(
+                'CREATE TEMP TABLE %s (pos INTEGER PRIMARY KEY, '
+                'rid INTEGER)' % (name, ))
+            sql = 'INSERT INTO temp.%s (rid) %s' % (name, sql_str)
+            logger.debug('SQL:\n%s\nParams: %r', sql, bind_values)
+            try:
+                cursor.execute(sql, bind_values)
+            except sqlite3.OperationalError:
+                # The query got interrupted (e.g. it was cancelled).
+                # Make sure dropping the table will not be interrupted too
+                conn.set_progress_handler(None, 0)
+                self._drop_id_set(conn, name)
+                raise
+            total_recs = cursor.rowcount
+        # Do not hold the read lock on the database
+        conn.commit()
+
+        conn.id_sets[key] = (name, total_recs, version)
+        while len(conn.id_sets) > self.MAX_MATERIALIZED_IDS:
+            old_name = conn.id_sets.popitem(last=False)[1][0]
+            self._drop_id_set(conn, old_name)
+
+        return name, total_recs
+
+    def _drop_id_set(self, conn, name):
+        """Drop a materialized ids temporary table.
+
+        :param conn: an open connection to the database
+        :param str name: the temporary table name
+        """
+        with closing(conn.cursor()) as cursor:
+            cursor.execute('DROP TABLE IF EXISTS temp.%s' % (name, ))
+
+    def _select_id_set_page(self, conn, id_set, page, page_count=1,
+                            columns=None, columns_key=None):
+        """Select a page of records using the materialized ids.
+
+        :param conn: an open connection to the database
+        :param str id_set: the materialized ids temporary table name
+        :param int page: the page to load
+        :param int page_count: how many pages to load, starting at `page`
+        :param list columns: the columns to select, as returned by
+            :meth:`._get_load_columns`, or `None` to select all of them
+        :param tuple columns_key: the key for `columns` returned along
+            with them by :meth:`._get_load_columns`
+        :return: an iterator for the records
+        """
+        ids_table = table_(id_set, column('pos'), column('rid'))
+        rowid = literal_column('%s._rowid_' % (self.table.name, ))
+        sql = select(
+            columns=columns if columns is not None else self.table.columns,
+            whereclause=and_(
+                ids_table.c.pos > bindparam('pos_start'),
+                ids_table.c.pos <= bindparam('pos_end')),
+            from_obj=[ids_table.join(self.table, rowid == ids_table.c.rid)],
+            order_by=[ids_table.c.pos])
+
+        cache_key = ('id_set_page', id_set, columns_key)
+        compiled = self._statements.get(cache_key)
+        if compiled is None:
+            compiled = sql.compile(dialect=_DIALECT).string
+            self._statements[cache_key] = compiled
+
+        start = page * self.MAX_RECS
+        end = start + page_count * self.MAX_RECS
+        logger.debug('SQL:\n%s\nParams: %r', compiled, (start, end))
+        with closing(conn.cursor()) as cursor:
+            cursor.execute(compiled, (start, end))
+            for row in cursor:
+                yield row
 
     def _ensure_primary_key_column(self, conn):
         """Ensure that we know what is the primary key.
@@ -521,11 +2572,12 @@ class SQLiteDataSource(DataSource):
         :rtype: list
         """
         cols = []
-        with closing(sqlite3.connect(self.db_file)) as conn:
+        self._text_columns = []
+        self._like_columns = []
+        with self._connect() as conn:
             has_primary_key = self._ensure_primary_key_column(conn)
 
             with closing(conn.cursor()) as cursor:
-                self._ensure_temp_view(cursor)
                 table_info_query = 'PRAGMA table_info(%s)' % self.table.name
                 cursor.execute(table_info_query)
                 rows = cursor.fetchall()
@@ -572,6 +2624,11 @@ class SQLiteDataSource(DataSource):
 
                     if col_name == self.ID_COLUMN:
                         self.id_column_idx = i
+                        # An INTEGER PRIMARY KEY is an alias to the rowid
+                        self._id_is_rowid = (
+                            not self.query and row[5] == 1 and
+                            row[2].upper() == 'INTEGER' and
+                            sum(1 for r in rows if r[5]) == 1)
                     if col_name == self.PARENT_ID_COLUMN:
                         self.parent_column_idx = i
                     if col_name == self.CHILDREN_LEN_COLUMN:
@@ -582,6 +2639,15 @@ class SQLiteDataSource(DataSource):
                         self.selected_column_idx = i
                         has_selected = True
                         col_dict['transform'] = 'boolean'
+                    if (col_name != self.ID_COLUMN and
+                            not col_name.startswith('__')):
+                        if _has_text_affinity(row[2]):
+                            self._text_columns.append(col_name)
+                        # Columns without a declared type (e.g. the
+                        # expressions on a custom query) may have text
+                        # too, so they are searched using LIKE
+                        if _has_text_affinity(row[2]) or not row[2]:
+                            self._like_columns.append(col_name)
 
                     cols.append(col_dict)
 
@@ -605,90 +2671,101 @@ class SQLiteDataSource(DataSource):
 
         return cols
 
-    def _load_tree_rows(self, conn, where, order_by, parent_id):
+    def _load_tree_rows(self, conn, where, order_by, parent_id,
+                        columns=None, cache_key=None):
         """Load rows as a tree."""
-        if where is not None:
-            # FIXME: If we have a where clause, we cant load the results lazily
-            # because, we don't know if a row's children/grandchildren/etc will
-            # match.  If this optimization (loading the leafs and the necessary
-            # parents until the root) good enough?
-            children = {}
-            node_mapper = {}
+        if columns is None:
+            columns = self.table.columns.values()
 
-            def load_rows(where_):
-                query = self.select(
-                    conn, self.table, columns=self.table.columns,
-                    where=where_, order_by=order_by)
-                for row in query:
-                    row_id = row[self.id_column_idx]
-                    if row_id in node_mapper:
-                        continue
-
-                    c_list = children.setdefault(
-                        row[self.parent_column_idx], [])
-                    node = Node(data=row)
-                    c_list.append(node)
-                    node_mapper[row_id] = node
-
-            load_rows(where)
-            if not children:
-                return
-
-            # Load parents incrementally until we are left with the root
-            while children.keys() != [None]:
-                parents_to_load = []
-                for parent, c_list in children.items():
-                    if parent is None:
-                        continue
-
-                    node = node_mapper.get(parent, None)
-                    if node is None:
-                        parents_to_load.append(parent)
-                        continue
-
-                    node.extend(c_list)
-                    node.children_len = len(node)
-                    del children[parent]
+        if where is not None:
+            # If we have a where clause, we cant load the results lazily
+            # because, we don't know if a row's children/grandchildren/etc
+            # will match. Load the matching rows and all their ancestors
+            # at once, resolving them with a recursive query.
+            id_column = self.table.columns[self.ID_COLUMN]
+            parents = alias(self.table, '__parents')
+            tree = select([id_column], whereclause=where).cte(
+                '__tree', recursive=True)
+            tree = tree.union(select(
+                [parents.c[self.PARENT_ID_COLUMN]],
+                whereclause=and_(
+                    parents.c[self.ID_COLUMN] == tree.c[self.ID_COLUMN],
+                    parents.c[self.PARENT_ID_COLUMN].isnot(None))))
 
-                if parents_to_load:
-                    where = self.table.columns[self.ID_COLUMN].in_(
-                        parents_to_load)
-                    load_rows(where)
+            query = self.select(
+                conn, self.table, columns=columns,
+                where=id_column.in_(select([tree.c[self.ID_COLUMN]])),
+                order_by=order_by,
+                cache_key=cache_key and ('tree_matches', cache_key))
 
-            for node in children[None]:
+            # Assemble the tree. Rows come sorted, so appending them to
+            # their parents' children will keep them sorted too
+            children = {}
+            node_mapper = {}
+            for row in query:
+                node = Node(data=row)
+                node_mapper[row[self.id_column_idx]] = node
+                children.setdefault(
+                    row[self.parent_column_idx], []).append(node)
+
+            roots = children.pop(None, [])
+            for parent, c_list in children.iteritems():
+                node = node_mapper.get(parent, None)
+                if node is None:
+                    # The parent doesn't exist. Show the rows on the root
+                    roots.extend(c_list)
+                    continue
+                node.extend(c_list)
+                node.children_len = len(node)
+
+            for node in roots:
                 yield node
         else:
             # If there's no where clause, we can load the results lazily
-            where = self.table.columns[self.PARENT_ID_COLUMN] == parent_id
-
+            parent_id_param = parent_id
+            if parent_id is not None:
+                parent_id_param = bindparam('parent_id', parent_id)
+            where = (self.table.columns[self.PARENT_ID_COLUMN] ==
+                     parent_id_param)
+
+            self._ensure_parent_index(conn)
+            from_obj = self.table
             if self.CHILDREN_LEN_COLUMN is None:
-                count_table = alias(self.table, '__count')
-                # We could use the comparison between the columns, but that would
-                # make sqlalchemy add self.table in the FROM clause, which
-                # would produce wrong results.
-                count_where = '%s.%s = %s.%s' % (
-                    count_table.name, self.PARENT_ID_COLUMN,
-                    self.table.name, self.ID_COLUMN)
-                count_select = select(
-                    [func.count(1)],
-                    whereclause=count_where, from_obj=[count_table])
-
-                columns = self.table.columns.values()
-                # We have to compile this here or else sqlalchemy would put
-                # this inside the FROM part.
-                columns.append('(%s)' % (_compile(count_select), ))
+                # Count the children of all the rows in this level with
+                # a single grouped aggregate, instead of counting them
+                # for each row with a correlated subquery
+                children = alias(self.table, '__children')
+                level = alias(self.table, '__level')
+                counts = select(
+                    [children.c[self.PARENT_ID_COLUMN].label('parent_id'),
+                     func.count(literal_column('1')).label('children_len')],
+                    whereclause=children.c[self.PARENT_ID_COLUMN].in_(
+                        select([level.c[self.ID_COLUMN]],
+                               whereclause=(
+                                   level.c[self.PARENT_ID_COLUMN] ==
+                                   parent_id_param))),
+                    group_by=[children.c[self.PARENT_ID_COLUMN]],
+                ).alias('__counts')
+                from_obj = self.table.outerjoin(
+                    counts,
+                    counts.c.parent_id == self.table.columns[self.ID_COLUMN])
+
+                columns = list(columns)
+                columns.append(func.coalesce(counts.c.children_len, 0))
                 extra_count_col = True
             else:
-                columns = self.table.columns
                 extra_count_col = False
 
             query = self.select(
-                conn, self.table, columns=columns,
-                where=where, order_by=order_by)
+                conn, from_obj, columns=columns,
+                where=where, order_by=order_by,
+                cache_key=cache_key and (
+                    'tree_level', cache_key, parent_id is None))
 
             for row in query:
                 if extra_count_col:
-                    children_len = row.pop(-1)
+                    children_len = row[-1]
+                    row = row[:-1]
                 else:
                     children_len = row[self.children_len_column_idx]
 
@@ -0,0 +1,374 @@
+"""Worker threads to run data source requests out of the main loop."""
+
+import copy
+import heapq
+import itertools
+import os
+import threading
+import weakref
+
+from gi.repository import GLib
+
+from datagrid_gtk3.db import QueryCancelled
+
+# Request priorities, from the most to the least urgent
+PRIORITY_VISIBLE = 0
+PRIORITY_PREVIEW = 1
+PRIORITY_PREFETCH = 2
+PRIORITY_COUNT = 3
+
+
+class Request(object):
+
+    """A request submitted to a :class:`DataSourceWorker`.
+
+    This works like a future: the result can be waited for by calling
+    :meth:`.result` or received on the main loop by the callbacks
+    added with :meth:`.add_done_callback`.
+
+    :param int priority: the priority of the request, one of the
+        ``PRIORITY_*`` constants
+    :param callable func: the function that will be called to run
+        the request
+    :param tuple args: the arguments to call `func` with
+    :param dict kwargs: the keyword arguments to call `func` with
+    :param bool cancellable: if `func` accepts a ``cancel_event``
+        keyword argument, like :meth:`datagrid_gtk3.db.DataSource.load`
+    """
+
+    def __init__(self, priority, func, args=(), kwargs=None,
+                 cancellable=False):
+        self.priority = priority
+        self.cancellable = cancellable
+
+        self._func = func
+        self._args = args
+        self._kwargs = kwargs or {}
+        self._result = None
+        self._exception = None
+        self._cancelled = False
+        self._callbacks = []
+        self._lock = threading.Lock()
+        self._done_event = threading.Event()
+        # Set to interrupt the running query, be it because the request
+        # got cancelled or because it was preempted by another one
+        self._interrupt_event = threading.Event()
+
+    ###
+    # Public
+    ###
+
+    def cancel(self):
+        """Cancel the request.
+
+        If it is running, its query will be interrupted (when it is
+        cancellable). Its callbacks will not be called after this,
+        even if it finished already, as long as this is called from
+        the main loop.
+
+        :return: `False` if the request had already finished
+        :rtype: bool
+        """
+        with self._lock:
+            finished = self._done_event.is_set()
+            self._cancelled = True
+            self._interrupt_event.set()
+            self._done_event.set()
+            self._callbacks = []
+        return not finished
+
+    def cancelled(self):
+        """Check if the request got cancelled.
+
+        :rtype: bool
+        """
+        return self._cancelled
+
+    def done(self):
+        """Check if the request finished or got cancelled.
+
+        :rtype: bool
+        """
+        return self._done_event.is_set()
+
+    def result(self, timeout=None):
+        """Wait for the request to finish and get its result.
+
+        :param float timeout: the maximum time in seconds to wait,
+            or `None` to wait as long as needed
+        :return: the value returned by the request's function
+        :raise QueryCancelled: if the request got cancelled
+        :raise RuntimeError: if the request did not finish in time
+        :raise Exception: whatever the request's function raised
+        """
+        if not self._done_event.wait(timeout):
+            raise RuntimeError('The request did not finish in time')
+        if self._cancelled:
+            raise QueryCancelled()
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def add_done_callback(self, callback):
+        """Call `callback` on the main loop when the request finishes.
+
+        :param callable callback: a callable that will receive this
+            request as its only argument
+        """
+        with self._lock:
+            if self._cancelled:
+                return
+            if not self._done_event.is_set():
+                self._callbacks.append(callback)
+                return
+
+        GLib.idle_add(self._invoke_callback, callback)
+
+    ###
+    # Private
+    ###
+
+    def _run(self):
+        """Run the request on the worker thread.
+
+        :return: `False` if the request got preempted and needs
+            to be run again later
+        :rtype: bool
+        """
+        kwargs = dict(self._kwargs)
+        if self.cancellable:
+            kwargs['cancel_event'] = self._interrupt_event
+
+        try:
+            self._result = self._func(*self._args, **kwargs)
+        except QueryCancelled:
+            with self._lock:
+                if not self._cancelled:
+                    self._interrupt_event.clear()
+                    return False
+        except Exception as e:
+            self._exception = e
+
+        with self._lock:
+            self._done_event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            GLib.idle_add(self._invoke_callback, callback)
+        return True
+
+    def _interrupt(self):
+        """Interrupt the running query so a more urgent one can run."""
+        with self._lock:
+            if not self._done_event.is_set():
+                self._interrupt_event.set()
+
+    def _invoke_callback(self, callback):
+        """Call the callback, unless the request got cancelled meanwhile."""
+        if not self._cancelled:
+            callback(self)
+        return False
+
+
+class DataSourceWorker(object):
+
+    """A thread running the requests for the data sources of a database.
+
+    The requests run one at a time, the most urgent ones first, so
+    queries don't block the main loop and don't compete with each other
+    for the database. When a request with a priority up to
+    :attr:`.PREEMPT_PRIORITY` gets submitted, a cancellable one that is
+    less urgent will be interrupted and run again after it (e.g. a slow
+    count will not delay the loading of the page being displayed).
+
+    The thread only exists while there are requests to run. Use
+    :meth:`.get_worker` instead of instantiating this directly so
+    the worker will be shared.
+    """
+
+    PREEMPT_PRIORITY = PRIORITY_PREVIEW
+
+    _workers = weakref.WeakValueDictionary()
+    _workers_lock = threading.Lock()
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._queue = []
+        self._counter = itertools.count()
+        self._running = None
+        self._thread = None
+
+    ###
+    # Public
+    ###
+
+    @classmethod
+    def get_worker(cls, data_source):
+        """Get the worker shared by the data sources of the same database.
+
+        :param data_source: the data source that will submit requests
+        :type data_source: :class:`datagrid_gtk3.db.DataSource`
+        :return: the worker
+        :rtype: :class:`DataSourceWorker`
+        """
+        key = getattr(data_source, 'db_file', None)
+        if key and key != ':memory:':
+            key = os.path.realpath(key)
+        else:
+            key = id(data_source)
+
+        with cls._workers_lock:
+            worker = cls._workers.get(key)
+            if worker is None:
+                worker = cls()
+                cls._workers[key] = worker
+
+        return worker
+
+    def submit(self, priority, func, args=(), kwargs=None,
+               cancellable=False, callback=None):
+        """Submit a request to be run on the worker thread.
+
+        :param int priority: the priority of the request, one of the
+            ``PRIORITY_*`` constants
+        :param callable func: the function to run
+        :param tuple args: the arguments to call `func` with
+        :param dict kwargs: the keyword arguments to call `func` with
+        :param bool cancellable: if `func` accepts a ``cancel_event``
+            keyword argument, like :meth:`datagrid_gtk3.db.DataSource.load`
+        :param callable callback: a callable that will receive the
+            request on the main loop when it finishes.
+            See :meth:`Request.add_done_callback`
+        :return: the submitted request
+        :rtype: :class:`Request`
+        """
+        request = Request(priority, func, args, kwargs,
+                          cancellable=cancellable)
+        if callback is not None:
+            request.add_done_callback(callback)
+
+        with self._cond:
+            heapq.heappush(
+                self._queue, (priority, next(self._counter), request))
+            running = self._running
+            if (running is not None and running.cancellable and
+                    priority <= self.PREEMPT_PRIORITY and
+                    priority < running.priority):
+                running._interrupt()
+
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+
+        return request
+
+    def load(self, data_source, params, priority=PRIORITY_VISIBLE,
+             callback=None):
+        """Load records on the worker thread.
+
+        The records are loaded with
+        :meth:`datagrid_gtk3.db.DataSource.load_counted`, so the data
+        source's ``total_recs`` is not changed from the worker thread.
+        The request's result is the loaded rows.
+
+        :param data_source: the data source to load the records from
+        :type data_source: :class:`datagrid_gtk3.db.DataSource`
+        :param dict params: the params to pass to
+            :meth:`datagrid_gtk3.db.DataSource.load`
+        :param int priority: the priority of the request
+        :param callable callback: a callable that will receive the
+            request on the main loop when it finishes
+        :return: the submitted request
+        :rtype: :class:`Request`
+        """
+        def load(params, cancel_event=None):
+            rows, _ = data_source.load_counted(
+                params, cancel_event=cancel_event)
+            return rows
+
+        return self.submit(
+            priority, load, (copy.deepcopy(params), ),
+            cancellable=True, callback=callback)
+
+    def count(self, data_source, params, time_budget=None,
+              priority=PRIORITY_COUNT, callback=None):
+        """Count records on the worker thread.
+
+        :param data_source: the data source to count the records from
+        :type data_source: :class:`datagrid_gtk3.db.sqlite.SQLiteDataSource`
+        :param dict params: the params to pass to its ``count`` method
+        :param float time_budget: the maximum time in seconds to
+            spend counting the records
+        :param int priority: the priority of the request
+        :param callable callback: a callable that will receive the
+            request on the main loop when it finishes
+        :return: the submitted request
+        :rtype: :class:`Request`
+        """
+        return self.submit(
+            priority, data_source.count,
+            (copy.deepcopy(params), time_budget),
+            cancellable=True, callback=callback)
+
+    def update(self, data_source, params, ids=None,
+               priority=PRIORITY_VISIBLE, callback=None):
+        """Update records on the worker thread.
+
+        :param data_source: the data source to update the records on
+        :type data_source: :class:`datagrid_gtk3.db.DataSource`
+        :param dict params: the columns to update mapped to their values
+        :param list ids: the ids of the records to update, or `None`
+            to update all of them
+        :param int priority: the priority of the request
+        :param callable callback: a callable that will receive the
+            request on the main loop when it finishes
+        :return: the submitted request
+        :rtype: :class:`Request`
+        """
+        return self.submit(
+            priority, data_source.update, (dict(params), ids),
+            callback=callback)
+
+    def get_single_record(self, data_source, record_id,
+                          priority=PRIORITY_PREVIEW, callback=None):
+        """Get a single record on the worker thread.
+
+        :param data_source: the data source to get the record from
+        :type data_source: :class:`datagrid_gtk3.db.DataSource`
+        :param object record_id: the id of the record
+        :param int priority: the priority of the request
+        :param callable callback: a callable that will receive the
+            request on the main loop when it finishes
+        :return: the submitted request
+        :rtype: :class:`Request`
+        """
+        return self.submit(
+            priority, data_source.get_single_record, (record_id, ),
+            callback=callback)
+
+    ###
+    # Private
+    ###
+
+    def _run(self):
+        """Run the submitted requests until there are no more of them."""
+        while True:
+            with self._cond:
+                request = None
+                while self._queue and request is None:
+                    request = heapq.heappop(self._queue)[2]
+                    if request.cancelled():
+                        request = None
+                if request is None:
+                    self._thread = None
+                    return
+                self._running = request
+
+            finished = request._run()
+
+            with self._cond:
+                self._running = None
+                if not finished:
+                    heapq.heappush(
+                        self._queue,
+                        (request.priority, next(self._counter), request))
@@ -3,9 +3,11 @@
 
 """Data grid test cases."""
 
+import Queue
 import contextlib
 import datetime
 import os
+import threading
 import unittest
 
 from gi.repository import (
@@ -176,13 +178,194 @@ class DataGridControllerTest(unittest.TestCase):
     def test_on_scrolled(self):
         """Test that more results are loaded after scrolling to the bottom."""
         vscroll = self.datagrid_controller.vscroll
+        loaded = threading.Event()
 
-        original_add_rows = self.model.add_rows
-        with mock.patch.object(self.model, 'add_rows') as add_rows:
-            add_rows.side_effect = original_add_rows
+        def idle_add(func, *args):
+            func(*args)
+            loaded.set()
+
+        with mock.patch('datagrid_gtk3.ui.grid.GLib.idle_add') as idle_add_:
+            idle_add_.side_effect = idle_add
             vscroll.set_value(vscroll.get_upper() - vscroll.get_page_size())
             vscroll.emit('value-changed')
-            add_rows.assert_called_once_with()
+            self.assertTrue(loaded.wait(5))
+        self.assertEqual(len(self.model.rows), 4)
+
+    def test_count_on_thread(self):
+        """Test that the records are counted after the first page loads."""
+        counted = threading.Event()
+
+        def idle_add(func, *args):
+            func(*args)
+            counted.set()
+
+        self.model.count_on_thread = True
+        with mock.patch('datagrid_gtk3.ui.grid.GLib.idle_add') as idle_add_:
+            idle_add_.side_effect = idle_add
+            self.model.refresh()
+            self.assertEqual(self.model.total_recs, 2)
+            self.assertTrue(counted.wait(5))
+
+        self.assertEqual(self.model.total_recs, 4)
+        self.assertTrue(self.model.total_recs_exact)
+        self.assertEqual(
+            self.datagrid_controller.container.label_num_recs.get_text(),
+            '4 records')
+
+    def test_get_row_by_id(self):
+        """Test that only the pages up to the row are loaded."""
+        self.model.refresh()
+        original_load = self.datasource.load
+        with mock.patch.object(self.datasource, 'load') as load:
+            load.side_effect = original_load
+            row = self.model.get_row_by_id(4, load_rows=True)
+            self.assertEqual(load.call_count, 1)
+        self.assertEqual(row.data[0], 4)
+        self.assertEqual(row.path, (3, ))
+
+        # The data source can't tell where a missing row is, so
+        # everything gets loaded looking for it
+        self.assertIsNone(self.model.get_row_by_id(5, load_rows=True))
+        self.assertEqual(len(self.model.rows), 4)
+        self.assertEqual(
+            list(self.model.iter_column_values(0)), [1, 2, 3, 4])
+
+    def test_prefetch_rows(self):
+        """Test that the next page is loaded on a thread before needed."""
+        prefetched = threading.Event()
+
+        def idle_add(func, *args):
+            func(*args)
+            # The deferred count may finish before the prefetch
+            if self.model._prefetched:
+                prefetched.set()
+
+        self.model.visible_range = ((0, ), (1, ))
+        with mock.patch('datagrid_gtk3.ui.grid.GLib.idle_add') as idle_add_:
+            idle_add_.side_effect = idle_add
+            self.model.prefetch_rows()
+            self.assertTrue(prefetched.wait(5))
+
+        with mock.patch.object(self.datasource, 'load') as load:
+            self.assertTrue(self.model.add_rows())
+            self.assertFalse(load.called)
+        self.assertEqual(len(self.model.rows), 4)
+
+    def test_virtual_rows(self):
+        """Test that the virtual rows are loaded as they get displayed."""
+        loaded = Queue.Queue()
+        self.model.virtual_rows = True
+        self.model.max_resident_rows = 2
+        self.model.refresh()
+        self.assertEqual(self.model.iter_n_children(None), 4)
+
+        # Getting the rows doesn't load their pages (the view may get
+        # all of them), only the visible ones get loaded
+        with mock.patch.object(self.model.worker, 'load') as load:
+            for row in xrange(4):
+                itr = self.model.get_iter((row, ))
+                self.assertFalse(self.model.iter_has_child(itr))
+            # A placeholder is displayed while the page is not loaded
+            self.assertEqual(self.model.get_value(itr, 2), '')
+            self.assertFalse(load.called)
+            # and there's no record to change on it
+            with mock.patch.object(self.datasource, 'update') as update:
+                self.model.set_value(itr, 2, 'Dee')
+                self.assertFalse(update.called)
+
+        self.model.visible_range = ((2, ), (3, ))
+        with mock.patch('datagrid_gtk3.ui.grid.GLib.idle_add') as idle_add:
+            idle_add.side_effect = lambda func, *args: loaded.put((func, args))
+            self.model.prefetch_rows()
+            func, args = loaded.get(timeout=5)
+            func(*args)
+
+        self.assertEqual(self.model.get_value(itr, 0), 4)
+        self.assertEqual(self.model.get_row_by_id(4).path, (3, ))
+        self.assertTrue(self.model.update_loaded_rows({'age': 99}, [4]))
+        self.assertEqual(self.model.get_row_by_id(4).data[3], 99)
+        # Only the values on the loaded pages are iterated
+        self.assertEqual(list(self.model.iter_column_values(0)), [3, 4])
+        # The first page is not kept since it is not visible
+        self.assertIsNone(self.model.get_row_by_id(1))
+        self.assertEqual(
+            self.model.get_row_by_id(1, load_rows=True).path, (0, ))
+
+    def test_evict_pages(self):
+        """Test that the appended pages farthest from view get evicted."""
+        loaded = Queue.Queue()
+        self.model.max_resident_rows = 2
+        self.model.visible_range = ((2, ), (3, ))
+        self.assertTrue(self.model.add_rows())
+        self.assertEqual(
+            self.model.memory_stats,
+            {'resident_rows': 2, 'max_resident_rows': 2, 'evictions': 1})
+        self.assertEqual(self.model.iter_n_children(None), 4)
+        self.assertNotIn(1, self.model.row_id_mapper)
+        # A placeholder is displayed while the page is evicted
+        itr = self.model.get_iter((0, ))
+        self.assertEqual(self.model.get_value(itr, 2), '')
+
+        # The page is loaded again when it gets visible
+        self.model.visible_range = ((0, ), (1, ))
+        with mock.patch('datagrid_gtk3.ui.grid.GLib.idle_add') as idle_add:
+            idle_add.side_effect = lambda func, *args: loaded.put((func, args))
+            self.model.prefetch_rows()
+            while 0 in self.model._evicted_pages:
+                func, args = loaded.get(timeout=5)
+                func(*args)
+        self.assertEqual(self.model.get_value(itr, 0), 1)
+        self.assertNotIn(4, self.model.row_id_mapper)
+
+        # or right away when it is needed
+        self.assertEqual(
+            self.model.get_row_by_id(4, load_rows=True).path, (3, ))
+        self.assertEqual(self.model.resident_rows, 2)
+
+    def test_search_on_thread(self):
+        """Test that only the latest search results are displayed."""
+        controller = self.datagrid_controller
+        entry = controller.container.entry_search
+        loaded = Queue.Queue()
+
+        def idle_add(func, *args):
+            # Ignore anything else (e.g. the records being counted)
+            callback = getattr(args[0], 'func', None)
+            if callback == controller._on_search_loaded:
+                loaded.put((func, args))
+
+        total_recs = self.datasource.total_recs
+        with mock.patch('datagrid_gtk3.ui.grid.GLib.idle_add') as idle_add_:
+            idle_add_.side_effect = idle_add
+            entry.set_text('gold')
+            controller.on_search_clicked(entry)
+            stale = loaded.get(timeout=5)
+            entry.set_text('austin')
+            controller.on_search_clicked(entry)
+            latest = loaded.get(timeout=5)
+            # The records being displayed are still the same, so the
+            # searches must not change their count
+            self.assertEqual(self.datasource.total_recs, total_recs)
+
+            for func, args in [latest, stale]:
+                func(*args)
+        self.assertEqual(
+            [row.data[2] for row in self.model.rows], ['Austin'])
+
+    def test_search_changed(self):
+        """Test that the search waits for the user to stop typing."""
+        controller = self.datagrid_controller
+        entry = controller.container.entry_search
+        with mock.patch('datagrid_gtk3.ui.grid.GLib') as glib:
+            glib.timeout_add.side_effect = [1, 2]
+            controller.on_search_changed(entry)
+            controller.on_search_changed(entry)
+            glib.source_remove.assert_called_once_with(1)
+
+            callback = glib.timeout_add.call_args[0][1]
+            with mock.patch.object(controller, 'on_search_clicked') as search:
+                self.assertFalse(callback())
+                search.assert_called_once_with(entry)
 
 
 class DataGridModelTreeTest(unittest.TestCase):
@@ -243,6 +426,74 @@ class DataGridModelTreeTest(unittest.TestCase):
             ['file-1-0-0'])
         self.assertEqual(self.model.rows[3][2].path, (3, 2))
 
+    def test_evict_collapsed_rows(self):
+        """Test that the children of collapsed rows get evicted."""
+        self.model.max_resident_rows = 7
+        self.model.add_rows(parent_node=self.model.rows[2])
+        self.model.add_rows(parent_node=self.model.rows[3])
+        self.assertEqual(self.model.resident_rows, 9)
+
+        self.model.set_row_expanded(Gtk.TreePath((3, )), False)
+        self.model.set_row_expanded(Gtk.TreePath((2, )), False)
+        self.assertEqual(
+            self.model.memory_stats,
+            {'resident_rows': 6, 'max_resident_rows': 7, 'evictions': 1})
+        self.assertEqual(len(self.model.rows[3]), 0)
+        self.assertNotIn('file-1-0', self.model.row_id_mapper)
+        self.assertEqual(len(self.model.rows[2]), 2)
+
+        # They are loaded again when needed, evicting the other ones
+        self.assertEqual(
+            self.model.get_value(self.model.get_iter((3, 0)), 0), 'file-1-0')
+        self.assertEqual(
+            self.model.memory_stats,
+            {'resident_rows': 7, 'max_resident_rows': 7, 'evictions': 2})
+        self.assertEqual(len(self.model.rows[2]), 0)
+
+    def test_get_row_by_id(self):
+        """Test that only the row's ancestors children are loaded."""
+        row = self.model.get_row_by_id('file-1-0-0', load_rows=True)
+        self.assertEqual(row.path, (3, 2, 0))
+        self.assertFalse(self.model.rows[2].is_children_loaded())
+        self.assertEqual(
+            self.datasource.get_ancestor_ids('file-1-0-0'),
+            ['folder-1', 'folder-1-0'])
+        self.assertIsNone(self.datasource.get_ancestor_ids('file-9'))
+
+    def test_formatted_cache(self):
+        """Test that the formatted values are cached until they change."""
+        itr = self.model.get_iter((0, ))
+        column = self.datasource.columns_idx['filename']
+        self.assertEqual(self.model.get_value(itr, column), 'file-0')
+        self.assertEqual(self.model.get_value(itr, column), 'file-0')
+        self.assertEqual(self.model.formatted_cache_stats['hits'], 1)
+
+        self.model.update_loaded_rows({'filename': 'file-y'}, ['file-0'])
+        self.assertEqual(self.model.get_value(itr, column), 'file-y')
+        self.assertEqual(
+            self.model.formatted_cache_stats,
+            {'hits': 1, 'misses': 2, 'size': 1, 'max_size': 10000})
+
+        self.model.refresh()
+        self.assertEqual(self.model.formatted_cache_stats['size'], 0)
+
+    def test_hierarchy_filtered(self):
+        """Test that the matching rows are loaded with their ancestors."""
+        self.model.active_params['where'] = {
+            'search': {'param': '-0-0', 'operator': '='}}
+        self.model.refresh()
+
+        self.assertEqual(
+            [row.data[0] for row in self.model.rows],
+            ['folder-0', 'folder-1'])
+        self.assertEqual(
+            [row.data[0] for row in self.model.rows[0]], ['file-0-0'])
+        self.assertEqual(
+            [row.data[0] for row in self.model.rows[1]], ['folder-1-0'])
+        self.assertEqual(
+            [row.data[0] for row in self.model.rows[1][0]], ['file-1-0-0'])
+        self.assertTrue(self.model.rows.is_children_loaded(recursive=True))
+
     def test_iter_rows(self):
         """Test that iter rows will load database rows as required."""
         self.assertNotEqual(
@@ -681,6 +932,15 @@ class TransformationsTest(unittest.TestCase):
         finally:
             transformations.unregister_transformer('test')
 
+    def test_compiled_formatter(self):
+        """The transformer is resolved once, when the columns are set."""
+        with mock.patch('datagrid_gtk3.ui.grid.get_transformer') as get:
+            get.return_value = lambda value, options=None: value * 2
+            self.assertEqual(self._transform('test', 'x'), 'xx')
+            self.assertEqual(
+                self.datagrid_model.get_formatted_value('y', 0), 'yy')
+            get.assert_called_once_with('test')
+
     def _transform(self, transform_type, value, transform_options=None):
         self.datagrid_model.columns = [
             {'name': transform_type,
@@ -0,0 +1,40 @@
+"""Database package test cases."""
+
+import array
+import unittest
+
+from datagrid_gtk3.db import ColumnarPage
+
+
+class ColumnarPageTest(unittest.TestCase):
+
+    """Tests for :class:`datagrid_gtk3.db.ColumnarPage`."""
+
+    def setUp(self):  # noqa
+        """Create the page."""
+        self.page = ColumnarPage([
+            (1, u'Dee', 30, 1.5),
+            (2, u'Steve', None, 2.5),
+        ])
+
+    def test_columns(self):
+        """Numeric columns are stored on typed arrays when possible."""
+        self.assertEqual(len(self.page), 2)
+        self.assertIsInstance(self.page.get_column(0), array.array)
+        self.assertNotIsInstance(self.page.get_column(1), array.array)
+        self.assertNotIsInstance(self.page.get_column(2), array.array)
+        self.assertEqual(self.page.get_column(3), array.array('d', [1.5, 2.5]))
+
+        self.assertEqual(self.page.get_value(1, 1), u'Steve')
+        self.assertEqual(self.page.get_row(0), (1, u'Dee', 30, 1.5))
+        self.assertEqual(self.page.find(0, 2), 1)
+        self.assertIsNone(self.page.find(0, 3))
+        self.assertEqual(len(ColumnarPage([])), 0)
+
+    def test_set_value(self):
+        """Values can be changed, even if they don't fit the arrays."""
+        self.page.set_value(0, 1, u'Monica')
+        self.page.set_value(1, 0, 5)
+        self.page.set_value(0, 3, None)
+        self.assertEqual(self.page.get_row(0), (1, u'Monica', 30, None))
+        self.assertEqual(self.page.get_row(1), (5, u'Steve', None, 2.5))
@@ -1,9 +1,14 @@
 import contextlib
+import itertools
 import os
 import sqlite3
+import threading
 import unittest
 
+import mock
+
 from datagrid_gtk3.tests.data import create_db, TEST_DATA
+from datagrid_gtk3.db import QueryCancelled
 from datagrid_gtk3.db.sqlite import SQLiteDataSource
 
 
@@ -38,6 +43,20 @@ class SQLiteDataSourceTest(unittest.TestCase):
         self.assertEqual(len(rows), 2)
         self.assertEqual(self.datasource.total_recs, 4)
 
+    def test_load_counted(self):
+        """Load records along with their count, without changing total."""
+        self.datasource.load()
+        param = {'where': {'search': {'param': 'gold'}}}
+        rows, total_recs = self.datasource.load_counted(param)
+        self.assertEqual([row.data[0] for row in rows], [3, 4])
+        self.assertEqual(total_recs, 2)
+        self.assertEqual(self.datasource.total_recs, 4)
+
+        rows, total_recs = self.datasource.load_counted(
+            dict(param, defer_count=True))
+        self.assertIsNone(total_recs)
+        self.assertEqual(self.datasource.total_recs, 4)
+
     def test_load_with_params(self):
         """Filter and order records."""
         param = {
@@ -68,6 +87,114 @@ class SQLiteDataSourceTest(unittest.TestCase):
             {('Oscar', 'Goldman'), ('Monica', 'Goldman')},
             {(row.data[1], row.data[2]) for row in rows})
 
+    def test_build_search_index(self):
+        """Search records using a FTS5 table, sorting them by rank."""
+        self.datasource.update({'last_name': 'Goldman Goldman'}, [4])
+        other = SQLiteDataSource(self.db_file, table=self.table)
+        built = []
+        other.connect('search-index-built', built.append)
+        with mock.patch('datagrid_gtk3.db.sqlite.GLib.idle_add') as idle_add:
+            self.datasource.SEARCH_INDEX_BATCH_SIZE = 3
+            self.datasource.build_search_index().join()
+        self.assertEqual(
+            [call[0][1:] for call in idle_add.call_args_list],
+            [('search-index-progress', 0.75),
+             ('search-index-progress', 1.0),
+             ('people_search', )])
+        # The data sources only start using it on the main loop
+        self.assertIsNone(other.search_table)
+        for call in idle_add.call_args_list:
+            call[0][0](*call[0][1:])
+        self.assertEqual(built, [other])
+        self.assertEqual(self.datasource.search_table, 'people_search')
+        self.assertEqual(other.search_table, 'people_search')
+        self.assertIsNone(self.datasource.build_search_index())
+
+        param = {'where': {'search': {'param': 'gold'}}}
+        rows = self.datasource.load(param)
+        self.assertEqual([row.data[0] for row in rows], [4, 3])
+        self.assertEqual(self.datasource.total_recs, 2)
+        param['order_by'] = '__id'
+        rows = self.datasource.load(param)
+        self.assertEqual([row.data[0] for row in rows], [3, 4])
+
+        # The triggers keep the search table updated
+        self.datasource.update({'first_name': 'Goldie'}, [1])
+        self.datasource.update({'__selected': True}, [1])
+        rows = self.datasource.load(param)
+        self.assertEqual([row.data[0] for row in rows], [1, 3])
+        self.assertEqual(self.datasource.total_recs, 3)
+
+        # The text typed on the search entry is an UTF-8 encoded str
+        self.datasource.update({'first_name': u'Jos\xe9'}, [2])
+        param = {'where': {'search': {'param': 'jos\xc3\xa9'}}}
+        rows = self.datasource.load(param)
+        self.assertEqual([row.data[0] for row in rows], [2])
+
+    def test_build_substring_index(self):
+        """Search substrings of the text columns using trigrams."""
+        with mock.patch('datagrid_gtk3.db.sqlite.GLib.idle_add') as idle_add:
+            self.datasource.build_substring_index().join()
+        for call in idle_add.call_args_list:
+            call[0][0](*call[0][1:])
+        self.assertEqual(self.datasource.substring_table, 'people_substr')
+
+        self.datasource.update({'first_name': u'Jos\xe9'}, [2])
+        # The text typed on the search entry is an UTF-8 encoded str.
+        # The last search has only 2 characters, so it uses LIKE
+        for search, expected_ids in [('OLDM', [3, 4]),
+                                     ('ld', [3, 4]),
+                                     ('35', []),
+                                     ('os\xc3\xa9', [2]),
+                                     ('s\xc3\xa9', [2])]:
+            param = {'where': {'search': {'param': search}}}
+            rows = self.datasource.load(param)
+            self.assertEqual([row.data[0] for row in rows], expected_ids)
+
+        # The records inserted afterwards are searchable too
+        with self.datasource._connect() as conn:
+            conn.execute(
+                "INSERT INTO people (first_name, last_name) "
+                "VALUES ('Rudy', 'Wells')")
+            conn.commit()
+        rows = self.datasource.load({'where': {'search': {'param': 'ell'}}})
+        self.assertEqual([row.data[0] for row in rows], [5])
+
+    def test_refine_search(self):
+        """Search over the results of the search being refined."""
+        self.datasource.REFINE_SEARCHES = True
+        params = {'where': {'search': {'param': 'man'}}, 'defer_count': True}
+        rows = self.datasource.load(params)
+        self.assertEqual([row.data[0] for row in rows], [3, 4])
+        self.assertEqual(self.datasource.total_recs, 2)
+
+        params['where']['search']['param'] = 'dman'
+        params['where']['age'] = {'operator': '>', 'param': 45}
+        get_select_sql = self.datasource._get_select_sql
+        with mock.patch.object(self.datasource, '_get_select_sql') as get_sql:
+            get_sql.side_effect = get_select_sql
+            rows = self.datasource.load(params)
+            self.assertEqual(
+                get_sql.call_args_list[0][1]['cache_key'],
+                ('search_set', mock.ANY, True))
+        self.assertEqual([row.data[0] for row in rows], [3])
+        self.assertEqual(self.datasource.total_recs, 1)
+
+        # Updating the records invalidates the results
+        self.datasource.update({'last_name': 'Goldman'}, [1])
+        self.datasource.update({'age': 60}, [1])
+        rows = self.datasource.load(params)
+        self.assertEqual([row.data[0] for row in rows], [1, 3])
+
+        is_refinement = self.datasource._is_refinement
+        old_where = {'age': {'operator': 'range', 'param': (30, 40)}}
+        self.assertTrue(is_refinement(
+            old_where, {'age': {'operator': 'range', 'param': (32, 40)}}))
+        self.assertFalse(is_refinement(
+            old_where, {'age': {'operator': 'range', 'param': (20, 40)}}))
+        self.assertFalse(is_refinement(
+            {'search': {'param': 'man'}}, {'search': {'param': 'ma'}}))
+
     def test_load_paging(self):
         """Load first and second pages of records."""
         self.datasource.load()  # initial load is always without paging
@@ -75,6 +202,174 @@ class SQLiteDataSourceTest(unittest.TestCase):
         self.assertEqual(len(rows), 2)
         self.assertEqual(rows[0].data[2], 'Goldman')
 
+    def test_load_defer_count(self):
+        """Load the first page without counting the records."""
+        rows = self.datasource.load({'defer_count': True})
+        self.assertEqual(len(rows), 2)
+        self.assertIsNone(self.datasource.total_recs)
+        self.assertEqual(self.datasource.count(), (4, True))
+
+        # The total is known when all records fit in the first page
+        param = {
+            'where': {'age': {'param': 40, 'operator': '>'}},
+            'defer_count': True,
+        }
+        rows = self.datasource.load(param)
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(self.datasource.total_recs, 1)
+
+    def test_load_cancelled(self):
+        """Interrupt loading the records when the event gets set."""
+        self.datasource.CANCEL_CHECK_INTERVAL = 1
+        self.datasource.MATERIALIZE_IDS = True
+        params = {'order_by': 'age'}
+        cancel_event = mock.Mock()
+        cancel_event.is_set.side_effect = itertools.chain(
+            [False], itertools.repeat(True))
+        self.assertRaises(
+            QueryCancelled, self.datasource.load, params, cancel_event)
+        self.assertRaises(
+            QueryCancelled, self.datasource.count, params, 60, cancel_event)
+
+        cancel_event = threading.Event()
+        rows = self.datasource.load(params, cancel_event)
+        self.assertEqual([row.data[0] for row in rows], [1, 2])
+        cancel_event.set()
+        self.assertRaises(
+            QueryCancelled, self.datasource.load, params, cancel_event)
+
+        # The interrupted query did not leave a table behind
+        with self.datasource._connect() as conn:
+            tables = conn.execute(
+                'SELECT name FROM sqlite_temp_master').fetchall()
+        self.assertEqual(len(tables), 1)
+
+    def test_count_time_budget(self):
+        """Estimate the number of records when counting takes too long."""
+        self.datasource.COUNT_PROGRESS_INTERVAL = 1
+        self.assertEqual(self.datasource.count(time_budget=-1), (None, False))
+
+        with self.datasource._connect() as conn:
+            conn.execute('ANALYZE')
+        self.assertEqual(self.datasource.count(time_budget=-1), (4, False))
+        self.assertEqual(self.datasource.count(time_budget=60), (4, True))
+
+    def test_load_paging_seek(self):
+        """Load pages after the first one using keyset pagination."""
+        for desc, expected_ids in [(False, [1, 2, 3, 4]),
+                                   (True, [4, 3, 2, 1])]:
+            params = {'order_by': '__id', 'desc': desc}
+            ids = [row.data[0] for row in self.datasource.load(params)]
+            params['page'] = 1
+            with mock.patch.object(self.datasource, 'select') as select:
+                select.side_effect = lambda *args, **kwargs: iter([])
+                self.datasource.load(params)
+                self.assertIsNone(select.call_args[1]['offset'])
+
+            ids.extend(row.data[0] for row in self.datasource.load(params))
+            self.assertEqual(ids, expected_ids)
+
+    def test_load_materialized_ids(self):
+        """Load pages from the materialized ids of the records."""
+        self.datasource.MATERIALIZE_IDS = True
+        params = {'order_by': 'age', 'desc': True}
+        rows = self.datasource.load(params)
+        self.assertEqual(self.datasource.total_recs, 4)
+        params['page'] = 1
+        rows.extend(self.datasource.load(params))
+        self.assertEqual([row.data[0] for row in rows], [3, 4, 2, 1])
+
+        with self.datasource._connect() as conn:
+            self.assertEqual(len(conn.id_sets), 1)
+
+        # Changing a column the records are sorted by invalidates them
+        self.datasource.update({'age': 99}, [1])
+        params['page'] = 0
+        rows = self.datasource.load(params)
+        self.assertEqual([row.data[0] for row in rows], [1, 3])
+        with self.datasource._connect() as conn:
+            self.assertEqual(len(conn.id_sets), 1)
+
+    def test_load_columns(self):
+        """Load only the values of the given columns."""
+        params = {'order_by': 'age', 'desc': True, 'columns': ['last_name']}
+        rows = self.datasource.load(params)
+        self.assertEqual(
+            [row.data for row in rows],
+            [(3, None, 'Goldman', None, None, None, None),
+             (4, None, 'Goldman', None, None, None, None)])
+
+        self.datasource.MATERIALIZE_IDS = True
+        params['page'] = 1
+        rows = self.datasource.load(params)
+        self.assertEqual(
+            [row.data for row in rows],
+            [(2, None, 'Austin', None, None, None, None),
+             (1, None, 'Timberlake', None, None, None, None)])
+
+        # The record still has all the values
+        self.assertEqual(self.datasource.get_single_record(1)[1], 'Dee')
+
+    def test_load_truncate(self):
+        """Load only the first characters of the text values."""
+        params = {'order_by': 'age', 'truncate': 4}
+        rows = self.datasource.load(params)
+        self.assertEqual(
+            [row.data[:4] for row in rows],
+            [(1, 'Dee', 'Timb', 30), (2, 'Stev', 'Aust', 35)])
+        # The image paths are not displayed as text
+        self.assertEqual(rows[0].data[5], TEST_DATA[self.table]['data'][0][5])
+
+        # The truncated page statement is compiled only once
+        for age in [30, 40]:
+            params['where'] = {'age': {'param': age, 'operator': '>'}}
+            stats = self.datasource.statement_cache_stats
+            rows = self.datasource.load(params)
+        self.assertEqual([row.data[:4] for row in rows],
+                         [(3, 'Osca', 'Gold', 50)])
+        self.assertEqual(
+            self.datasource.statement_cache_stats['misses'], stats['misses'])
+
+    def test_result_cache(self):
+        """Results are cached until the database gets modified."""
+        with mock.patch.object(SQLiteDataSource, 'RESULT_CACHE_SIZE', 2 ** 20):
+            datasource = SQLiteDataSource(self.db_file, table=self.table)
+        datasource.MAX_RECS = 2
+        params = {'order_by': 'age'}
+        rows = datasource.load(params)
+        self.assertEqual([row.data[0] for row in rows], [1, 2])
+        # Changing the loaded rows does not change the cached ones
+        rows[0].set_value(0, None)
+
+        # Sorting does not change the number of records, so it is not
+        # counted again when only the sort changes
+        with mock.patch.object(datasource, '_count') as count:
+            datasource.load(dict(params, desc=True))
+            self.assertFalse(count.called)
+        with mock.patch.object(datasource, 'select') as select:
+            rows = datasource.load(params)
+            self.assertFalse(select.called)
+        self.assertEqual([row.data[0] for row in rows], [1, 2])
+        self.assertEqual(datasource.total_recs, 4)
+        self.assertEqual(datasource.result_cache_stats['hits'], 2)
+
+        # Updated by another data source
+        self.datasource.update({'age': 99}, [1])
+        rows = datasource.load(params)
+        self.assertEqual([row.data[0] for row in rows], [2, 4])
+
+        # Modified by another process
+        conn = sqlite3.connect(self.db_file)
+        conn.execute('DELETE FROM people WHERE __id = 2')
+        conn.commit()
+        conn.close()
+        rows = datasource.load(params)
+        self.assertEqual([row.data[0] for row in rows], [4, 3])
+        self.assertEqual(datasource.total_recs, 3)
+
+        datasource.do_rows_changed({'age': 99}, None)
+        self.assertEqual(datasource.result_cache_stats['size'], 0)
+
     def test_update(self):
         """Update __selected in first record in data set."""
         self.datasource.update({'__selected': True}, [1])
@@ -82,6 +377,49 @@ class SQLiteDataSourceTest(unittest.TestCase):
         rows = self.datasource.load()
         self.assertEqual(rows[0].data[0], 1)
 
+    def test_update_many(self):
+        """Update several records in a single statement."""
+        self.datasource.update({'__selected': True}, [1, 3, 4])
+        param = {'where': {'__selected': {'param': 1, 'operator': '='}}}
+        rows = self.datasource.load(param)
+        self.assertEqual([row.data[0] for row in rows], [1, 3])
+        self.assertEqual(self.datasource.total_recs, 3)
+
+        # Any iterable of ids works, and the other data sources are
+        # told which ones changed
+        other = SQLiteDataSource(self.db_file, table=self.table)
+        changes = []
+        other.connect(
+            'rows-changed', lambda ds, params, ids: changes.append(ids))
+        with mock.patch('datagrid_gtk3.db.sqlite.GLib.idle_add') as idle_add:
+            self.datasource.update({'__selected': False}, {3})
+            self.datasource.update(
+                {'__selected': False}, (id_ for id_ in [1, 4]))
+        for call in idle_add.call_args_list:
+            call[0][0](*call[0][1:])
+        self.assertEqual(self.datasource.get_all_record_ids(param), [])
+        self.assertEqual(changes, [[3], [1, 4]])
+
+    def test_update_by_filter(self):
+        """Update the records matching a filter without loading ids."""
+        other = SQLiteDataSource(self.db_file, table=self.table)
+        other.load()
+        changes = []
+        other.connect(
+            'rows-changed', lambda ds, params, ids: changes.append(ids))
+
+        param = {'where': {'age': {'param': 30, 'operator': '>'}}}
+        with mock.patch('datagrid_gtk3.db.sqlite.GLib.idle_add') as idle_add:
+            self.datasource.update_by_filter({'__selected': True}, param)
+        # The other data sources are notified on the main loop
+        self.assertEqual(changes, [])
+        for call in idle_add.call_args_list:
+            call[0][0](*call[0][1:])
+        ids = self.datasource.get_all_record_ids(
+            {'where': {'__selected': {'param': 1, 'operator': '='}}})
+        self.assertEqual(ids, [2, 3, 4])
+        self.assertEqual(changes, [None])
+
     def test_get_all_record_ids(self):
         """Get all record ids for a particular query."""
         param = {
@@ -94,6 +432,25 @@ class SQLiteDataSourceTest(unittest.TestCase):
         ids = self.datasource.get_all_record_ids(param)
         self.assertEqual(ids, [2, 3, 4])
 
+    def test_get_row_position(self):
+        """Get the position of a record without loading the records."""
+        self.datasource.update({'age': None}, [4])
+        for params, expected_ids in [
+                ({}, [1, 2, 3, 4]),
+                ({'order_by': 'age'}, [4, 1, 2, 3]),
+                ({'order_by': 'age', 'desc': True}, [3, 2, 1, 4]),
+                ({'order_by': 'last_name'}, [2, 3, 4, 1]),
+                ({'where': {'age': {'param': 30, 'operator': '>'}},
+                  'order_by': 'age', 'desc': True}, [3, 2])]:
+            for materialize in [False, True]:
+                self.datasource.MATERIALIZE_IDS = materialize
+                positions = [self.datasource.get_row_position(id_, params)
+                             for id_ in expected_ids]
+                self.assertEqual(positions, range(len(expected_ids)))
+
+        params = {'where': {'age': {'param': 30, 'operator': '>'}}}
+        self.assertIsNone(self.datasource.get_row_position(1, params))
+
     def test_visible_columns(self):
         """Set visible columns and ensure they're persisted."""
         self.datasource.set_visible_columns(['last_name'])
@@ -113,6 +470,76 @@ class SQLiteDataSourceTest(unittest.TestCase):
             results = list(self.datasource.select(conn, self.datasource.table))
         self.assertEqual(len(results), 4)
 
+    def test_statement_cache(self):
+        """Statements with the same shape are compiled only once."""
+        for age in [30, 40]:
+            param = {'where': {'age': {'param': age, 'operator': '>'}}}
+            self.datasource.load(param)
+        for record_id in [1, 2]:
+            self.datasource.get_single_record(record_id)
+
+        stats = self.datasource.statement_cache_stats
+        # page and count for the first load and the first single record
+        self.assertEqual(stats['misses'], 3)
+        self.assertEqual(stats['hits'], 3)
+
+        rows = self.datasource.load(
+            {'where': {'age': {'param': 40, 'operator': '>'}}})
+        self.assertEqual([row.data[0] for row in rows], [3])
+        self.assertEqual(self.datasource.total_recs, 1)
+
+    def test_connection_pool(self):
+        """Data sources on the same file share long-lived connections."""
+        datasource = SQLiteDataSource(
+            self.db_file, table=self.table, pragmas={'temp_store': 'FILE'})
+        self.assertIs(datasource._pool, self.datasource._pool)
+
+        stats = self.datasource.connection_stats
+        self.datasource.load()
+        datasource.load()
+        new_stats = datasource.connection_stats
+        self.assertEqual(
+            new_stats['connections_created'], stats['connections_created'])
+        self.assertEqual(
+            new_stats['connections_reused'], stats['connections_reused'] + 2)
+
+        # Connections opened before the pragmas were given keep the old
+        # values, so close them to make sure the new ones will be used
+        datasource._pool.close()
+        with datasource._connect() as conn:
+            conn.row_factory = sqlite3.Row
+            with contextlib.closing(conn.cursor()) as cursor:
+                cursor.execute('PRAGMA temp_store')
+                self.assertEqual(cursor.fetchone()[0], 1)  # 1 means FILE
+        with datasource._connect() as conn:
+            self.assertIsNone(conn.row_factory)
+
+    def test_load_tree_children_len(self):
+        """Count the children of a tree level without a children column."""
+
+        class _FilesDataSource(SQLiteDataSource):
+            PARENT_ID_COLUMN = '__parent'
+            CREATE_PARENT_INDEX = True
+
+        db_file = create_db('files')
+        self.addCleanup(os.unlink, db_file)
+        datasource = _FilesDataSource(
+            db_file, table='files', ensure_selected_column=False)
+
+        rows = datasource.load({'order_by': '__id'})
+        self.assertEqual(
+            [(row.data[0], row.children_len) for row in rows],
+            [('file-0', 0), ('file-1', 0), ('folder-0', 2), ('folder-1', 3)])
+        rows = datasource.load({'order_by': '__id', 'parent_id': 'folder-1'})
+        self.assertEqual(
+            [(row.data[0], row.children_len) for row in rows],
+            [('file-1-0', 0), ('file-1-1', 0), ('folder-1-0', 1)])
+        self.assertEqual(len(rows[0].data), len(datasource.columns))
+
+        with contextlib.closing(sqlite3.connect(db_file)) as conn:
+            indexes = conn.execute('PRAGMA index_list(files)').fetchall()
+        self.assertIn('__files___parent_index', [row[1] for row in indexes])
+
     def test_explicit_query(self):
         """Test using an explicit query for the data source."""
         # Important to not ensure "selected" column if there is no primary
@@ -127,6 +554,17 @@ class SQLiteDataSourceTest(unittest.TestCase):
                           for record in TEST_DATA[self.table]['data']}
         self.assertEqual(data, reference_data)
 
+    def test_search_untyped_columns(self):
+        """Columns without a declared type are searched too."""
+        datasource = SQLiteDataSource(
+            self.db_file,
+            query="SELECT first_name, first_name || ' ' || last_name AS name "
+                  "FROM people",
+            ensure_selected_column=False
+        )
+        rows = datasource.load({'where': {'search': {'param': 'ar gol'}}})
+        self.assertEqual([row.data[1] for row in rows], ['Oscar Goldman'])
+
 
 if __name__ == '__main__':
     unittest.main()
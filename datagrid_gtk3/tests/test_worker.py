@@ -0,0 +1,94 @@
+"""Data source worker test cases."""
+
+import threading
+import unittest
+
+import mock
+
+from datagrid_gtk3.db import QueryCancelled
+from datagrid_gtk3.db.worker import (
+    DataSourceWorker,
+    PRIORITY_COUNT,
+    PRIORITY_PREFETCH,
+    PRIORITY_VISIBLE,
+)
+
+
+class DataSourceWorkerTest(unittest.TestCase):
+
+    """Test DataSourceWorker."""
+
+    def setUp(self):
+        """Run the callbacks right away."""
+        self.worker = DataSourceWorker()
+        patcher = mock.patch('datagrid_gtk3.db.worker.GLib.idle_add')
+        idle_add = patcher.start()
+        idle_add.side_effect = lambda func, *args: func(*args)
+        self.addCleanup(patcher.stop)
+
+    def test_priority(self):
+        """The most urgent requests run first."""
+        ran = []
+        release = threading.Event()
+        self.worker.submit(PRIORITY_VISIBLE, release.wait)
+        for priority in [PRIORITY_COUNT, PRIORITY_PREFETCH, PRIORITY_VISIBLE]:
+            request = self.worker.submit(priority, ran.append, (priority, ))
+        release.set()
+
+        request.result(5)
+        self.assertEqual(
+            ran, [PRIORITY_VISIBLE, PRIORITY_PREFETCH, PRIORITY_COUNT])
+
+    def test_preempt(self):
+        """Urgent requests interrupt the less urgent running ones."""
+        ran = []
+        started = threading.Event()
+
+        def count(cancel_event=None):
+            ran.append('count')
+            started.set()
+            if len(ran) == 1:
+                cancel_event.wait(5)
+                raise QueryCancelled()
+            return 4
+
+        count_request = self.worker.submit(
+            PRIORITY_COUNT, count, cancellable=True)
+        started.wait(5)
+        self.worker.submit(PRIORITY_VISIBLE, ran.append, ('page', ))
+
+        self.assertEqual(count_request.result(5), 4)
+        self.assertEqual(ran, ['count', 'page', 'count'])
+
+    def test_cancel(self):
+        """Cancelled requests don't run and their callbacks are not called."""
+        callback = mock.Mock()
+        release = threading.Event()
+        self.worker.submit(PRIORITY_VISIBLE, release.wait)
+        func = mock.Mock()
+        request = self.worker.submit(
+            PRIORITY_VISIBLE, func, callback=callback)
+        self.assertTrue(request.cancel())
+        last_request = self.worker.submit(PRIORITY_COUNT, len, ('abc', ))
+        release.set()
+
+        self.assertEqual(last_request.result(5), 3)
+        self.assertRaises(QueryCancelled, request.result)
+        self.assertFalse(func.called)
+        self.assertFalse(callback.called)
+
+    def test_callback(self):
+        """Callbacks receive the request when it finishes."""
+        called = threading.Event()
+        callback = mock.Mock()
+        callback.side_effect = lambda request: called.set()
+        request = self.worker.submit(
+            PRIORITY_VISIBLE, int, ('x', ), callback=callback)
+        self.assertTrue(called.wait(5))
+        callback.assert_called_once_with(request)
+        self.assertRaises(ValueError, request.result)
+
+        # Callbacks added after it finishes are called too
+        callback = mock.Mock()
+        request.add_done_callback(callback)
+        callback.assert_called_once_with(request)
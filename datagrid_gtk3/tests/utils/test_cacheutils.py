@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+
+"""Cache utilities test cases."""
+
+import unittest
+
+from datagrid_gtk3.utils.cacheutils import LRUCache
+
+
+class LRUCacheTest(unittest.TestCase):
+
+    """Tests for :class:`datagrid.utils.cacheutils.LRUCache`."""
+
+    def test_discard_least_recently_used(self):
+        """The least recently used items are discarded first."""
+        cache = LRUCache(2)
+        cache['a'] = 1
+        cache['b'] = 2
+        self.assertEqual(cache.get('a'), 1)
+        cache['c'] = 3
+
+        self.assertIn('a', cache)
+        self.assertNotIn('b', cache)
+        self.assertIn('c', cache)
+        self.assertEqual(len(cache), 2)
+
+    def test_info(self):
+        """Hits and misses are counted on lookups."""
+        cache = LRUCache(10)
+        cache['a'] = 1
+        cache.get('a')
+        cache.get('a')
+        cache.get('b')
+        self.assertEqual(cache.pop('a'), 1)
+
+        self.assertEqual(
+            cache.info(),
+            {'hits': 2, 'misses': 1, 'size': 0, 'max_size': 10})
+
+    def test_max_size_by_item_size(self):
+        """Items are discarded when their total size exceeds max_size."""
+        cache = LRUCache(10, get_size=len)
+        cache['a'] = 'xxxx'
+        cache['b'] = 'xxxx'
+        cache['c'] = 'xxxx'
+
+        self.assertNotIn('a', cache)
+        self.assertEqual(cache.info()['size'], 8)
+        self.assertEqual(cache.pop('b'), 'xxxx')
+        self.assertEqual(cache.info()['size'], 4)
+
+        # An item bigger than max_size is not kept at all
+        cache['d'] = 'x' * 11
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.info()['size'], 0)
@@ -1,8 +1,11 @@
 """Module containing classes for datagrid MVC implementation."""
 
 import base64
+import collections
 import contextlib
+import copy
 import datetime
+import functools
 import itertools
 import logging
 import os
@@ -17,10 +20,17 @@ from gi.repository import (
 )
 from pygtkcompat.generictreemodel import GenericTreeModel
 
+from datagrid_gtk3.db import ColumnarPage, Node
+from datagrid_gtk3.db.worker import (
+    DataSourceWorker,
+    PRIORITY_PREFETCH,
+    PRIORITY_VISIBLE,
+)
 from datagrid_gtk3.ui.popupcal import DateEntry
 from datagrid_gtk3.ui.uifile import UIFile
 from datagrid_gtk3.utils.dateutils import normalize_timestamp
 from datagrid_gtk3.utils.imageutils import ImageCacheManager
+from datagrid_gtk3.utils.cacheutils import LRUCache
 from datagrid_gtk3.utils.transformations import get_transformer
 
 _MEDIA_FILES = os.path.join(
@@ -47,6 +57,9 @@ NO_IMAGE_PIXBUF = _no_image_loader.get_pixbuf()
 # None as it can be a valid value for filtering.
 NO_FILTER_OPTION = object()
 
+# Returned by the formatted values cache when the value is not there
+_NOT_CACHED = object()
+
 
 class OptionsPopup(Gtk.Window):
 
@@ -375,6 +388,9 @@ class DataGridController(object):
 
     """
 
+    # Milliseconds to wait for the user to stop typing before searching
+    SEARCH_DELAY = 150
+
     def __init__(self, container, data_source, selected_record_callback=None,
                  activated_icon_callback=None, activated_row_callback=None,
                  has_checkboxes=True, decode_fallback=None,
@@ -389,6 +405,10 @@ class DataGridController(object):
         self.activated_icon_callback = activated_icon_callback
         self.activated_row_callback = activated_row_callback
 
+        self._search_timeout_id = None
+        self._search_request = None
+        self._preview_request = None
+
         self.vscroll = container.grid_scrolledwindow.get_vadjustment()
         self.vscroll.connect_after('value-changed', self.on_scrolled)
 
@@ -454,7 +474,7 @@ class DataGridController(object):
         # search widget
         self.container.entry_search.connect('activate', self.on_search_clicked)
         self.container.entry_search.connect(
-            'search-changed', self.on_search_clicked)
+            'search-changed', self.on_search_changed)
 
         self.container.grid_vbox.show_all()
 
@@ -470,6 +490,7 @@ class DataGridController(object):
         :param data_source: The data source to bind.
         :type data_source: :class:`datagrid_gtk3.db.DataSource`
         """
+        self._cancel_search()
         self.model = DataGridModel(data_source,
                                    self.get_full_path,
                                    self.decode_fallback)
@@ -632,7 +653,7 @@ class DataGridController(object):
             vadj.get_page_size() == vadj.get_upper())
 
         if scrolled_to_bottom:
-            self.model.add_rows()
+            self.model.request_rows()
 
         self._set_visible_range()
 
@@ -706,11 +727,10 @@ class DataGridController(object):
         selection = view.get_selection()
         model, row_iterator = selection.get_selected()
         if row_iterator and self.selected_record_callback:
-            record = self.model.data_source.get_single_record(
+            self._request_preview(
                 model[row_iterator][self.model.id_column_idx])
-            self.selected_record_callback(record)
         elif self.selected_record_callback:
-            self.selected_record_callback(None)
+            self._request_preview(None)
 
     def on_iconview_selection_changed(self, view):
         """Get the data for a selected record and run optional callback.
@@ -722,11 +742,10 @@ class DataGridController(object):
         row_iterator = selections and self.model.get_iter(selections[0])
         if row_iterator and self.selected_record_callback:
             model = view.get_model()
-            record = self.model.data_source.get_single_record(
+            self._request_preview(
                 model[row_iterator][self.model.id_column_idx])
-            self.selected_record_callback(record)
         elif self.selected_record_callback:
-            self.selected_record_callback(None)
+            self._request_preview(None)
 
     def on_iconview_item_activated(self, view, path):
         """Get the data the activated record and run optional callback.
@@ -777,6 +796,7 @@ class DataGridController(object):
         :param path: the path pointing to the expanded row
         :type path: :class:`Gtk.TreePath`
         """
+        self.model.set_row_expanded(path, True)
         GObject.idle_add(self._set_visible_range)
 
     def on_tree_view_row_collapsed(self, treeview, iter_, path):
@@ -791,6 +811,7 @@ class DataGridController(object):
         :param path: the path pointing to the collapsed row
         :type path: :class:`Gtk.TreePath`
         """
+        self.model.set_row_expanded(path, False)
         GObject.idle_add(self._set_visible_range)
 
     def on_image_cache_manager_image_loaded(self, cm):
@@ -842,19 +863,8 @@ class DataGridController(object):
         :param ids: The row ids that got updated
         :type ids: [int]
         """
-        params_idx = [
-            (self.model.data_source.columns_idx[k], v)
-            for k, v in params.iteritems()]
-        rows = (row
-                for id_, row in self.model.row_id_mapper.iteritems()
-                if ids is None or id_ in ids)
-
-        for row in rows:
-            for idx, value in params_idx:
-                row.data[idx] = value
-
-            path = Gtk.TreePath(row.path)
-            self.model.row_changed(path, self.model.get_iter(row.path))
+        self.model.discard_prefetched_rows()
+        if self.model.update_loaded_rows(params, ids):
             # Even if we call `view.queue_draw` here, it would only be updated
             # when it got focused. By setting refresh_draw to True, it will
             # force it to refresh the values when the view gets visible on the
@@ -869,24 +879,45 @@ class DataGridController(object):
         :param int total_recs: Total records for current query
 
         """
-        self.container.label_num_recs.set_markup(
-            '<small>%d records</small>' % total_recs
-        )
+        # While the records are being counted, total_recs is just the
+        # number of records loaded so far
+        template = ('<small>%d records</small>' if model.total_recs_exact
+                    else '<small>%d+ records</small>')
+        self.container.label_num_recs.set_markup(template % total_recs)
+
+    def on_search_changed(self, widget):
+        """Schedule the full-text search for the keyword being typed.
+
+        The search only starts after :attr:`.SEARCH_DELAY` milliseconds
+        without changes, so a search will not be done for each
+        keystroke. Any search already running gets cancelled.
+
+        :param widget: The widget that called the event
+        :type widget: :class:`Gtk.Widget`
+        """
+        self._cancel_search()
+        self._search_timeout_id = GLib.timeout_add(
+            self.SEARCH_DELAY, self._on_search_timeout)
 
     def on_search_clicked(self, widget):
         """Execute the full-text search for given keyword.
 
+        The first page of results is loaded by the model's worker, so
+        the UI will not be blocked by the query. Starting another search
+        (or refreshing the view in any other way) before that finishes
+        will cancel it, interrupting its query, and only the results
+        of the latest search will be displayed.
+
         :param widget: The widget that called the event
         :type widget: :class:`Gtk.Widget`
         """
-        search = self.container.entry_search.get_text()
-        update_dict = {
-            'search': {
-                'operator': '=',
-                'param': search
-            }
-        }
-        self._refresh_view(update_dict)
+        self._cancel_search()
+        params = self._get_search_params()
+        load_params = self.model.get_first_page_params(params)
+        self._search_request = self.model.worker.submit(
+            PRIORITY_VISIBLE, self.model.load_first_page, (load_params, ),
+            cancellable=True,
+            callback=functools.partial(self._on_search_loaded, params))
 
     def on_date_change(self, widget, data=None):
         """Refresh the view with chosen date range.
@@ -946,15 +977,27 @@ class DataGridController(object):
     # Private
     ###
 
-    def _refresh_view(self, update_dict=None, remove_keys=None):
+    def _refresh_view(self, update_dict=None, remove_keys=None,
+                      rows=None, total_recs=None):
         """Reload the grid with any filter/sort parameters.
 
         :param dict update_dict: Any ``where`` parameters with which to update
             the currently active parameters
         :param remove_keys: List of keys to delete from ``where`` parameters
         :type remove_keys: list
+        :param rows: the first page of rows, if already loaded.
+            See :meth:`DataGridModel.refresh`
+        :type rows: :class:`datagrid_gtk3.db.Node`
+        :param int total_recs: the total number of records loaded
+            along with `rows`
 
         """
+        if self._cancel_search():
+            # The search was not applied yet. Do it now with the rest
+            update_dict = dict(
+                update_dict or {},
+                search=self._get_search_params()['where']['search'])
+
         where_dict = self.model.active_params.setdefault('where', {})
 
         if remove_keys:
@@ -970,17 +1013,119 @@ class DataGridController(object):
         # This will speed up loading the views. Images will be loaded
         # after when _set_visible_range executes.
         self.model.visible_range = ((-1, ), (-1, ))
-        self.view.refresh()
+        self.view.refresh(rows=rows, total_recs=total_recs)
         GObject.idle_add(self._set_visible_range)
 
+    def _get_search_params(self):
+        """Get the model params for searching the current keyword.
+
+        :return: a copy of the model's active params, with the
+            search keyword on its ``where`` params
+        :rtype: dict
+        """
+        params = copy.deepcopy(self.model.active_params)
+        params.pop('page', None)
+        params.pop('parent_id', None)
+        params.setdefault('where', {})['search'] = {
+            'operator': '=',
+            'param': self.container.entry_search.get_text(),
+        }
+        return params
+
+    def _cancel_search(self):
+        """Cancel the search that is scheduled or being loaded.
+
+        :return: if there was a search to cancel
+        :rtype: bool
+        """
+        cancelled = False
+        if self._search_timeout_id is not None:
+            GLib.source_remove(self._search_timeout_id)
+            self._search_timeout_id = None
+            cancelled = True
+        if self._search_request is not None:
+            self._search_request.cancel()
+            self._search_request = None
+            cancelled = True
+
+        return cancelled
+
+    def _on_search_timeout(self):
+        """Start the search scheduled by :meth:`.on_search_changed`."""
+        self._search_timeout_id = None
+        self.on_search_clicked(self.container.entry_search)
+        return False
+
+    def _on_search_loaded(self, params, request):
+        """Display the search results loaded by the worker.
+
+        :param dict params: the params the rows were loaded with
+        :param request: the finished search request
+        :type request: :class:`datagrid_gtk3.db.worker.Request`
+        """
+        self._search_request = None
+        try:
+            rows, total_recs = request.result()
+        except Exception:
+            logger.exception('Failed to search')
+            rows, total_recs = None, None
+
+        if self._get_search_params() != params:
+            # The other params changed meanwhile (e.g. the view got
+            # sorted), so the rows need to be loaded again
+            rows = None
+        self._refresh_view(
+            {'search': params['where']['search']},
+            rows=rows, total_recs=total_recs)
+
+    def _request_preview(self, record_id):
+        """Get the record on the worker and pass it to the callback.
+
+        Any preview still being loaded gets cancelled, so only the
+        latest selected record will be passed to
+        :attr:`.selected_record_callback`.
+
+        :param object record_id: the id of the selected record, or
+            `None` if there's no record selected
+        """
+        if self._preview_request is not None:
+            self._preview_request.cancel()
+            self._preview_request = None
+        if record_id is None:
+            self.selected_record_callback(None)
+            return
+
+        self._preview_request = self.model.worker.get_single_record(
+            self.model.data_source, record_id,
+            callback=self._on_preview_loaded)
+
+    def _on_preview_loaded(self, request):
+        """Pass the record loaded by the worker to the callback.
+
+        :param request: the finished request
+        :type request: :class:`datagrid_gtk3.db.worker.Request`
+        """
+        self._preview_request = None
+        try:
+            record = request.result()
+        except Exception:
+            logger.exception('Failed to get the selected record')
+            record = None
+        self.selected_record_callback(record)
+
     def _set_visible_range(self):
-        """Update model with current view's visible range."""
+        """Update model with current view's visible range.
+
+        The rows around it will be loaded by
+        :meth:`DataGridModel.prefetch_rows`.
+        """
         visible_range = self.view.get_visible_range()
         if visible_range is None:
             return
 
         self.model.visible_range = (
             tuple(visible_range[0]), tuple(visible_range[1]))
+        self.model.prefetch_rows()
 
         self.view.queue_draw()
 
@@ -1054,16 +1199,24 @@ class DataGridView(Gtk.TreeView):
             self.refresh_draw = False
         return Gtk.TreeView.do_draw(self, cr)
 
-    def refresh(self):
-        """Refresh the model results."""
+    def refresh(self, rows=None, total_recs=None):
+        """Refresh the model results.
+
+        The params are passed to :meth:`DataGridModel.refresh`.
+        """
         self.set_model(None)
-        self.model.refresh()
+        self.model.refresh(rows=rows, total_recs=total_recs)
         self.set_model(self.model)
 
+        self.set_fixed_height_mode(False)
         for col in self.get_columns()[:]:
             self.remove_column(col)
 
         self._setup_columns()
+        # Otherwise, the view would get the values of all the virtual
+        # rows to measure their heights (and the model would need to
+        # load them). All the columns have a fixed width in that case
+        self.set_fixed_height_mode(self.model.has_virtual_rows)
 
         # After refreshing the model, some rows may not be present anymore.
         # Let self.expanded_ids be constructed again by the events bellow
@@ -1193,9 +1346,8 @@ class DataGridView(Gtk.TreeView):
         if 'where' in self.model.active_params:
             where_params['where'] = self.model.active_params['where']
 
-        ids = self.model.data_source.get_all_record_ids(where_params)
-        self.model.update_data_source(
-            self.model.data_source.SELECTED_COLUMN, val, ids)
+        self.model.update_data_source_by_filter(
+            self.model.data_source.SELECTED_COLUMN, val, where_params)
 
         self.refresh()
 
@@ -1228,11 +1380,13 @@ class DataGridView(Gtk.TreeView):
                 lambda tvc: check_btn.set_active(not check_btn.get_active()))
 
             self.check_btn_toggle_all = check_btn
+            if self.model.has_virtual_rows:
+                # Required by the fixed height mode. See refresh
+                col.set_fixed_width(self.MIN_WIDTH)
+                col.set_sizing(Gtk.TreeViewColumnSizing.FIXED)
             self.append_column(col)
 
         hidden_columns = self.model.hidden_columns
-        samples = list(itertools.islice(
-            (r.data for r in self.model.iter_rows()), self.SAMPLE_SIZE))
         for column_index, column in enumerate(self.model.columns):
             item = column['name']
             display = item in self.model.display_columns
@@ -1254,6 +1408,9 @@ class DataGridView(Gtk.TreeView):
                 # Set the minimum width for the column based on the width
                 # of the label and some padding
                 width = self._get_pango_string_width(lbl) + 14
+                samples = itertools.islice(
+                    self.model.iter_column_values(column_index),
+                    self.SAMPLE_SIZE)
                 col.set_fixed_width(
                     self._get_best_column_width(column_index, samples))
                 col.set_sizing(Gtk.TreeViewColumnSizing.FIXED)
@@ -1281,8 +1438,17 @@ class DataGridView(Gtk.TreeView):
             return
 
         selected_idx = self.model.data_source.selected_column_idx
-        all_selected = all(row[selected_idx] for row in self.model)
-        any_selected = any(row[selected_idx] for row in self.model)
+        if self.model.has_virtual_rows:
+            # Count them straight from the loaded pages instead of getting
+            # each row from the model. The rows not loaded are unselected
+            selected = sum(
+                1 for value in self.model.iter_column_values(selected_idx)
+                if value)
+            all_selected = selected == self.model.rows.children_len
+            any_selected = selected > 0
+        else:
+            all_selected = all(row[selected_idx] for row in self.model)
+            any_selected = any(row[selected_idx] for row in self.model)
 
         with self.check_btn_toggle_all.handler_block(
                 self.check_btn_toggled_id):
@@ -1313,7 +1479,8 @@ class DataGridView(Gtk.TreeView):
         """Determine a reasonable column width for the given column.
 
         :param int colnum: Index of column
-        :param int samples: Number of rows to use to determine best width
+        :param samples: Values of the column to use to determine best width
+        :type samples: iterable
         :return: optimal column width
         :rtype: int
         """
@@ -1322,9 +1489,8 @@ class DataGridView(Gtk.TreeView):
         label_width = layout.get_pixel_size()[0]
         lengths = set()
         model = self.get_model()
-        for row in samples:
-            value = model.get_formatted_value(row[colnum], colnum,
-                                              visible=False)
+        for sample in samples:
+            value = model.get_formatted_value(sample, colnum, visible=False)
             if isinstance(value, basestring):
                 lines = value.splitlines()
                 if lines:
@@ -1518,10 +1684,13 @@ class DataGridIconView(Gtk.IconView):
             self.refresh_draw = False
         return Gtk.IconView.do_draw(self, cr)
 
-    def refresh(self):
-        """Refresh the model results."""
+    def refresh(self, rows=None, total_recs=None):
+        """Refresh the model results.
+
+        The params are passed to :meth:`DataGridModel.refresh`.
+        """
         self.set_model(None)
-        self.model.refresh()
+        self.model.refresh(rows=rows, total_recs=total_recs)
         self.set_model(self.model)
 
         if self.model.flat_column_idx is not None:
@@ -1677,6 +1846,15 @@ class DataGridModel(GenericTreeModel):
     image_max_size = GObject.property(type=float, default=24.0)
     image_draw_border = GObject.property(type=bool, default=False)
     image_load_on_thread = GObject.property(type=bool, default=True)
+    prefetch_distance = GObject.property(type=int, default=100)
+    prefetch_pages = GObject.property(type=int, default=1)
+    count_on_thread = GObject.property(type=bool, default=True)
+    count_time_budget = GObject.property(type=float, default=0.0)
+    project_columns = GObject.property(type=bool, default=True)
+    truncate_strings = GObject.property(type=bool, default=True)
+    virtual_rows = GObject.property(type=bool, default=False)
+    max_resident_rows = GObject.property(type=int, default=10000)
+    formatted_cache_size = GObject.property(type=int, default=10000)
 
     STRING_MAX_LENGTH = 100
     IMAGE_PREFIX = 'file://'
@@ -1688,6 +1866,10 @@ class DataGridModel(GenericTreeModel):
 
         self._invisible_images = {}
         self._fallback_images = {}
+        # The formatted values of the cells, mapped by their row ids and
+        # columns. See formatted_cache_stats
+        self._formatted_cache = LRUCache(self.formatted_cache_size)
+        self._cached_columns = set()
         self.visible_range = None
         self.active_params = {'flat': False}
         self.data_source = data_source
@@ -1714,6 +1896,7 @@ class DataGridModel(GenericTreeModel):
 
         self.encoding_hint = encoding_hint
         self.selected_cells = list()
+        self.worker = DataSourceWorker.get_worker(self.data_source)
 
         self.row_id_mapper = {}
         self.id_column_idx = None
@@ -1721,6 +1904,92 @@ class DataGridModel(GenericTreeModel):
         self.flat_column_idx = None
         self.rows = None
         self.total_recs = None
+        self.total_recs_exact = True
+        self._count_request = None
+
+        # The requests for the pages being loaded by the worker and the
+        # pages already loaded by it, waiting for add_rows to use them
+        self._prefetching = {}
+        self._prefetched = {}
+        # The page to add as soon as it gets loaded. See request_rows
+        self._requested_page = None
+
+        # The pages loaded when using virtual rows, stored column-wise
+        # (see ColumnarPage), and what is displayed while a row's page
+        # is not loaded (or got evicted). See refresh
+        self._virtual = False
+        self._pages = {}
+        self._placeholder = Node(data=[None] * len(self.columns))
+
+        # The number of rows loaded and how many times pages or subtrees
+        # got evicted to keep them under max_resident_rows.
+        # See memory_stats
+        self.resident_rows = 0
+        # The pages appended to the non-hierarchical rows whose rows got
+        # replaced by the placeholder when evicted. See _evict_page
+        self._evicted_pages = set()
+        self.evictions = 0
+        # The rows collapsed on the view whose children can be evicted,
+        # mapped by their ids. See set_row_expanded
+        self._collapsed = collections.OrderedDict()
+
+        # The formatters are compiled when the columns are set (see
+        # columns) and again when the properties they depend on change
+        for prop in ['image-max-size', 'image-draw-border',
+                     'image-load-on-thread', 'truncate-strings']:
+            self.connect('notify::' + prop, self._on_notify_formatting)
+        self.connect('notify::formatted-cache-size',
+                     self._on_notify_formatted_cache_size)
+
+    @property
+    def columns(self):
+        """The columns of the model, as described by the data source.
+
+        Setting this compiles the functions that format their values.
+        See :meth:`.get_formatted_value`
+        """
+        return self._columns
+
+    @columns.setter
+    def columns(self, columns):
+        self._columns = columns
+        self._compile_formatters()
+
+    @property
+    def formatted_cache_stats(self):
+        """Statistics about the formatted values cache.
+
+        The values of the cells displayed on the view are cached (up to
+        :attr:`.formatted_cache_size` of them) so they don't need to be
+        formatted again each time the view gets redrawn.
+
+        :return: a dict with the number of ``hits`` and ``misses``
+            and the cache ``size`` and ``max_size``
+        :rtype: dict
+        """
+        return self._formatted_cache.info()
+
+    @property
+    def has_virtual_rows(self):
+        """If the rows are virtual, i.e. loaded as they get displayed.
+
+        See :meth:`.refresh`
+        """
+        return self._virtual
+
+    @property
+    def memory_stats(self):
+        """Statistics about the rows kept in memory.
+
+        :return: a dict containing the number of ``resident_rows``, the
+            ``max_resident_rows`` and the number of ``evictions``
+        :rtype: dict
+        """
+        return {
+            'resident_rows': self.resident_rows,
+            'max_resident_rows': self.max_resident_rows,
+            'evictions': self.evictions,
+        }
 
     @property
     def hidden_columns(self):
@@ -1733,32 +2002,133 @@ class DataGridModel(GenericTreeModel):
                 hidden.add(self.data_source.FLAT_COLUMN)
         return hidden
 
-    def refresh(self):
-        """Refresh the model from the data source."""
+    def refresh(self, rows=None, total_recs=None):
+        """Refresh the model from the data source.
+
+        When :attr:`.virtual_rows` is `True` and the data is not
+        hierarchical, the model will have all the records as rows
+        right away (so the scrollbar will represent all of them) and
+        their pages will be loaded on demand as they get displayed.
+        The pages farthest from :attr:`.visible_range` will be evicted
+        when there are more than :attr:`.max_resident_rows` rows
+        loaded. The rows of the pages not loaded yet will have no values.
+
+        Otherwise, the pages of non-hierarchical data are appended as
+        the view gets scrolled (see :meth:`.add_rows`), and the ones
+        farthest from :attr:`.visible_range` get evicted the same way.
+        They will be loaded again when they get visible.
+
+        :param rows: the first page of rows for :attr:`.active_params`,
+            as returned by :meth:`.load_first_page`, if they were
+            already loaded (e.g. on another thread)
+        :type rows: :class:`datagrid_gtk3.db.Node`
+        :param int total_recs: the total number of records returned
+            by :meth:`.load_first_page` along with `rows`
+        """
         if 'page' in self.active_params:
             del self.active_params['page']
         if 'parent_id' in self.active_params:
             del self.active_params['parent_id']
+        self._update_load_params()
 
+        self.discard_prefetched_rows()
         self.row_id_mapper.clear()
-        self.rows = self.data_source.load(self.active_params)
+        self._pages.clear()
+        self._evicted_pages.clear()
+        self._formatted_cache.clear()
+        self._collapsed.clear()
+        if self._count_request is not None:
+            # The records being counted are not the ones loaded anymore
+            self._count_request.cancel()
+            self._count_request = None
+
+        if rows is None:
+            rows, total_recs = self.load_first_page(
+                self.get_first_page_params(self.active_params))
+        self.data_source.total_recs = total_recs
+        self.rows = rows
         self.rows.path = ()
 
         self.id_column_idx = self.data_source.id_column_idx
         self.parent_column_idx = self.data_source.parent_column_idx
         self.flat_column_idx = self.data_source.flat_column_idx
-        self.total_recs = self.data_source.total_recs
-
-        if self.id_column_idx is not None:
+        self.total_recs = total_recs
+        self.total_recs_exact = self.total_recs is not None
+        self._virtual = (self.total_recs_exact and
+                         self._uses_virtual_rows(self.active_params))
+        self.resident_rows = 0
+        if self._virtual:
+            self.rows = Node(children_len=self.total_recs)
+            self.rows.path = ()
+            self._add_page(0, rows, emit_changed=False)
+        elif not self.total_recs_exact:
+            # Count the records on the worker so the first page can
+            # be displayed as soon as possible. Meanwhile, total_recs
+            # will be the number of records loaded so far.
+            self.total_recs = len(self.rows)
+            self._count_request = self.worker.count(
+                self.data_source, self.active_params,
+                self.count_time_budget or None,
+                callback=self._on_records_counted)
+
+        if not self._virtual:
+            self.resident_rows = self._count_rows(self.rows)
+        if self.id_column_idx is not None and not self._virtual:
             for i, row in enumerate(self.rows):
                 row.path = (i, )
                 self.row_id_mapper[row.data[self.id_column_idx]] = row
 
         self.emit('data-loaded', self.total_recs)
 
-    def add_rows(self, parent_node=None):
+    def get_first_page_params(self, params):
+        """Get the params to load the first page of rows with.
+
+        This depends on the model's properties, so it should be called
+        on the main loop, before passing the result to
+        :meth:`.load_first_page`.
+
+        :param dict params: the params to load the rows for
+        :return: a copy of the params, adjusted to load the first page
+        :rtype: dict
+        """
+        params = dict(params)
+        params.pop('page', None)
+        params.pop('parent_id', None)
+        # The virtual rows need to know the number of records up front
+        if self.count_on_thread and not self._uses_virtual_rows(params):
+            params['defer_count'] = True
+        return params
+
+    def load_first_page(self, params, cancel_event=None):
+        """Load the first page of rows for the params.
+
+        This is what :meth:`.refresh` uses to load the rows, and it is
+        safe to call from another thread (e.g. submitted to
+        :attr:`.worker`), since neither the model nor the data source
+        get changed by it. See
+        :meth:`datagrid_gtk3.db.DataSource.load_counted`.
+
+        :param dict params: the params to load the rows with, as
+            returned by :meth:`.get_first_page_params`
+        :param cancel_event: an event that, when set, will cancel
+            the loading. See :meth:`datagrid_gtk3.db.DataSource.load`
+        :type cancel_event: :class:`threading.Event`
+        :return: the rows and the total number of records (or `None`
+            if they will be counted on another thread)
+        :rtype: tuple
+        :raise QueryCancelled: if `cancel_event` got set
+        """
+        return self.data_source.load_counted(
+            params, cancel_event=cancel_event)
+
+    def add_rows(self, parent_node=None, page_count=1):
         """Add rows to the model from a new page of data and update the view.
 
+        :param parent_node: the node to load the children for, or `None`
+            to load the next page of a non-hierarchical data
+        :type parent_node: :class:`datagrid_gtk3.db.Node`
+        :param int page_count: how many pages to load at once when
+            loading non-hierarchical data
         :return: True if update took place, False if not
         :rtype: bool
         """
@@ -1768,23 +2138,41 @@ class DataGridModel(GenericTreeModel):
         # except in a flat view, where data is being lazy loaded.
         if is_tree and parent_node is None:
             return False
+        # The virtual rows are all there already
+        if self._virtual:
+            return False
 
         if parent_node is None:
             parent_id = None
             parent_row = self.rows
-            path_offset = self.rows[-1].path[-1] + 1
+            # The last row may be a placeholder for an evicted page
+            path_offset = len(self.rows)
             # We are not using pages for hierarchical data
-            self.active_params['page'] = self.active_params.get('page', 0) + 1
+            first_page = self.active_params.get('page', 0) + 1
+            self.active_params['page'] = first_page + page_count - 1
         else:
             parent_id = parent_node.data[self.id_column_idx]
             parent_row = parent_node
             path_offset = 0
 
         self.active_params['parent_id'] = parent_id
-        rows = self.data_source.load(self.active_params)
+        rows = None
+        params = self.active_params
+        if parent_node is None and page_count == 1:
+            rows = self._prefetched.pop(first_page, None)
+            request = self._prefetching.pop(first_page, None)
+            if request is not None:
+                # It will be loaded right now instead
+                request.cancel()
+        elif parent_node is None:
+            self.discard_prefetched_rows()
+            params = dict(params, page=first_page, page_count=page_count)
+        if rows is None:
+            rows = self.data_source.load(params)
         if not len(rows):
             return False
 
+        self.resident_rows += len(rows)
         for i, row in enumerate(rows):
             row.path = parent_row.path + (path_offset + i, )
             self.row_id_mapper[row.data[self.id_column_idx]] = row
@@ -1799,8 +2187,182 @@ class DataGridModel(GenericTreeModel):
                 path = Gtk.TreePath(row.path)
                 self.row_inserted(path, self.create_tree_iter(row.path))
 
+        if (parent_node is None and not self.total_recs_exact and
+                len(self.rows) > self.total_recs):
+            self.total_recs = len(self.rows)
+            self.emit('data-loaded', self.total_recs)
+
+        self._evict_rows()
         return True
 
+    def request_rows(self):
+        """Add the next page of rows to the model as soon as it loads.
+
+        This is like :meth:`.add_rows`, except that the page is loaded
+        by :attr:`.worker` with the highest priority, so the main loop
+        will not be blocked by the query. The page is added right away
+        if it was prefetched already.
+        """
+        if self._virtual:
+            return
+
+        is_tree = (self.parent_column_idx is not None and
+                   not self.active_params.get('flat', False))
+        page = self.active_params.get('page', 0) + 1
+        if (is_tree or page in self._prefetched or not self.rows or
+                (self.total_recs_exact and
+                 len(self.rows) >= self.total_recs)):
+            self.add_rows()
+            return
+
+        self._requested_page = page
+        request = self._prefetching.get(page)
+        if request is not None:
+            if request.priority == PRIORITY_VISIBLE:
+                return
+            # Load it again with a higher priority
+            request.cancel()
+        self._load_page(page, PRIORITY_VISIBLE)
+
+    def prefetch_rows(self):
+        """Load the next pages on the worker thread if needed.
+
+        When the visible range gets within :attr:`.prefetch_distance`
+        rows of the last loaded row, the next :attr:`.prefetch_pages`
+        pages will be loaded by :attr:`.worker`. That way, when
+        :meth:`.add_rows` gets called the rows will (hopefully) be
+        already loaded and the main loop will not be blocked by the
+        query.
+
+        Note that this only applies to non-hierarchical data, since
+        hierarchical data is loaded by expanding the parent rows.
+
+        When using virtual rows (see :meth:`.refresh`), this loads the
+        pages in :attr:`.visible_range` and :attr:`.prefetch_pages`
+        pages around them instead, and cancels the loading of the
+        ones that got scrolled out of view meanwhile. Otherwise, the
+        evicted pages in :attr:`.visible_range` get loaded again.
+        """
+        if self._virtual:
+            self._load_visible_pages()
+            return
+
+        if not self.rows or self.visible_range is None:
+            return
+        if (self.parent_column_idx is not None and
+                not self.active_params.get('flat', False)):
+            return
+
+        max_recs = self.data_source.MAX_RECS
+        for page in xrange(self.visible_range[0][0] // max_recs,
+                           self.visible_range[1][0] // max_recs + 1):
+            if (page in self._evicted_pages and
+                    page not in self._prefetching):
+                self._load_page(page, PRIORITY_VISIBLE)
+
+        if self.prefetch_pages <= 0:
+            return
+        if self.total_recs_exact and len(self.rows) >= self.total_recs:
+            return
+
+        last_visible = self.visible_range[1][0]
+        if len(self.rows) - last_visible > self.prefetch_distance:
+            return
+
+        current_page = self.active_params.get('page', 0)
+        for page in xrange(current_page + 1,
+                           current_page + 1 + self.prefetch_pages):
+            if page in self._prefetched or page in self._prefetching:
+                continue
+            self._load_page(page, PRIORITY_PREFETCH)
+
+    def discard_prefetched_rows(self):
+        """Discard any page loaded, or being loaded, by the prefetch.
+
+        This should be called when the data on the prefetched pages
+        became stale, like when :attr:`.active_params` changes or
+        when the data source gets updated.
+        """
+        for request in self._prefetching.itervalues():
+            request.cancel()
+        self._prefetching.clear()
+        self._prefetched.clear()
+        self._requested_page = None
+
+    def update_loaded_rows(self, params, ids):
+        """Update the values of the loaded rows.
+
+        This is used to reflect the changes made on the data source
+        without loading the rows again.
+
+        :param dict params: the columns names mapped to their new values
+        :param list ids: the ids of the rows that got updated, or `None`
+            if all of them were
+        :return: `True` if any loaded row got updated
+        :rtype: bool
+        """
+        if self.id_column_idx is None:
+            return False
+
+        params_idx = [
+            (self.data_source.columns_idx[k], v)
+            for k, v in params.iteritems()]
+        if ids is None:
+            self._formatted_cache.clear()
+        else:
+            for id_ in ids:
+                for idx, value in params_idx:
+                    self._formatted_cache.pop((id_, idx))
+
+        paths = []
+        if self._virtual:
+            max_recs = self.data_source.MAX_RECS
+            for page, columns in self._pages.iteritems():
+                for page_index, id_ in enumerate(
+                        columns.get_column(self.id_column_idx)):
+                    if ids is not None and id_ not in ids:
+                        continue
+                    for idx, value in params_idx:
+                        columns.set_value(page_index, idx, value)
+                    paths.append((page * max_recs + page_index, ))
+        else:
+            for id_, row in self.row_id_mapper.iteritems():
+                if ids is not None and id_ not in ids:
+                    continue
+                for idx, value in params_idx:
+                    row.set_value(idx, value)
+                paths.append(row.path)
+
+        for path in paths:
+            self.row_changed(Gtk.TreePath(path), self.get_iter(path))
+        return bool(paths)
+
+    def set_row_expanded(self, path, expanded):
+        """Tell the model if a row is expanded on the view.
+
+        The children of the collapsed rows will be evicted (the ones
+        collapsed first, first) when there are more than
+        :attr:`.max_resident_rows` rows loaded. They will be loaded
+        again when needed, like when the row gets expanded again.
+
+        Note that the children of the rows loaded while filtering
+        the hierarchical data can't be loaded again, so they are
+        never evicted.
+
+        :param path: the path of the row
+        :type path: :class:`Gtk.TreePath`
+        :param bool expanded: if the row is expanded
+        """
+        if self.id_column_idx is None or self.active_params.get('where'):
+            return
+
+        row = self._get_row_by_path(tuple(path))
+        row_id = row.data[self.id_column_idx]
+        self._collapsed.pop(row_id, None)
+        if not expanded and len(row):
+            self._collapsed[row_id] = row
+            self._evict_rows()
+
     def update_data_source(self, column, value, ids):
         """Update the model's persistent data source for given records.
 
@@ -1815,8 +2377,26 @@ class DataGridModel(GenericTreeModel):
         :param list ids: List of primary keys of records to update
         """
         param = {column: value}
+        self.discard_prefetched_rows()
         self.data_source.update(param, ids)
 
+    def update_data_source_by_filter(self, column, value, filter_params):
+        """Update the model's persistent data source for filtered records.
+
+        The same as :meth:`.update_data_source`, but all the records
+        matching `filter_params` will be updated without loading their ids.
+
+        :param str column: Name of column to update
+        :param value: Update value
+        :type value: str or int
+        :param dict filter_params: params from which to construct
+            the SQL ``WHERE`` clause (e.g. the ``where`` key of
+            :attr:`.active_params`)
+        """
+        param = {column: value}
+        self.discard_prefetched_rows()
+        self.data_source.update_by_filter(param, filter_params)
+
     def get_formatted_value(self, value, column_index, visible=True):
         """Get the value to display in the cell.
 
@@ -1829,92 +2409,7 @@ class DataGridModel(GenericTreeModel):
         :return: formatted value
         :rtype: unicode or int or bool or None
         """
-        col_dict = self.columns[column_index]
-        col_name = col_dict['name']
-
-        # Defaults to string transformer if None
-        transformer_name = col_dict['transform'] or 'string'
-        transformer = get_transformer(transformer_name)
-        transformer_kwargs = {}
-
-        # Only enforce value type if the config was provided. Otherwise,
-        # we would just be spamming a lot of obvious warnings (we got the type
-        # from introspecting the database and for sqlite, it has a high
-        # probability of not being an exact match in python).
-        if (col_dict['from_config'] and
-                value is not None and 'type' in col_dict):
-            # Try enforcing value type
-            value = self._enforce_value_type(value, col_dict['type'])
-
-        if transformer is None:
-            logger.warning("No transformer found for %s", transformer_name)
-            return value
-
-        if (transformer_name == 'boolean' and
-                col_name == self.data_source.SELECTED_COLUMN):
-            # __selected is an exception to the boolean transformation.
-            # It requires a bool value and not a pixbuf
-            return bool(value)
-        elif transformer_name == 'image':
-            transformer_kwargs.update(dict(
-                size=self.image_max_size,
-                draw_border=self.image_draw_border,
-                load_on_thread=self.image_load_on_thread,
-                draft=True,
-            ))
-
-            # If no value, use an invisible image as a placeholder
-            if not value:
-                invisible_img = self._invisible_images.get(self.image_max_size)
-                if not invisible_img:
-                    invisible_img = NO_IMAGE_PIXBUF.scale_simple(
-                        self.image_max_size, self.image_max_size,
-                        GdkPixbuf.InterpType.NEAREST)
-                    self._invisible_images[self.image_max_size] = invisible_img
-                return invisible_img
-
-            if isinstance(value, buffer):
-                # FIXME: Support buffer in the future. Atm, set visible to
-                # False so a fallback image will be returned bellow
-                logger.warn('Buffered images are still not supported')
-                visible = False
-
-            # When not visible on the iconview, use an already generated
-            # fallback image (that has the same dimensions as the real
-            # image should have) to improve loading time.
-            if not visible:
-                key = (self.image_draw_border, self.image_max_size)
-                fallback = self._fallback_images.get(key)
-                if not fallback:
-                    fallback = transformer(None, **transformer_kwargs)
-                    self._fallback_images[key] = fallback
-                return fallback
-
-            if value.startswith(self.IMAGE_PREFIX):
-                value = value[len(self.IMAGE_PREFIX):]
-
-            if not value:
-                # Force fallback in this case
-                value = None
-            elif not os.path.isabs(value):
-                if self.get_media_callback is None:
-                    logger.warning(
-                        "Don't know how to access the relative path '%s'. "
-                        "Try passing get_full_path to controller.", value)
-                    value = None
-                else:
-                    value = self.get_media_callback(value)
-        elif transformer_name in ['string', 'html']:
-            transformer_kwargs.update(dict(
-                max_length=self.STRING_MAX_LENGTH, oneline=True,
-                decode_fallback=self.decode_fallback,
-            ))
-
-        custom_options = col_dict.get('transform_options')
-        if custom_options:
-            transformer_kwargs['options'] = custom_options
-
-        return transformer(value, **transformer_kwargs)
+        return self._formatters[column_index](value, visible)
 
     def set_value(self, itr, column, value, emit_event=True):
         """Set the value in the model and update the data source with it.
@@ -1929,9 +2424,22 @@ class DataGridModel(GenericTreeModel):
         """
         path = self.get_path(itr)
         # path and iter are the same in this model.
-        row = self._get_row_by_path(path)
-        row.data[column] = value
-        id_ = self.get_value(itr, self.id_column_idx)
+        if self._virtual:
+            columns, index = self._get_virtual_position(path[0])
+            if columns is None:
+                # The row's page is not loaded, so it is only displaying a
+                # placeholder and there's no record to change
+                return
+            columns.set_value(index, column, value)
+            id_ = columns.get_value(index, self.id_column_idx)
+        else:
+            row = self._get_row_by_path(path)
+            if row is self._placeholder:
+                # The row's page got evicted. See _evict_page
+                return
+            row.set_value(column, value)
+            id_ = row.data[self.id_column_idx]
+        self._formatted_cache.pop((id_, column))
         self.update_data_source(
             self.columns[column]['name'], value, [int(id_)])
         if emit_event:
@@ -1962,14 +2470,37 @@ class DataGridModel(GenericTreeModel):
         :returns: an iterator for the rows
         :rtype: generator
         """
+        max_recs = self.data_source.MAX_RECS
+
         def _iter_children_aux(parent):
-            for row in parent:
+            for index, row in enumerate(parent):
+                if row is self._placeholder:
+                    # Only the pages of non-hierarchical rows get evicted
+                    if not load_rows:
+                        continue
+                    self._load_evicted_page(index // max_recs)
+                    row = parent[index]
+                    if row is self._placeholder:
+                        # The records changed since they were counted
+                        continue
                 if load_rows:
                     self._ensure_children_is_loaded(row)
                 yield row
                 for inner_row in _iter_children_aux(row):
                     yield inner_row
 
+        if self._virtual:
+            for page in xrange(-(-self.rows.children_len // max_recs)):
+                columns = self._pages.get(page)
+                if columns is None and load_rows:
+                    columns = self._load_virtual_page(page)
+                if columns is None:
+                    continue
+                for index in xrange(len(columns)):
+                    yield self._make_virtual_row(
+                        page * max_recs + index, columns, index)
+            return
+
         for row in _iter_children_aux(self.rows):
             yield row
 
@@ -1980,20 +2511,66 @@ class DataGridModel(GenericTreeModel):
                     yield row
                 rows_len = len(self.rows)
 
+    def iter_column_values(self, column):
+        """Iterate over the values of a column on the loaded rows.
+
+        The rows are iterated in the same order as :meth:`.iter_rows`.
+        On virtual rows mode, the values are read straight from the
+        columns of the loaded pages, without making a row for each one.
+
+        :param int column: the index of the column
+        :returns: an iterator for the values
+        :rtype: generator
+        """
+        if self._virtual:
+            for page in sorted(self._pages):
+                for value in self._pages[page].get_column(column):
+                    yield value
+            return
+
+        for row in self.iter_rows():
+            yield row.data[column]
+
     def get_row_by_id(self, row_id, load_rows=False):
         """Get a row given its id
 
-        Note that this will load the data from the source until the
-        row is found, meaning that everything will be loaded on the
-        worst case (i.e. the row is not present)
+        When `load_rows` is `True`, the data source will be asked where
+        the row is (i.e. its position or its ancestors when the data is
+        hierarchical) and only what is needed to reach it will be loaded.
+
+        Note that if the data source can't tell that (i.e. it returns
+        `None` from :meth:`datagrid_gtk3.db.DataSource.get_row_position`
+        or :meth:`datagrid_gtk3.db.DataSource.get_ancestor_ids`), this
+        will load the data from the source until the row is found,
+        meaning that everything will be loaded on the worst case (i.e.
+        the row is not present)
 
         :param object row_id: the id of the row
+        :param bool load_rows: if we should load rows from the
+            datasource to find the row
         :returns: the row or ``None`` if it wasn't found
         :rtype: :class:`datagrid_gtk3.db.sqlite.Node`
         """
-        if row_id in self.row_id_mapper:
+        if self._virtual:
+            row = self._find_virtual_row(row_id)
+            if row is not None:
+                return row
+        elif row_id in self.row_id_mapper:
             return self.row_id_mapper[row_id]
 
+        if load_rows:
+            row = self._load_row_by_id(row_id)
+            if row is not None:
+                return row
+            # The data source doesn't know where the row is.
+            # Fallback to loading the rows until we find it.
+
+        if self._virtual:
+            for row in self.iter_rows(load_rows=load_rows):
+                if row.data[self.id_column_idx] == row_id:
+                    return row
+            return None
+
         for row in self.iter_rows(load_rows=load_rows):
             # Although we could check row, trying self.row_id_mapper has a
             # chance of needing less iterations (and thus, less loading from
@@ -2006,6 +2583,635 @@ class DataGridModel(GenericTreeModel):
     # Private
     ###
 
+    def _load_row_by_id(self, row_id):
+        """Load only what is needed to reach the row.
+
+        :param object row_id: the id of the row
+        :returns: the row or ``None`` if the data source doesn't
+            know where it is
+        :rtype: :class:`datagrid_gtk3.db.sqlite.Node`
+        """
+        is_tree = (self.parent_column_idx is not None and
+                   not self.active_params.get('flat', False))
+        if not is_tree:
+            position = self.data_source.get_row_position(
+                row_id, self.active_params)
+            if position is None:
+                return None
+
+            if self._virtual:
+                page = position // self.data_source.MAX_RECS
+                if page not in self._pages:
+                    self._load_virtual_page(page)
+                return self._find_virtual_row(row_id)
+
+            page = position // self.data_source.MAX_RECS
+            page_count = page - self.active_params.get('page', 0)
+            if page_count > 0:
+                self.add_rows(page_count=page_count)
+            elif page in self._evicted_pages:
+                self._load_evicted_page(page)
+            return self.row_id_mapper.get(row_id, None)
+
+        ancestors = self.data_source.get_ancestor_ids(row_id)
+        if ancestors is None:
+            return None
+
+        parent = self.rows
+        for id_ in ancestors + [row_id]:
+            if parent is not self.rows:
+                self._ensure_children_is_loaded(parent)
+            row = self.row_id_mapper.get(id_, None)
+            if row is None:
+                # The rows loaded at once when filtering a tree are
+                # not mapped, so we need to look for it on the parent
+                for i, child in enumerate(parent):
+                    if child.data[self.id_column_idx] == id_:
+                        row = child
+                        row.path = parent.path + (i, )
+                        self.row_id_mapper[id_] = row
+                        break
+                else:
+                    return None
+            parent = row
+
+        return row
+
+    def _update_load_params(self):
+        """Set what to load from the records on :attr:`.active_params`.
+
+        When :attr:`.project_columns` is `True`, only the displayed
+        columns (and the image ones, used by the icon view) will be
+        loaded. The others will be `None` on the rows, so anything
+        needing the whole record should use
+        :meth:`datagrid_gtk3.db.DataSource.get_single_record`.
+
+        When :attr:`.truncate_strings` is `True`, only the first
+        :attr:`.STRING_MAX_LENGTH` characters of the strings (plus one
+        to know if they were truncated) will be loaded.
+        """
+        if self.project_columns:
+            self.active_params['columns'] = sorted(
+                col['name'] for col in self.columns
+                if col['name'] in self.display_columns or
+                col['transform'] == 'image')
+        else:
+            self.active_params.pop('columns', None)
+
+        if self.truncate_strings:
+            self.active_params['truncate'] = self.STRING_MAX_LENGTH + 1
+        else:
+            self.active_params.pop('truncate', None)
+
+    def _uses_virtual_rows(self, params):
+        """Check if the rows loaded with the params will be virtual.
+
+        :param dict params: the params to load the rows with
+        :rtype: bool
+        """
+        return (self.virtual_rows and
+                (self.data_source.parent_column_idx is None or
+                 params.get('flat', False)))
+
+    def _add_page(self, page, rows, emit_changed=True):
+        """Add a page to the virtual rows.
+
+        The rows are stored column-wise, so no :class:`Node` is kept
+        for them. See :meth:`._make_virtual_row`.
+
+        :param int page: the page the rows are from
+        :param rows: the rows of the page
+        :type rows: :class:`datagrid_gtk3.db.Node`
+        :param bool emit_changed: if :meth:`.row_changed` should be
+            called for the rows, replacing their placeholders
+        """
+        old_columns = self._pages.get(page)
+        if old_columns is not None:
+            self.resident_rows -= len(old_columns)
+        columns = ColumnarPage(row.data for row in rows)
+        self._pages[page] = columns
+        self.resident_rows += len(columns)
+        if not emit_changed:
+            return
+
+        offset = page * self.data_source.MAX_RECS
+        for i in xrange(min(len(columns), self.rows.children_len - offset)):
+            path = (offset + i, )
+            self.row_changed(Gtk.TreePath(path), self.create_tree_iter(path))
+
+    def _load_virtual_page(self, page):
+        """Load a page of the virtual rows right away.
+
+        :param int page: the page to load
+        :return: the rows of the page
+        :rtype: :class:`datagrid_gtk3.db.ColumnarPage`
+        """
+        request = self._prefetching.pop(page, None)
+        if request is not None:
+            # It will be loaded right now instead
+            request.cancel()
+
+        rows = self.data_source.load(
+            dict(self.active_params, page=page, parent_id=None))
+        self._add_page(page, rows)
+        self._evict_rows(keep_page=page)
+        return self._pages[page]
+
+    def _get_virtual_position(self, index):
+        """Get where one of the virtual rows is.
+
+        This doesn't load the row's page. Only the pages around
+        :attr:`.visible_range` get loaded, by :meth:`.prefetch_rows`.
+
+        :param int index: the index of the row
+        :return: the page containing the row and the row's index on it,
+            or `None` and `None` while the page is not loaded
+        :rtype: tuple
+        :raise IndexError: if there's no row at `index`
+        """
+        if not 0 <= index < self.rows.children_len:
+            raise IndexError(index)
+
+        page, page_index = divmod(index, self.data_source.MAX_RECS)
+        columns = self._pages.get(page)
+        if columns is None:
+            return None, None
+        if page_index >= len(columns):
+            # The records changed since they were counted
+            return None, None
+
+        return columns, page_index
+
+    def _get_placeholder_value(self, column):
+        """Get the value displayed while a row's page is not loaded.
+
+        :param int column: the index of the column
+        :return: an empty value of the column's type
+        """
+        column_type = self.on_get_column_type(column)
+        if column_type is bool:
+            return False
+        return '' if column_type is str else None
+
+    def _get_virtual_row(self, index):
+        """Get one of the virtual rows.
+
+        :param int index: the index of the row
+        :return: the row or :attr:`._placeholder` while its page
+            is not loaded
+        :rtype: :class:`datagrid_gtk3.db.Node`
+        :raise IndexError: if there's no row at `index`
+        """
+        columns, page_index = self._get_virtual_position(index)
+        if columns is None:
+            return self._placeholder
+        return self._make_virtual_row(index, columns, page_index)
+
+    def _make_virtual_row(self, index, columns, page_index):
+        """Make a row for one of the rows stored on a page.
+
+        Note that changing the row will not change the page. Use
+        :meth:`.set_value` for that.
+
+        :param int index: the index of the row
+        :param columns: the page containing the row
+        :type columns: :class:`datagrid_gtk3.db.ColumnarPage`
+        :param int page_index: the row's index on the page
+        :return: the row
+        :rtype: :class:`datagrid_gtk3.db.Node`
+        """
+        row = Node(data=columns.get_row(page_index))
+        row.path = (index, )
+        return row
+
+    def _find_virtual_row(self, row_id):
+        """Find one of the virtual rows on the loaded pages.
+
+        :param object row_id: the id of the row
+        :return: the row or `None` if it is not loaded
+        :rtype: :class:`datagrid_gtk3.db.Node`
+        """
+        if self.id_column_idx is None:
+            return None
+
+        for page, columns in self._pages.iteritems():
+            page_index = columns.find(self.id_column_idx, row_id)
+            if page_index is not None:
+                return self._make_virtual_row(
+                    page * self.data_source.MAX_RECS + page_index,
+                    columns, page_index)
+        return None
+
+    def _load_visible_pages(self):
+        """Load the virtual pages being displayed and around them."""
+        if self.visible_range is None:
+            return
+
+        max_recs = self.data_source.MAX_RECS
+        first_visible = self.visible_range[0][0] // max_recs
+        last_visible = self.visible_range[1][0] // max_recs
+        last_page = (self.rows.children_len - 1) // max_recs
+        pages = xrange(
+            max(first_visible - max(self.prefetch_pages, 0), 0),
+            min(last_visible + max(self.prefetch_pages, 0), last_page) + 1)
+
+        # The pages scrolled out of view are not needed anymore
+        for page, request in self._prefetching.items():
+            if page not in pages:
+                request.cancel()
+                del self._prefetching[page]
+
+        for page in pages:
+            if page in self._pages:
+                continue
+            if first_visible <= page <= last_visible:
+                priority = PRIORITY_VISIBLE
+            else:
+                priority = PRIORITY_PREFETCH
+            request = self._prefetching.get(page)
+            if request is not None:
+                if request.priority <= priority:
+                    continue
+                # Load it again with a higher priority
+                request.cancel()
+            self._load_page(page, priority)
+
+    def _evict_rows(self, keep_page=None):
+        """Evict rows until there are at most max_resident_rows loaded.
+
+        The children of the rows collapsed first are evicted first.
+        Then, for non-hierarchical data, the pages farthest from the
+        visible range.
+
+        :param int keep_page: a page that should not be evicted (e.g.
+            one that was just loaded to be used right away)
+        """
+        if self.max_resident_rows <= 0:
+            return
+
+        while (self.resident_rows > self.max_resident_rows and
+               self._collapsed):
+            row = self._collapsed.popitem(last=False)[1]
+            self._unload_children(row)
+            self.evictions += 1
+
+        max_recs = self.data_source.MAX_RECS
+        if self._virtual:
+            pages = self._pages.keys()
+        elif (self.parent_column_idx is None or
+                self.active_params.get('flat', False)):
+            pages = [page for page in xrange(-(-len(self.rows) // max_recs))
+                     if page not in self._evicted_pages]
+        else:
+            return
+
+        if self.visible_range is not None:
+            center = self.visible_range[0][0] // max_recs
+        else:
+            center = 0
+        farthest = sorted(
+            (page for page in pages if page != keep_page),
+            key=lambda page: abs(page - center))
+        while self.resident_rows > self.max_resident_rows and farthest:
+            page = farthest.pop()
+            if self._virtual:
+                self.resident_rows -= len(self._pages.pop(page))
+            else:
+                self._evict_page(page)
+            self.evictions += 1
+
+    def _evict_page(self, page):
+        """Evict one of the pages appended to the non-hierarchical rows.
+
+        Its rows are replaced by :attr:`._placeholder`, so the view
+        still has all the rows loaded so far, until the page gets
+        loaded again by :meth:`.prefetch_rows` or
+        :meth:`._load_evicted_page`.
+
+        :param int page: the page to evict
+        """
+        start = page * self.data_source.MAX_RECS
+        end = min(start + self.data_source.MAX_RECS, len(self.rows))
+        for index in xrange(start, end):
+            row = self.rows[index]
+            if self.id_column_idx is not None:
+                self.row_id_mapper.pop(row.data[self.id_column_idx], None)
+            self.rows[index] = self._placeholder
+        self.resident_rows -= end - start
+        self._evicted_pages.add(page)
+
+    def _restore_page(self, page, rows):
+        """Put the rows of an evicted page back in place.
+
+        :param int page: the page the rows are from
+        :param rows: the rows of the page
+        :type rows: :class:`datagrid_gtk3.db.Node`
+        """
+        self._evicted_pages.discard(page)
+        offset = page * self.data_source.MAX_RECS
+        # The records may have changed since they were counted
+        rows = rows[:max(len(self.rows) - offset, 0)]
+        for i, row in enumerate(rows):
+            path = (offset + i, )
+            row.path = path
+            self.rows[offset + i] = row
+            if self.id_column_idx is not None:
+                self.row_id_mapper[row.data[self.id_column_idx]] = row
+            self.row_changed(Gtk.TreePath(path), self.create_tree_iter(path))
+        self.resident_rows += len(rows)
+
+    def _load_evicted_page(self, page):
+        """Load an evicted page of the non-hierarchical rows right away.
+
+        :param int page: the page to load
+        """
+        request = self._prefetching.pop(page, None)
+        if request is not None:
+            # It will be loaded right now instead
+            request.cancel()
+
+        # The records are already counted
+        rows, _ = self.data_source.load_counted(dict(
+            self.active_params, page=page, parent_id=None, defer_count=True))
+        self._restore_page(page, rows)
+        self._evict_rows(keep_page=page)
+
+    def _unload_children(self, row):
+        """Unload the children of the row, and theirs, recursively.
+
+        They will be loaded again by :meth:`._ensure_children_is_loaded`.
+
+        :param row: the row to unload the children from
+        :type row: :class:`datagrid_gtk3.db.Node`
+        """
+        for child in row:
+            self._unload_children(child)
+            child_id = child.data[self.id_column_idx]
+            self.row_id_mapper.pop(child_id, None)
+            self._collapsed.pop(child_id, None)
+        self.resident_rows -= len(row)
+        del row[:]
+
+    def _count_rows(self, rows):
+        """Count the rows and their children, recursively.
+
+        :param rows: the rows to count
+        :type rows: :class:`datagrid_gtk3.db.Node`
+        :return: the number of rows
+        :rtype: int
+        """
+        return sum(1 + self._count_rows(row) for row in rows)
+
+    def _load_page(self, page, priority):
+        """Load a page of the non-hierarchical data on the worker.
+
+        :param int page: the page to load
+        :param int priority: the priority of the request.
+            See :mod:`datagrid_gtk3.db.worker`
+        """
+        params = dict(self.active_params, page=page, parent_id=None)
+        self._prefetching[page] = self.worker.load(
+            self.data_source, params, priority=priority,
+            callback=functools.partial(self._on_page_prefetched, page))
+
+    def _on_records_counted(self, request):
+        """Update the total records with the ones counted on the worker.
+
+        :param request: the finished count request
+        :type request: :class:`datagrid_gtk3.db.worker.Request`
+        """
+        self._count_request = None
+        try:
+            total_recs, exact = request.result()
+        except Exception:
+            logger.exception('Failed to count records')
+            return
+
+        if exact:
+            self.total_recs = total_recs
+            self.total_recs_exact = True
+            # Let the data source avoid loading pages past the end
+            self.data_source.total_recs = total_recs
+        elif total_recs is not None:
+            self.total_recs = max(self.total_recs, total_recs)
+
+        self.emit('data-loaded', self.total_recs)
+
+    def _on_page_prefetched(self, page, request):
+        """Store a page loaded by the worker.
+
+        :param int page: the page that got loaded
+        :param request: the finished load request
+        :type request: :class:`datagrid_gtk3.db.worker.Request`
+        """
+        self._prefetching.pop(page, None)
+        try:
+            rows = request.result()
+        except Exception:
+            logger.exception('Failed to prefetch page %d', page)
+            return
+
+        if self._virtual:
+            self._add_page(page, rows)
+            self._evict_rows()
+            return
+        if page in self._evicted_pages:
+            self._restore_page(page, rows)
+            self._evict_rows(keep_page=page)
+            return
+
+        if page > self.active_params.get('page', 0):
+            self._prefetched[page] = rows
+        if page == self._requested_page:
+            self._requested_page = None
+            self.add_rows()
+
+    def _on_notify_formatting(self, model, p_spec):
+        """Compile the formatters again after a property they use changed.
+
+        :param model: this model
+        :type model: :class:`DataGridModel`
+        """
+        self._compile_formatters()
+
+    def _on_notify_formatted_cache_size(self, model, p_spec):
+        """Resize the formatted values cache.
+
+        :param model: this model
+        :type model: :class:`DataGridModel`
+        """
+        self._formatted_cache.max_size = self.formatted_cache_size
+        self._formatted_cache.clear()
+
+    def _compile_formatters(self):
+        """Compile the functions that format the values of the columns.
+
+        Everything that doesn't depend on the value (the transformer,
+        its arguments, etc) is resolved here once, instead of on every
+        :meth:`.get_formatted_value` call.
+        """
+        self._formatters = [self._compile_formatter(col_dict)
+                            for col_dict in self.columns]
+        # Images are already cached by ImageCacheManager, and the first
+        # value formatted for them may be a placeholder (see
+        # image_transform's load_on_thread)
+        self._cached_columns = {
+            i for i, col_dict in enumerate(self.columns)
+            if col_dict['transform'] != 'image'}
+        # The cached values were formatted differently
+        self._formatted_cache.clear()
+
+    def _compile_formatter(self, col_dict):
+        """Compile the function that formats the values of a column.
+
+        :param dict col_dict: the column
+        :return: a callable receiving the value and if it is visible
+        :rtype: callable
+        """
+        # Defaults to string transformer if None
+        transformer_name = col_dict['transform'] or 'string'
+        transformer = get_transformer(transformer_name)
+        transformer_kwargs = {}
+
+        custom_options = col_dict.get('transform_options')
+        if custom_options:
+            transformer_kwargs['options'] = custom_options
+
+        # Only enforce value type if the config was provided. Otherwise,
+        # we would just be spamming a lot of obvious warnings (we got the type
+        # from introspecting the database and for sqlite, it has a high
+        # probability of not being an exact match in python).
+        if col_dict['from_config'] and 'type' in col_dict:
+            type_ = col_dict['type']
+        else:
+            type_ = None
+        enforce_value_type = self._enforce_value_type
+
+        if transformer is None:
+            logger.warning("No transformer found for %s", transformer_name)
+
+            def format_value(value, visible):
+                if type_ is not None and value is not None:
+                    value = enforce_value_type(value, type_)
+                return value
+
+        elif (transformer_name == 'boolean' and
+                col_dict['name'] == self.data_source.SELECTED_COLUMN):
+            # __selected is an exception to the boolean transformation.
+            # It requires a bool value and not a pixbuf
+            def format_value(value, visible):
+                if type_ is not None and value is not None:
+                    value = enforce_value_type(value, type_)
+                return bool(value)
+
+        elif transformer_name == 'image':
+            format_value = self._compile_image_formatter(
+                transformer, transformer_kwargs, type_)
+
+        elif transformer_name in ['string', 'html'] and self.truncate_strings:
+            transformer_kwargs.update(self._get_string_kwargs())
+            # The value may have been truncated when loading it.
+            # See _update_load_params
+            truncated_kwargs = dict(transformer_kwargs, truncated=True)
+            max_length = self.STRING_MAX_LENGTH
+
+            def format_value(value, visible):
+                if type_ is not None and value is not None:
+                    value = enforce_value_type(value, type_)
+                if isinstance(value, basestring) and len(value) > max_length:
+                    return transformer(value, **truncated_kwargs)
+                return transformer(value, **transformer_kwargs)
+
+        else:
+            if transformer_name in ['string', 'html']:
+                transformer_kwargs.update(self._get_string_kwargs())
+
+            def format_value(value, visible):
+                if type_ is not None and value is not None:
+                    value = enforce_value_type(value, type_)
+                return transformer(value, **transformer_kwargs)
+
+        return format_value
+
+    def _get_string_kwargs(self):
+        """Get the kwargs for the string and html transformers.
+
+        :rtype: dict
+        """
+        return dict(max_length=self.STRING_MAX_LENGTH, oneline=True,
+                    decode_fallback=self.decode_fallback)
+
+    def _compile_image_formatter(self, transformer, transformer_kwargs,
+                                 type_):
+        """Compile the function that formats the values of an image column.
+
+        :param callable transformer: the image transformer
+        :param dict transformer_kwargs: the column's transformer kwargs
+        :param type type_: the type to enforce on the values, or `None`
+        :return: a callable receiving the value and if it is visible
+        :rtype: callable
+        """
+        transformer_kwargs.update(dict(
+            size=self.image_max_size,
+            draw_border=self.image_draw_border,
+            load_on_thread=self.image_load_on_thread,
+            draft=True,
+        ))
+        image_max_size = self.image_max_size
+        fallback_key = (self.image_draw_border, image_max_size)
+        enforce_value_type = self._enforce_value_type
+        get_media_callback = self.get_media_callback
+        prefix = self.IMAGE_PREFIX
+
+        def format_value(value, visible):
+            if type_ is not None and value is not None:
+                value = enforce_value_type(value, type_)
+
+            # If no value, use an invisible image as a placeholder
+            if not value:
+                invisible_img = self._invisible_images.get(image_max_size)
+                if not invisible_img:
+                    invisible_img = NO_IMAGE_PIXBUF.scale_simple(
+                        image_max_size, image_max_size,
+                        GdkPixbuf.InterpType.NEAREST)
+                    self._invisible_images[image_max_size] = invisible_img
+                return invisible_img
+
+            if isinstance(value, buffer):
+                # FIXME: Support buffer in the future. Atm, set visible to
+                # False so a fallback image will be returned bellow
+                logger.warn('Buffered images are still not supported')
+                visible = False
+
+            # When not visible on the iconview, use an already generated
+            # fallback image (that has the same dimensions as the real
+            # image should have) to improve loading time.
+            if not visible:
+                fallback = self._fallback_images.get(fallback_key)
+                if not fallback:
+                    fallback = transformer(None, **transformer_kwargs)
+                    self._fallback_images[fallback_key] = fallback
+                return fallback
+
+            if value.startswith(prefix):
+                value = value[len(prefix):]
+
+            if not value:
+                # Force fallback in this case
+                value = None
+            elif not os.path.isabs(value):
+                if get_media_callback is None:
+                    logger.warning(
+                        "Don't know how to access the relative path '%s'. "
+                        "Try passing get_full_path to controller.", value)
+                    value = None
+                else:
+                    value = get_media_callback(value)
+
+            return transformer(value, **transformer_kwargs)
+
+        return format_value
+
     def _enforce_value_type(self, value, type_):
         # FIXME: Some configurations are indicating the images as buffer,
         # but really are storing the file path. This can be removed
@@ -2029,6 +3235,9 @@ class DataGridModel(GenericTreeModel):
             self.add_rows(row)
 
     def _get_row_by_path(self, iter_):
+        if self._virtual and len(iter_) == 1:
+            return self._get_virtual_row(iter_[0])
+
         def get_row_by_iter_aux(iter_aux, rows):
             self._ensure_children_is_loaded(rows)
             if len(iter_aux) == 1:
@@ -2069,6 +3278,11 @@ class DataGridModel(GenericTreeModel):
 
     def on_get_iter(self, path):
         """Return the node corresponding to the given path (node is path)."""
+        if self._virtual:
+            if len(path) == 1 and 0 <= path[0] < self.rows.children_len:
+                return tuple(path)
+            return None
+
         try:
             # row and path are the same in this model. We just need
             # to make sure that the iter is valid
@@ -2085,15 +3299,40 @@ class DataGridModel(GenericTreeModel):
         else:
             visible = True
 
-        row = self._get_row_by_path(rowref)
-        raw = row.data[column]
+        if self._virtual:
+            # Read the value straight from its page, without a row
+            columns, page_index = self._get_virtual_position(rowref[0])
+            if columns is None:
+                # The row's page is not loaded yet
+                return self._get_placeholder_value(column)
+            raw = columns.get_value(page_index, column)
+            row = None
+        else:
+            row = self._get_row_by_path(rowref)
+            if row is self._placeholder:
+                # The row's page got evicted and is not loaded again yet
+                return self._get_placeholder_value(column)
+            raw = row.data[column]
         # Don't format value for id and parent columns. They are not displayed
         # on the grid and we may need their full values to get their records
         # (e.g. when the id is a string column)
         if column in [self.id_column_idx, self.parent_column_idx]:
             return raw
+        if self.id_column_idx is None or column not in self._cached_columns:
+            return self._formatters[column](raw, visible)
+
+        # The view gets the values again each time it is redrawn, so
+        # cache them instead of formatting them every time
+        if row is None:
+            id_ = columns.get_value(page_index, self.id_column_idx)
         else:
-            return self.get_formatted_value(raw, column, visible=visible)
+            id_ = row.data[self.id_column_idx]
+        key = (id_, column)
+        value = self._formatted_cache.get(key, _NOT_CACHED)
+        if value is _NOT_CACHED:
+            value = self._formatters[column](raw, visible)
+            self._formatted_cache[key] = value
+        return value
 
     def on_iter_next(self, rowref):
         """Return the next node at this level of the tree."""
@@ -2127,13 +3366,16 @@ class DataGridModel(GenericTreeModel):
 
     def on_iter_has_child(self, rowref):
         """Return true if this node has children."""
+        if self._virtual:
+            return False
+
         row = self._get_row_by_path(rowref)
         return row.children_len > 0
 
     def on_iter_n_children(self, rowref):
         """Return the number of children of this node."""
         if rowref is None:
-            return len(self.rows)
+            return self.rows.children_len
 
         row = self._get_row_by_path(rowref)
         return row.children_len
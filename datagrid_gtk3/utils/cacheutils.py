@@ -0,0 +1,113 @@
+"""Cache utilities."""
+
+import collections
+import threading
+
+
+class LRUCache(object):
+
+    """A mapping that discards the least recently used items.
+
+    Lookups through :meth:`.get` are counted as hits or misses so the
+    cache effectiveness can be observed through :meth:`.info`.
+
+    :param int max_size: the maximum number of items to keep, or their
+        maximum total size when `get_size` is given
+    :param callable get_size: a callable returning the size of an
+        item (e.g. its approximate memory usage)
+    """
+
+    def __init__(self, max_size, get_size=None):
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+        self._get_size = get_size or (lambda value: 1)
+        self._lock = threading.Lock()
+        # Maps the keys to their values and sizes
+        self._items = collections.OrderedDict()
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def __len__(self):
+        return len(self._items)
+
+    def __setitem__(self, key, value):
+        size = self._get_size(value)
+        with self._lock:
+            self._discard(key)
+            self._items[key] = (value, size)
+            self.size += size
+            while self.size > self.max_size:
+                self.size -= self._items.popitem(last=False)[1][1]
+
+    ###
+    # Public
+    ###
+
+    def get(self, key, default=None):
+        """Get the item for the given key, marking it as recently used.
+
+        :param object key: the key of the item
+        :param object default: what to return if the item is not cached
+        :return: the cached item or `default`
+        """
+        with self._lock:
+            try:
+                item = self._items.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+
+            self._items[key] = item
+            self.hits += 1
+            return item[0]
+
+    def pop(self, key, default=None):
+        """Remove the item for the given key from the cache.
+
+        :param object key: the key of the item
+        :param object default: what to return if the item is not cached
+        :return: the removed item or `default`
+        """
+        with self._lock:
+            item = self._discard(key)
+        return item[0] if item is not None else default
+
+    def clear(self):
+        """Remove all the items from the cache."""
+        with self._lock:
+            self._items.clear()
+            self.size = 0
+
+    def info(self):
+        """Get statistics about the cache usage.
+
+        :return: a dict containing the number of ``hits`` and
+            ``misses``, the actual ``size`` and the ``max_size``
+        :rtype: dict
+        """
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': self.size,
+            'max_size': self.max_size,
+        }
+
+    ###
+    # Private
+    ###
+
+    def _discard(self, key):
+        """Remove the item for the given key, with the lock held.
+
+        :param object key: the key of the item
+        :return: the removed value and its size, or `None`
+        :rtype: tuple
+        """
+        item = self._items.pop(key, None)
+        if item is not None:
+            self.size -= item[1]
+        return item
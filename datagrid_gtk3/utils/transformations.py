@@ -72,7 +72,7 @@ def transformer(transformer_name):
 
 @transformer('string')
 def string_transform(value, max_length=None, oneline=True,
-                     decode_fallback=None):
+                     decode_fallback=None, truncated=False):
     """String transformation.
 
     :param object value: the value that will be converted to
@@ -83,6 +83,8 @@ def string_transform(value, max_length=None, oneline=True,
         in one line
     :param callable decode_fallback: a callable to use
         to decode value in case it cannot be converted to unicode directly
+    :param bool truncated: if the value is already truncated, in which
+        case it will be ellipsized even if not greater than `max_length`
     :return: the string representation of the value
     :rtype: str
     """
@@ -107,7 +109,7 @@ def string_transform(value, max_length=None, oneline=True,
         value = u' '.join(v.strip() for v in value.splitlines() if v.strip())
 
     # Don't show more than max_length chars in treeview. Helps with performance
-    if max_length is not None and len(value) > max_length:
+    if max_length is not None and (truncated or len(value) > max_length):
         value = u'%s [...]' % (value[:max_length], )
 
     # At the end, if value is unicode, it needs to be converted to
@@ -117,7 +119,7 @@ def string_transform(value, max_length=None, oneline=True,
 
 @transformer('html')
 def html_transform(value, max_length=None, oneline=True,
-                   decode_fallback=None):
+                   decode_fallback=None, truncated=False):
     """HTML transformation.
 
     :param object value: the escaped html that will be unescaped
@@ -127,6 +129,8 @@ def html_transform(value, max_length=None, oneline=True,
         in one line
     :param callable decode_fallback: a callable to use
         to decode value in case it cannot be converted to unicode directly
+    :param bool truncated: if the value is already truncated, in which
+        case it will be ellipsized even if not greater than `max_length`
     :return: the html string unescaped
     :rtype: str
     """
@@ -137,7 +141,7 @@ def html_transform(value, max_length=None, oneline=True,
     unescaped = html_parser.unescape(value)
     return string_transform(
         unescaped, max_length=max_length, oneline=oneline,
-        decode_fallback=decode_fallback)
+        decode_fallback=decode_fallback, truncated=truncated)
 
 
 @transformer('boolean')